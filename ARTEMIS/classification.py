@@ -4,14 +4,23 @@ import os.path
 import csv
 from datetime import datetime
 import pprint
+import copy
+import itertools
+import threading
+import time
 
 from sklearn.base import ClassifierMixin
-from sklearn.neighbors.base import NeighborsBase, RadiusNeighborsMixin, \
-        SupervisedIntegerMixin
+from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import NearestNeighbors
+try:
+    from sklearn.neighbors._base import NeighborsBase, RadiusNeighborsMixin
+except ImportError:  # scikit-learn < 0.22
+    from sklearn.neighbors.base import NeighborsBase, RadiusNeighborsMixin
 from sklearn.utils import check_array
 from sklearn.utils.extmath import weighted_mode
 
 import config
+from storage import grow_rows
 
 
 def _within_interval(x, interval):
@@ -40,46 +49,35 @@ def classification_weights(neigh_dist, neigh_ind, target_space):
 
     source_weight is determined based on the physical site of a target (current
     site, or a previous deployment) and whether the target has been manually
-    reviewed.
-    """
+    reviewed (see targets.source_weight), and is stored for each row of the
+    classifier tables as it is added.
 
-    weights = []
-    # determine weight for each neighbor
-    inds = np.squeeze(neigh_ind.tolist()).tolist()
-    if type(inds) is int:
-        inds = [inds]
-
-    for i, ind in enumerate(inds):
-        target = target_space.classifier_index_to_target[ind]
-        source = target.source
-
-        # using source, determine source_weight. If source is not formatted
-        # correctly, assign weight of 1
-        if source.startswith(config.site_name):
-            if source.endswith('manual'):
-                source_weight = 1
-            elif source.endswith('auto'):
-                source_weight = 0.9
-        else:
-            if source.endswith('manual'):
-                source_weight = 0.9
-            elif source.endswith('auto'):
-                source_weight = 0.8
-            else:
-                source_weight = 1
-
-        if type(np.squeeze(neigh_dist.tolist()).tolist()) is float:
-            distance = np.squeeze(neigh_dist.tolist()).tolist()
-        else:
-            distance = np.squeeze(neigh_dist.tolist()).tolist()[i]
+    neigh_dist and neigh_ind hold the neighbors of one query, or of a batch of
+    queries as returned by radius_neighbors (arrays of dtype object holding
+    one array per query). For a batch, an array of dtype object holding the
+    weights for each query is returned.
+    """
+    source_weights = target_space.get_classifier_source_weights()
+    neigh_ind = np.asarray(neigh_ind)
+    if neigh_ind.dtype != object and neigh_ind.ndim < 2:
+        # single query
+        distance = np.asarray(neigh_dist, dtype=np.float64).ravel()
         # if a target is exactly in the same space as another target, assign
         # weight of 1 (1/1 = 1)
-        if distance == 0:
-            distance = 1
-
-        weights += [(1/distance) * source_weight]
-
-    return np.array(weights)
+        distance[distance == 0] = 1
+        return source_weights[neigh_ind.ravel().astype(np.intp)] / distance
+
+    weights = np.empty(len(neigh_ind), dtype=object)
+    if len(neigh_ind) == 0:
+        return weights
+    splits = np.cumsum([len(ind) for ind in neigh_ind])[:-1]
+    distance = np.concatenate(list(neigh_dist)).astype(np.float64)
+    distance[distance == 0] = 1
+    ind = np.concatenate(list(neigh_ind)).astype(np.intp)
+    for i, query_weights in enumerate(np.split(source_weights[ind] / distance,
+                                               splits)):
+        weights[i] = query_weights
+    return weights
 
 class BackgroundClassifier():
     """Classifier implementing priority-based background hyperspace rules to be
@@ -201,8 +199,365 @@ class BackgroundClassifier():
         raise ValueError("No background classification could be found for \
                 {0}.".format(X))
 
+class IncrementalNeighborIndex():
+    """Radius neighbor index that accepts new rows without a full refit.
+
+    Rows are held in one growable array. Rows up to n_indexed are searched
+    with a scikit-learn NearestNeighbors tree; rows added since are held in
+    an insert buffer searched by brute force. Once the buffer holds more than
+    rebuild_threshold rows, a new tree over all rows is built (in a
+    background thread if background is True) and swapped in, while queries
+    keep using the old tree and buffer.
+
+    Indices returned by radius_neighbors are positions in the order rows were
+    added.
+
+    Parameters
+    ----------
+    radius, algorithm, leaf_size, metric, p, metric_params
+        As for sklearn.neighbors.NearestNeighbors.
+    rebuild_threshold : int, optional
+        Size of the insert buffer above which the tree is rebuilt.
+    background : bool, optional
+        Rebuild in a background thread rather than in add().
+    """
+    def __init__(self, radius=5.0, algorithm='auto', leaf_size=30, metric='minkowski',
+                 p=2, metric_params=None,
+                 rebuild_threshold=config.classifier_rebuild_threshold,
+                 background=True):
+        self.radius = radius
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.metric = metric
+        self.p = p
+        self.metric_params = metric_params
+        self.rebuild_threshold = rebuild_threshold
+        self.background = background
+
+        self._lock = threading.Lock()
+        self._X = np.empty((0, 0))
+        self._size = 0
+        self._tree = None
+        self.n_indexed = 0
+        self.rebuilding = False
+        self.rebuilds = 0
+        self.last_rebuild_seconds = None
+
+    def __len__(self):
+        return self._size
+
+    def _build_tree(self, X):
+        return NearestNeighbors(radius=self.radius, algorithm=self.algorithm,
+                                leaf_size=self.leaf_size, metric=self.metric,
+                                p=self.p, metric_params=self.metric_params).fit(X)
+
+    def fit(self, X):
+        """Replaces all rows with X and builds the tree over them."""
+        X = check_array(X, dtype=np.float64) if len(X) else np.empty((0, 0))
+        tree = self._build_tree(X) if len(X) else None
+        with self._lock:
+            self._X = X.copy()
+            self._size = len(X)
+            self._tree = tree
+            self.n_indexed = len(X)
+        return self
+
+    def add(self, X):
+        """Appends rows X to the insert buffer, starting a rebuild of the tree
+        if the buffer is over rebuild_threshold.
+        """
+        X = check_array(X, dtype=np.float64)
+        with self._lock:
+            if self._size == 0:
+                self._X = np.empty((0, X.shape[1]))
+            self._X = grow_rows(self._X, self._size + len(X))
+            self._X[self._size:self._size + len(X)] = X
+            self._size += len(X)
+            rebuild = (not self.rebuilding and
+                       self._size - self.n_indexed > self.rebuild_threshold)
+            if rebuild:
+                self.rebuilding = True
+        if rebuild:
+            if self.background:
+                thread = threading.Thread(target=self._rebuild)
+                thread.daemon = True
+                thread.start()
+            else:
+                self._rebuild()
+
+    def _rebuild(self):
+        """Builds a tree over every row added so far and swaps it in."""
+        try:
+            start = time.time()
+            with self._lock:
+                size = self._size
+                X = self._X[:size].copy()
+            tree = self._build_tree(X)
+            with self._lock:
+                self._tree = tree
+                self.n_indexed = size
+                self.rebuilds += 1
+                self.last_rebuild_seconds = time.time() - start
+        finally:
+            self.rebuilding = False
+
+    def _buffer_neighbors(self, X, buffer, radius):
+        """Brute-force radius search of buffer, returns lists of distances and
+        of positions in buffer for each row of X.
+        """
+        kwargs = dict(self.metric_params or {})
+        if self.metric == 'minkowski':
+            kwargs['p'] = self.p
+        dist = pairwise_distances(X, buffer, metric=self.metric, **kwargs)
+        rows, cols = np.nonzero(dist <= radius)
+        splits = np.searchsorted(rows, np.arange(1, len(X)))
+        return (np.split(dist[rows, cols], splits), np.split(cols, splits))
+
+    def radius_neighbors(self, X, radius=None):
+        """Returns arrays (of dtype object) holding the distances and indices
+        of neighbors within radius of each row of X, as for
+        NearestNeighbors.radius_neighbors.
+        """
+        X = check_array(X, dtype=np.float64)
+        radius = self.radius if radius is None else radius
+        with self._lock:
+            tree, n_indexed = self._tree, self.n_indexed
+            buffer = self._X[n_indexed:self._size]
+        neigh_dist = np.empty(len(X), dtype=object)
+        neigh_ind = np.empty(len(X), dtype=object)
+        if tree is not None:
+            tree_dist, tree_ind = tree.radius_neighbors(X, radius)
+        if len(buffer):
+            buffer_dist, buffer_ind = self._buffer_neighbors(X, buffer, radius)
+        for i in range(len(X)):
+            if tree is not None and len(buffer):
+                neigh_dist[i] = np.concatenate([tree_dist[i], buffer_dist[i]])
+                neigh_ind[i] = np.concatenate([tree_ind[i], buffer_ind[i] + n_indexed])
+            elif tree is not None:
+                neigh_dist[i], neigh_ind[i] = tree_dist[i], tree_ind[i]
+            elif len(buffer):
+                neigh_dist[i], neigh_ind[i] = buffer_dist[i], buffer_ind[i] + n_indexed
+            else:
+                neigh_dist[i], neigh_ind[i] = np.empty(0), np.empty(0, dtype=np.intp)
+        return neigh_dist, neigh_ind
+
+    def copy(self):
+        """Returns a copy that rows can be added to without changing this
+        index. The tree is shared, as it is never modified once built.
+        """
+        with self._lock:
+            index = copy.copy(self)
+            index._X = self._X[:self._size].copy()
+        index._lock = threading.Lock()
+        # a rebuild running on this index does not update the copy
+        index.rebuilding = False
+        return index
+
+    def stats(self):
+        return {'rows': self._size,
+                'indexed': self.n_indexed,
+                'buffered': self._size - self.n_indexed,
+                'rebuilding': self.rebuilding,
+                'rebuilds': self.rebuilds,
+                'last_rebuild_seconds': self.last_rebuild_seconds}
+
+class GridIndex():
+    """Radius neighbor index hashing rows into a uniform grid of cells.
+
+    Each cell is a cube with sides of length radius, so every neighbor of a
+    point within radius lies in the point's cell or one of the 3**d cells
+    adjacent to it, for any Minkowski metric. A query visits only those
+    cells, and adding a row appends it to one cell in O(1), so there is no
+    tree to rebuild. Classifier features are scaled to about [0, 1] on each
+    axis (see _scale_axis), so this works well when radius is small relative
+    to 1. With radius of 1/2 or more, a query's cell and its adjacent cells
+    cover the whole feature range, and a query compares against every row as
+    a brute-force search does; with the classifier's default radius of 5.0,
+    all rows are in one cell.
+
+    Cell coordinates are hashed to one integer. A hash collision only adds
+    rows that are then rejected by their distance.
+
+    Parameters
+    ----------
+    radius : float
+        Radius of queries, and side of each cell.
+    metric : {'minkowski', 'euclidean', 'manhattan', 'chebyshev'}, optional
+        Distance metric.
+    p : float, optional
+        Power parameter for the Minkowski metric.
+    """
+    # odd multipliers of each cell coordinate in the hash
+    _hash_multipliers = np.array([1, 2654435761, 805459861, 3674653429,
+                                  2097192037, 1434869437, 2165219737,
+                                  433494437], dtype=np.int64)
+
+    def __init__(self, radius=5.0, metric='minkowski', p=2, **kwargs):
+        if metric == 'euclidean':
+            p = 2
+        elif metric == 'manhattan':
+            p = 1
+        elif metric == 'chebyshev':
+            p = np.inf
+        elif metric != 'minkowski':
+            raise ValueError("Metric {0} is not supported by GridIndex. Valid " \
+                    "metrics are 'minkowski', 'euclidean', 'manhattan' or " \
+                    "'chebyshev'.".format(metric))
+        if p < 1:
+            raise ValueError("GridIndex requires p >= 1.")
+        self.radius = radius
+        self.p = p
+        self._lock = threading.Lock()
+        self._X = np.empty((0, 0))
+        self._size = 0
+        self._cells = {}
+        self._multipliers = None
+        self._below = self._above = None
+        self._offset_keys = None
+
+    def __len__(self):
+        return self._size
+
+    def _keys(self, X):
+        """Returns hash of the cell holding each row of X."""
+        cells = np.floor(X / self.radius).astype(np.int64)
+        return cells.dot(self._multipliers)
+
+    def _norm(self, diff, axis=-1):
+        """Returns Minkowski norm of absolute differences diff along axis."""
+        if self.p == 2:
+            return np.sqrt((diff * diff).sum(axis=axis))
+        elif self.p == 1:
+            return diff.sum(axis=axis)
+        elif self.p == np.inf:
+            return diff.max(axis=axis)
+        return (diff ** self.p).sum(axis=axis) ** (1. / self.p)
+
+    def _reachable_offsets(self, X, radius):
+        """Returns mask, for each row of X, of the adjacent cells that lie
+        within radius of it. Corner cells are often farther away than radius
+        and are skipped.
+        """
+        position = X / self.radius
+        position = position - np.floor(position)  # within [0, 1) of its cell
+        ratio = radius / self.radius
+        # distance along each axis (in cells) to the cell below is position,
+        # and to the cell above is 1 - position
+        if self.p == np.inf:
+            too_far = (np.dot(position > ratio, self._below.T) +
+                       np.dot(1 - position > ratio, self._above.T))
+            return too_far == 0
+        gaps = (np.dot(position ** self.p, self._below.T) +
+                np.dot((1 - position) ** self.p, self._above.T))
+        # allow for rounding at the boundary
+        return gaps <= ratio ** self.p * (1 + 1e-9)
+
+    def fit(self, X):
+        """Replaces all rows with X."""
+        with self._lock:
+            self._X = np.empty((0, 0))
+            self._size = 0
+            self._cells = {}
+        if len(X):
+            self.add(X)
+        return self
+
+    def add(self, X):
+        """Adds rows X, each to the cell holding it."""
+        X = check_array(X, dtype=np.float64)
+        with self._lock:
+            if self._size == 0:
+                n_features = X.shape[1]
+                self._X = np.empty((0, n_features))
+                multipliers = self._hash_multipliers[
+                        np.arange(n_features) % len(self._hash_multipliers)]
+                self._multipliers = multipliers
+                offsets = np.array(list(itertools.product((-1, 0, 1),
+                                                          repeat=n_features)))
+                self._below = (offsets == -1).astype(np.float64)
+                self._above = (offsets == 1).astype(np.float64)
+                self._offset_keys = offsets.dot(multipliers)
+            self._X = grow_rows(self._X, self._size + len(X))
+            self._X[self._size:self._size + len(X)] = X
+            # sort rows by cell to append each cell's rows at once
+            keys = self._keys(X)
+            order = np.argsort(keys, kind='mergesort')
+            unique_keys, starts = np.unique(keys[order], return_index=True)
+            rows = order + self._size
+            for key, cell_rows in zip(unique_keys.tolist(),
+                                      np.split(rows, starts[1:])):
+                cell = self._cells.get(key)
+                if cell is None:
+                    self._cells[key] = cell_rows.tolist()
+                else:
+                    cell.extend(cell_rows.tolist())
+            self._size += len(X)
+
+    def _distances(self, queries, rows):
+        """Returns matrix of distances from each of queries to each of rows."""
+        return self._norm(np.abs(queries[:, np.newaxis, :] - rows[np.newaxis, :, :]))
+
+    def radius_neighbors(self, X, radius=None):
+        """Returns arrays (of dtype object) holding the distances and indices
+        of neighbors within radius of each row of X, as for
+        NearestNeighbors.radius_neighbors. radius may not exceed the radius
+        the index was built with.
+        """
+        X = check_array(X, dtype=np.float64)
+        radius = self.radius if radius is None else radius
+        if radius > self.radius:
+            raise ValueError("Query radius {0} is larger than the GridIndex " \
+                    "cell size {1}.".format(radius, self.radius))
+        with self._lock:
+            data, size, cells = self._X, self._size, self._cells
+        neigh_dist = np.empty(len(X), dtype=object)
+        neigh_ind = np.empty(len(X), dtype=object)
+        if size == 0:
+            for i in range(len(X)):
+                neigh_dist[i], neigh_ind[i] = np.empty(0), np.empty(0, dtype=np.intp)
+            return neigh_dist, neigh_ind
+        # queries in the same cell share the same candidate rows
+        keys = self._keys(X)
+        reachable = self._reachable_offsets(X, radius)
+        order = np.argsort(keys, kind='mergesort')
+        unique_keys, starts = np.unique(keys[order], return_index=True)
+        for key, queries in zip(unique_keys.tolist(), np.split(order, starts[1:])):
+            offset_keys = self._offset_keys[reachable[queries].any(axis=0)]
+            candidates = list(filter(None, map(cells.get,
+                    (key + offset_keys).tolist())))
+            if candidates:
+                candidates = np.fromiter(itertools.chain.from_iterable(candidates),
+                                         dtype=np.intp)
+                # rows added after this query started
+                candidates = candidates[candidates < size]
+            else:
+                candidates = np.empty(0, dtype=np.intp)
+            dist = self._distances(X[queries], data[candidates])
+            for query, query_dist in zip(queries, dist):
+                within = query_dist <= radius
+                neigh_dist[query] = query_dist[within]
+                neigh_ind[query] = candidates[within]
+        return neigh_dist, neigh_ind
+
+    def copy(self):
+        """Returns a copy that rows can be added to without changing this
+        index.
+        """
+        with self._lock:
+            index = copy.copy(self)
+            index._X = self._X[:self._size].copy()
+            index._cells = {key: list(cell) for key, cell in self._cells.items()}
+        index._lock = threading.Lock()
+        return index
+
+    def stats(self):
+        occupancy = [len(cell) for cell in list(self._cells.values())]
+        return {'rows': self._size,
+                'cells': len(occupancy),
+                'max_cell_rows': max(occupancy) if occupancy else 0}
+
 class RadiusNeighborsClassifier(NeighborsBase, RadiusNeighborsMixin,
-                                SupervisedIntegerMixin, ClassifierMixin):
+                                ClassifierMixin):
     """Classifier implementing a vote among neighbors within a given radius
 
     Extension of scikit-learn's RadiusNeighborsClassifier that
@@ -224,11 +579,15 @@ class RadiusNeighborsClassifier(NeighborsBase, RadiusNeighborsMixin,
     radius : float, optional (default = 1.0)
         Range of parameter space to use by default for :meth`radius_neighbors`
         queries.
-    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute'}, optional
+    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute', 'grid'}, optional
         Algorithm used to compute the nearest neighbors:
         - 'ball_tree' will use :class:`BallTree`
         - 'kd_tree' will use :class:`KDtree`
         - 'brute' will use a brute-force search.
+        - 'grid' will use :class:`GridIndex`, a grid of cells with sides of
+          length radius, which needs no rebuilding as targets are added.
+          Only faster than brute force for radius well below 1/2, as
+          features are scaled to about [0, 1].
         - 'auto' will attempt to decide the most appropriate algorithm
           based on the values passed to :meth:`fit` method.
         Note: fitting on sparse input will override the setting of
@@ -257,6 +616,9 @@ class RadiusNeighborsClassifier(NeighborsBase, RadiusNeighborsMixin,
         - target_space, TargetSpace instance that maps ind to other target info
     metric_params : dict, optional (default = None)
         Additional keyword arguments for the metric function.
+    rebuild_threshold : int, optional
+        Rows added by partial_fit searched by brute force before the
+        neighbor tree is rebuilt (see IncrementalNeighborIndex).
 
     Notes
     -----
@@ -267,15 +629,91 @@ class RadiusNeighborsClassifier(NeighborsBase, RadiusNeighborsMixin,
 
     def __init__(self, weights, target_space, radius=5.0,
                  algorithm='auto', leaf_size=30, p=2, metric='minkowski',
-                 outliers=None, metric_params=None, **kwargs):
-        self._init_params(radius=radius,
-                          algorithm=algorithm,
-                          leaf_size=leaf_size,
-                          metric=metric, p=p, metric_params=metric_params,
-                          **kwargs)
-        self.outlier_function = outliers
-        self.weight_function = weights
+                 outliers=None, metric_params=None,
+                 rebuild_threshold=config.classifier_rebuild_threshold):
+        # parameters are stored as given, for get_params() and clone(); they
+        # are checked by the neighbor index built in fit()
+        self.weights = weights
         self.target_space = target_space
+        self.radius = radius
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.p = p
+        self.metric = metric
+        self.outliers = outliers
+        self.metric_params = metric_params
+        self.rebuild_threshold = rebuild_threshold
+        self.n_samples_fit_ = 0
+
+    def fit(self, X, y):
+        """Fit the model using X as training data and y as target values,
+        replacing any previous training data.
+        """
+        y = np.asarray(y).ravel()
+        self.classes_, y = np.unique(y, return_inverse=True)
+        self._labels = self._y = y
+        self.outputs_2d_ = False
+        if self.algorithm == 'grid':
+            self._index = GridIndex(radius=self.radius, metric=self.metric,
+                                    p=self.p).fit(X)
+        else:
+            self._index = IncrementalNeighborIndex(
+                    radius=self.radius, algorithm=self.algorithm,
+                    leaf_size=self.leaf_size, metric=self.metric, p=self.p,
+                    metric_params=self.metric_params,
+                    rebuild_threshold=self.rebuild_threshold).fit(X)
+        self.n_samples_fit_ = len(y)
+        return self
+
+    def partial_fit(self, X, y):
+        """Adds training data X with target values y without refitting.
+        The rows are searched by brute force until the neighbor tree is next
+        rebuilt (see IncrementalNeighborIndex), or added straight to the grid
+        cells if algorithm is 'grid'.
+        """
+        y = np.asarray(y).ravel()
+        if not hasattr(self, '_index'):
+            return self.fit(X, y)
+        new_classes = [label for label in np.unique(y)
+                       if label not in self.classes_]
+        if new_classes:
+            self.classes_ = np.concatenate([self.classes_, new_classes])
+        codes = {label: i for i, label in enumerate(self.classes_)}
+        size = self.n_samples_fit_ + len(y)
+        self._labels = grow_rows(self._labels, size)
+        self._labels[self.n_samples_fit_:size] = [codes[label] for label in y]
+        self._index.add(X)
+        self._y = self._labels[:size]
+        self.n_samples_fit_ = size
+        return self
+
+    def copy(self):
+        """Returns a copy of the fitted classifier that update() and
+        partial_fit() can add rows to without changing this one, e.g. while
+        it is still used for predictions.
+        """
+        model = copy.copy(self)
+        if hasattr(self, '_index'):
+            model._index = self._index.copy()
+            model._labels = self._labels[:self.n_samples_fit_].copy()
+            model._y = model._labels
+        return model
+
+    def update(self):
+        """Adds rows appended to the target space's classifier tables since
+        the last fit or update. Returns the number of rows added.
+        """
+        features, classifications = self.target_space.classifier_snapshot(
+                start=self.n_samples_fit_)
+        if features:
+            self.partial_fit(features, classifications)
+        return len(features)
+
+    def radius_neighbors(self, X, radius=None):
+        """Finds the neighbors within radius of each row of X, in the tree
+        and the insert buffer. Returns arrays of distances and indices.
+        """
+        return self._index.radius_neighbors(X, radius)
 
     def predict(self, X):
         """Predict the class labels for the provided data
@@ -303,7 +741,7 @@ class RadiusNeighborsClassifier(NeighborsBase, RadiusNeighborsMixin,
             classes_ = [self.classes_]
         n_outputs = len(classes_)
 
-        if self.outlier_function is None and outliers:
+        if self.outliers is None and outliers:
             raise ValueError('No neighbors found for test samples %r, '
                              'you can try using larger radius, '
                              'give a function for outliers, '
@@ -313,7 +751,7 @@ class RadiusNeighborsClassifier(NeighborsBase, RadiusNeighborsMixin,
         if type(neigh_ind) is int:
             neigh_ind = [neigh_ind]
 
-        weights = self.weight_function(neigh_dist=neigh_dist, neigh_ind=neigh_ind,
+        weights = self.weights(neigh_dist=neigh_dist, neigh_ind=neigh_ind,
                                target_space=self.target_space)
 
         y_pred = np.empty((n_samples, n_outputs), dtype=classes_[0].dtype)
@@ -322,12 +760,12 @@ class RadiusNeighborsClassifier(NeighborsBase, RadiusNeighborsMixin,
                                    dtype=object)
             if weights is None:
                 mode = np.array([stats.mode(pl)[0]
-                                 for pl in pred_labels[inliers]], dtype=np.int)
+                                 for pl in pred_labels[inliers]], dtype=int)
             else:
                 mode = np.array([weighted_mode(pl, w)[0]
                                  for (pl, w)
-                                 in zip(pred_labels[inliers], weights)],
-                                dtype=np.int)
+                                 in zip(pred_labels[inliers], weights[inliers])],
+                                dtype=int)
 
             mode = mode.ravel()
 
@@ -335,9 +773,55 @@ class RadiusNeighborsClassifier(NeighborsBase, RadiusNeighborsMixin,
 
         if outliers:
             for outlier in outliers:
-                y_pred[outlier, 0] = self.outlier_function.predict(X[outlier])
+                y_pred[outlier, 0] = self.outliers.predict(X[outlier])
 
         if not self.outputs_2d_:
             y_pred = y_pred.ravel()
 
         return y_pred
+
+
+if __name__ == '__main__':
+    # Compares neighbor indices on uniformly distributed scaled features
+    import timeit
+    radius = 0.1
+    n_features = len(config.classifier_features)
+    n_queries = 100
+    n_inserts = 100
+    rng = np.random.RandomState(0)
+    queries = rng.rand(n_queries, n_features)
+    inserts = rng.rand(n_inserts, n_features)
+    print('{0} features, radius {1}, {2} queries, {3} inserts'.format(
+            n_features, radius, n_queries, n_inserts))
+    print('{0:>8s} {1:>10s} {2:>10s} {3:>14s} {4:>14s} {5:>10s}'.format(
+            'rows', 'algorithm', 'build s', 'insert us/row', 'query us/row',
+            'neighbors'))
+    for n in [1000, 10000, 100000, 1000000]:
+        X = rng.rand(n, n_features)
+        for algorithm in ['ball_tree', 'kd_tree', 'grid']:
+            if algorithm == 'grid':
+                def build():
+                    return GridIndex(radius=radius).fit(X)
+                index = build()
+                def insert():
+                    index.add(inserts)
+            else:
+                def build():
+                    return NearestNeighbors(radius=radius,
+                                            algorithm=algorithm).fit(X)
+                index = build()
+                # a tree must be rebuilt to include new rows
+                X_inserted = np.vstack([X, inserts])
+                def insert():
+                    NearestNeighbors(radius=radius,
+                                     algorithm=algorithm).fit(X_inserted)
+            build_seconds = min(timeit.repeat(build, number=1, repeat=3))
+            insert_seconds = min(timeit.repeat(insert, number=1, repeat=3))
+            query_seconds = min(timeit.repeat(
+                    lambda: index.radius_neighbors(queries, radius),
+                    number=1, repeat=3))
+            neighbors = np.mean([len(ind) for ind in
+                                 index.radius_neighbors(queries, radius)[1]])
+            print('{0:8d} {1:>10s} {2:10.3f} {3:14.1f} {4:14.1f} {5:10.1f}'.format(
+                    n, algorithm, build_seconds, 1e6 * insert_seconds / n_inserts,
+                    1e6 * query_seconds / n_queries, neighbors))
@@ -1,27 +1,43 @@
-from comms_NIMS_sim import read_tracks
-from comms_pamguard import PAMGuard_read
-from comms_adcp import ADCP_read
-import stage
-import targets
-import threading
+from comms_NIMS_sim import get_tracks
+from comms_pamguard import handle_PAMGuard
+from comms_adcp import ADCPBurst, end_ADCP_burst
+from comms_reactor import DatagramChannel, Reactor, StreamChannel
+from comms_stream import FramedStreamReader
+import config
+import nims_decoders
 
 class InstrumentComms:
     """
     Class to start all instrument communications and check their status.
 
+    All instrument sockets are served by one Reactor thread (see
+    comms_reactor), which decodes incoming data and adds it to stage.
+
     Inputs:
     stage_instance: instance of AMP data stage
     start_now: boolean value - start comms at initialization? If false, must call
-                InstrumentComms.start() to start comms threads.
+                InstrumentComms.start() to start comms.
+    instruments: instruments to read from, any of 'nims', 'pamguard' and 'adcp'
     """
-    def __init__(self, stage_instance, start_now):
+    def __init__(self, stage_instance, start_now, instruments=('nims',)):
         #TODO: Can make this check what streams are present, and start those
         # functions
-        comms_functions = [read_tracks] #, PAMGuard_read, ADCP_read]
-        self.threads = []
-        for fun in comms_functions:
-                self.threads.append(
-                    threading.Thread(target=fun, args=(stage_instance,)))
+        self.reactor = Reactor()
+        if 'nims' in instruments:
+            message_format = config.nims_message_format
+            decoder = nims_decoders.decoders[message_format]()
+            reader = FramedStreamReader('localhost', 5000,
+                    framing=nims_decoders.framings[message_format])
+            self.reactor.add(StreamChannel('nims', reader,
+                    lambda messages: get_tracks(stage_instance, messages, decoder)))
+        if 'pamguard' in instruments:
+            self.reactor.add(DatagramChannel('pamguard', ('', 8000),
+                    lambda data: handle_PAMGuard(stage_instance, data)))
+        if 'adcp' in instruments:
+            burst = ADCPBurst()
+            self.reactor.add(DatagramChannel('adcp', ('', 61557), burst.add,
+                    idle_timeout=5,
+                    on_idle=lambda: end_ADCP_burst(stage_instance, burst)))
 
         if start_now:
             self.start()
@@ -30,15 +46,12 @@ class InstrumentComms:
         """
         Start all communications fuctions.
         """
-        for thread in self.threads:
-            thread.start()
+        self.reactor.start()
 
     def check_status(self):
         """
-        Returns list of booleans indicating which functions are running
+        Returns dictionary describing reactor health ('running', 'healthy',
+        loop count and time since the last loop) with statistics for each
+        instrument socket under 'channels'.
         """
-        status = []
-        for i, thread in enumerate(self.threads):
-            status.append(thread.is_alive())
-
-        return status
+        return self.reactor.status()
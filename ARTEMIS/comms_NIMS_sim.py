@@ -1,54 +1,47 @@
 """
-Reads json data stream over socket from NIMS simulator.
+Reads track data stream over socket from NIMS simulator.
 
-Format is in ../NIMS-track-simulator/ex.json
+JSON format is in ../NIMS-track-simulator/ex.json, with each message
+followed by a null byte as in the real NIMS stream. The simulator can also
+send the binary format described in nims_decoders, length-prefixed.
 """
 
-from struct import *
-from pprint import pprint as pp
-import socket
-import json
-import datetime
+import config
+import nims_decoders
+import timeutil
+from comms_stream import FramedStreamReader
 
 
-def unpacker(fmt, buff):
+def arrival_times(count, now=None):
     """
-    Unpack buffer from nims simulator
+    Returns times for count messages received together, the last at now and
+    the others one ping earlier each, as they were sent.
     """
-    size = calcsize(fmt)
-    return unpack(fmt, buff[:size]), buff[size:]
+    if now is None:
+        now = timeutil.now()
+    return [now - (count - 1 - i) / config.nims_ping_rate for i in range(count)]
 
-
-def get_tracks(stage_instance, buffer):
+def get_tracks(stage_instance, messages, decoder):
     """
-    Get track information from json buffer, and send to stage.
+    Decode track information from messages, and send to stage as one batch.
+    Decoders use the time sent in each message where there is one, and
+    otherwise its arrival time (see arrival_times).
     """
+    # TODO - ask NIMS to send timestamp with ping number
+    columns = decoder.decode(messages, arrival_times(len(messages)))
+    stage_instance.addColumnsToStage('nims', columns)
 
-    while len(buffer):
-        msg, buffer = unpacker("=%ds" % len(buffer), buffer)
-        nims_data = json.loads(msg[0].decode("utf-8"))
-
-        #print('ping no: ', nims_data['ping_num'])
-        #print(nims_data['num_tracks'], ' tracks detected')
-
-        # TODO - ask NIMS to send timestamp with ping number
-        timestamp = datetime.datetime.utcnow()
-        stage_instance.addDataToStage('nims',
-                                      [timestamp, nims_data['tracks']])
-
-def read_tracks(stage_instance):
+def read_tracks(stage_instance, host='localhost', port=5000,
+                message_format=config.nims_message_format, decoder=None):
     """
     Function to read data from NIMS simulator, and send to stage.
+    message_format ('json' or 'binary') selects the stream framing and, unless
+    decoder is given, the decoder (see nims_decoders).
     """
-
-    s = socket.socket()         # Create a socket object
-    host = 'localhost'  # Get local machine name
-    port = 5000                # Reserve a port for your service.
-
-    s.connect((host, port))
-
-    while True:
-        buf = s.recv(4096)
-        get_tracks(stage_instance, buf)
-
-    s.close
+    if decoder is None:
+        decoder = nims_decoders.decoders[message_format]()
+    reader = FramedStreamReader(host, port,
+                                framing=nims_decoders.framings[message_format])
+    reader.connect()
+    for messages in reader.batches():
+        get_tracks(stage_instance, messages, decoder)
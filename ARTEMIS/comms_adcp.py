@@ -1,68 +1,98 @@
 # to do:
 # - read in tidal predictions (if file exists) to validate data
+import select
 import socket
 import numpy as np
 
+from comms_udp import MAX_DATAGRAM_SIZE, DatagramReceiver
 
-def ADCP_read(stage_instance, udp_IP = "", udp_port = 61557, buff_size = 1024, timeout = 5):
+
+def ADCP_read(stage_instance, udp_IP = "", udp_port = 61557, buff_size = MAX_DATAGRAM_SIZE, timeout = 5):
     """
     Reads ADCP data continously from the specified port.
     **EDITING NOTE - break added after timeout**
 
+    Pings are decoded as they arrive into an ADCPBurst, and the burst is
+    summarized and sent to stage once no ping has arrived for timeout
+    seconds.
+
     Inputs:
     udp_ip: "" for local host, otherwise "XXX.XXX.XXX.XXX"
     udp_port: port for UDP communication (61557 = ADCP Default)
-    buff_size: Each read iteration will read buff_size bytes of data, or until
-    the end of a packet is reached.
+    buff_size: largest datagram accepted. Longer datagrams are counted as
+    truncated (see comms_udp).
     """
+    receiver = DatagramReceiver((udp_IP, udp_port), buff_size)
+    sock = receiver.open()
 
-    # create socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((udp_IP, udp_port))
-    sock.settimeout(timeout)
-
-    # read one data packet
-    currents = []
-    headers = []
+    burst = ADCPBurst()
     while True:
-        # read data. Continue reading if timeout error, attempt to reconnect if
-        # there is a different socket error.
-
+        # wait for data, draining all queued pings at once. End burst on
+        # timeout, attempt to rebind if there is a socket error.
         try:
-            data, addr = sock.recvfrom(buff_size)
-        except socket.timeout:
-            if len(currents):
-                process_ADCP(currents, header)
-                currents = []
-
-            else:
-                pass
-
+            ready, _, _ = select.select([sock], [], [], timeout)
+            if not ready:
+                end_ADCP_burst(stage_instance, burst)
+                continue
+            datagrams = receiver.drain()
         except socket.error:
-            sock.close()
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.bind((udp_IP, udp_port))
-            sock.settimeout(timeout)
+            sock = receiver.open()
+            continue
 
-        # decode data, if present
-        try:
-            data
-        except NameError:
-            pass
-        else:
-            current, header = decode_ADCP(data)
-            currents.append(current)
-            headers.append(header)
-            del data
+        for data in datagrams:
+            burst.add(data)
 
-    sock.close()
 
-
-def decode_ADCP(data):
+def _split_ADCP(data):
+    """
+    Splits raw ADCP packet (bytes) into header [timestamp, nCells, nBeams,
+    pressure] and the current payload (bytes), without parsing the payload.
+    Returns None, None if the packet is not valid.
+    """
+    if not (data.startswith(b'AAAA') and data.endswith(b'ZZZZ')):
+        return None, None
+    tokens = data.split(b' ', 6)
+    if len(tokens) < 7:
+        return None, None
+    try:
+        timestamp = float(tokens[1]) + float(tokens[2])/1000
+        nCells = int(tokens[3])
+        nBeams = int(tokens[4])
+        pressure = int(tokens[5])
+    except ValueError:
+        return None, None
+    if nCells <= 0 or nBeams <= 0:
+        return None, None
+    # drop the last two tokens (as data[6:-2] did)
+    payload = tokens[6].rsplit(b' ', 2)
+    if len(payload) < 3:
+        return None, None
+    return [timestamp, nCells, nBeams, pressure], payload[0]
+
+
+def _parse_currents(payload, out):
+    """
+    Parses payload into out (nBeams x nCells array) in m/s, in one pass.
+    Returns False, leaving out unchanged, if a value is not a number or the
+    number of values is wrong.
+    """
+    try:
+        values = np.array(payload.split(), dtype=np.float64)
+    except ValueError:
+        return False
+    if values.size != out.size:
+        return False
+    np.divide(values.reshape(out.shape), 1000, out=out)
+    np.round(out, 3, out=out)
+    return True
+
+
+def decode_ADCP(data, out=None):
     """
     Decodes ADCP data read in over UDP. Returns two lists: header and current.
 
-    input: Raw data string from ADCP UDP stream
+    input: Raw data string (bytes) from ADCP UDP stream
+    out: optional preallocated nBeams x nCells array to decode current into
 
     Output:
     header: [timestamp, nCells, nBeams, pressure]
@@ -72,49 +102,114 @@ def decode_ADCP(data):
 
     current: nBeams x nCells current values in m/s
     """
-    data = data.decode("utf-8")
+    header, payload = _split_ADCP(data)
+    if header is None:
+        return [], []
+    if out is None:
+        out = np.empty((header[2], header[1]))
+    if not _parse_currents(payload, out):
+        return [], []
+    return out, header
+
+
+class ADCPBurst:
+    """
+    Running summary of the pings in one ADCP burst.
+
+    Each ping is parsed into a preallocated nBeams x nCells buffer and added
+    to running sums per bin, so a burst of any length is summarized in
+    O(nBeams x nCells) memory. Buffers are reused from burst to burst, and
+    only reallocated if the profile size changes.
+
+    Parameters
+    ----------
+    max_pings : int, optional
+        If greater than 0, the first max_pings pings of the burst are also kept
+        in pings, a preallocated (max_pings, nBeams, nCells) buffer.
+    """
+    def __init__(self, max_pings=0):
+        self.max_pings = max_pings
+        self.shape = None
+        self.pings = None
+        self.sums = None
+        self._ping = None
+        self.count = 0
+        self.header = None
+
+    def _allocate(self, nBeams, nCells):
+        self.shape = (nBeams, nCells)
+        self.pings = np.zeros((self.max_pings, nBeams, nCells))
+        self.sums = np.zeros((nBeams, nCells))
+        self._ping = np.zeros((nBeams, nCells))
+        self.count = 0
+
+    def reset(self):
+        """Starts a new burst."""
+        if self.sums is not None:
+            self.sums.fill(0)
+        self.count = 0
+        self.header = None
+
+    def add(self, data):
+        """
+        Decodes a raw ping into the burst. Returns False if the packet was not
+        valid.
+        """
+        header, payload = _split_ADCP(data)
+        if header is None:
+            return False
+        shape = (header[2], header[1])
+        if shape != self.shape:
+            # profile size changed, previous pings cannot be combined
+            self._allocate(*shape)
+        if self.count < self.max_pings:
+            out = self.pings[self.count]
+        else:
+            out = self._ping
+        if not _parse_currents(payload, out):
+            return False
+        self.sums += out
+        self.count += 1
+        self.header = header
+        return True
 
-    if data.endswith('ZZZZ') and data.startswith('AAAA'):
-        data = data.split(' ')
-        timestamp = float(data[1]) + float(data[2])/1000
-        nCells = int(data[3])
-        nBeams = int(data[4])
-        pressure = int(data[5])
-        current = np.array(list(map(float, list(data[6:-2]))))/1000
-        current = np.resize(current, (nBeams, nCells)).round(3)
+    def mean(self):
+        """Mean current per bin over the burst (nBeams x nCells), in m/s."""
+        return self.sums / self.count
 
-        header = [timestamp, nCells, nBeams, pressure]
-    else:
-        header = []
-        current = []
 
-    return current, header
+def end_ADCP_burst(stage_instance, burst):
+    """
+    Sends summary of burst to stage, if it holds any pings, and starts a new
+    burst.
+    """
+    if burst.count:
+        process_ADCP(stage_instance, burst)
+        burst.reset()
 
 
-def process_ADCP(stage_instance, currents, header):
+def process_ADCP(stage_instance, burst):
     """
     Calculates velocity magnitude and direction after a burst has finished.
 
     Inputs:
-    Currents = raw data from ADCP [nPings x nBeams x nCells]
-    Header = header data from ADCP
+    burst = ADCPBurst holding the running sums of the burst's pings
 
     Outputs:
     Heading = velocity direction (in radians from north)
     Speed = magintude of horizontal velocity (East and North)
     Timestamp = end of burst in unix time format
     """
-    timestamp = header[0]
+    timestamp = burst.header[0]
 
-    currents = np.array(currents)
-    bin_avg = np.mean(currents, axis=0)
+    bin_avg = burst.mean()
     bins = bin_avg[:, 1:4]
     avg = np.mean(bins, axis=1).round(3)
 
-    heading = np.arctan(avg[1]/avg[0]).round(3)
-    speed = (avg[1]**2 + avg[0]**2)**0.5
+    heading = np.arctan2(avg[1], avg[0]).round(3)
+    speed = np.hypot(avg[0], avg[1])
 
-    pressure = header[3]/0.0001   # dBar to Pa
+    pressure = burst.header[3]/0.0001   # dBar to Pa
     # depth = pressure/(g*rho)   # fix this correction!
 
     adcp_data = [timestamp, speed, heading]
@@ -1,47 +1,47 @@
+import select
 import socket
-import datetime
+import timeutil
+from comms_udp import MAX_DATAGRAM_SIZE, DatagramReceiver
 
-def PAMGuard_read(stage_instance, udp_IP = "",udp_port = 8000,buff_size = 1024,timeout = 0.1):
+def PAMGuard_read(stage_instance, udp_IP = "",udp_port = 8000,buff_size = MAX_DATAGRAM_SIZE,timeout = 1):
     """
-    Reads ADCP data continously from the specified port.
+    Reads PAMGuard data continously from the specified port.
 
     Inputs:
     udp_ip: "" for local host, otherwise "XXX.XXX.XXX.XXX"
     udp_port: port for UDP communication (8000 = PAM Default)
-    buff_size: Each read iteration will read buff_size bytes of data, or until
-    the end of a packet is reached.
-    timeout: socket timeout (0.1 default)
+    buff_size: largest datagram accepted. Longer datagrams are counted as
+    truncated (see comms_udp).
+    timeout: longest wait for data before checking again (1 s default)
     """
-    # create socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((udp_IP,udp_port))
-    sock.settimeout(timeout)
+    receiver = DatagramReceiver((udp_IP, udp_port), buff_size)
+    sock = receiver.open()
 
     while True:
         try:
-            data, addr = sock.recvfrom(buff_size)
-        except socket.timeout:
-            pass
+            ready, _, _ = select.select([sock], [], [], timeout)
+            datagrams = receiver.drain() if ready else []
         except socket.error:
-            sock.close()
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.bind((udp_IP, udp_port))
-            sock.settimeout(timeout)
+            sock = receiver.open()
+            continue
 
-        try:
-            data
-        except NameError:
-            pass
-        else:
-            data = data.decode("utf-8")
-            if data.endswith('ZZZZ') and data.startswith('AAAA'):
-                detection = data[4:-4]
-                timestamp = datetime.datetime.utcnow()
-
-                pamguard_data = [timestamp, detection]
-                stage_instance.addDataToStage('pamguard', pamguard_data)
-
-                print("PAMGuard Detection of type: ", detection)
-                del data
-            else:
-                del data
+        for data in datagrams:
+            handle_PAMGuard(stage_instance, data)
+
+
+def handle_PAMGuard(stage_instance, data):
+    """
+    Decodes one PAMGuard datagram (bytes) and, if it holds a detection, sends
+    it to stage. Returns the detection type, or None if the datagram was not
+    a detection.
+    """
+    data = data.decode("utf-8")
+    if data.endswith('ZZZZ') and data.startswith('AAAA'):
+        detection = data[4:-4]
+        timestamp = timeutil.now()
+
+        pamguard_data = [timestamp, detection]
+        stage_instance.addDataToStage('pamguard', pamguard_data)
+
+        print("PAMGuard Detection of type: ", detection)
+        return detection
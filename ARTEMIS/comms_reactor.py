@@ -0,0 +1,307 @@
+"""
+Single-threaded reactor serving every instrument socket.
+
+One thread waits on all sockets with a selector and wakes only when a socket
+is readable or a timer is due, instead of one blocking thread (and timeout
+loop) per instrument. Each socket is wrapped in a channel that decodes what
+it receives and hands records to a callback, usually one that adds them to
+Stage.
+"""
+import selectors
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from comms_udp import MAX_DATAGRAM_SIZE, DatagramReceiver
+
+
+class Channel:
+    """Base class for sockets served by a Reactor.
+
+    Subclasses implement start(), handle() and on_deadline(), and set
+    self.deadline to the time on_deadline() should next be called (or None).
+    """
+    kind = None
+
+    def __init__(self, name):
+        self.name = name
+        self.reactor = None
+        self.sock = None
+        self.state = 'stopped'
+        self.deadline = None
+        self.bytes_received = 0
+        self.messages_received = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_receive = None
+
+    def start(self, now):
+        raise NotImplementedError
+
+    def handle(self, mask, now):
+        raise NotImplementedError
+
+    def on_deadline(self, now):
+        raise NotImplementedError
+
+    def dispatch(self, callback, *args):
+        """Calls callback, logging and counting any error so that one bad
+        record does not stop the reactor.
+        """
+        try:
+            callback(*args)
+        except Exception as e:
+            self.error(e)
+
+    def error(self, e):
+        self.errors += 1
+        self.last_error = '{0}: {1}'.format(type(e).__name__, e)
+        sys.stderr.write('{0}: {1}\n'.format(self.name, self.last_error))
+
+    def stats(self, now):
+        return {'kind': self.kind,
+                'state': self.state,
+                'bytes': self.bytes_received,
+                'messages': self.messages_received,
+                'errors': self.errors,
+                'last_error': self.last_error,
+                'seconds_since_receive': None if self.last_receive is None
+                                         else now - self.last_receive}
+
+
+class StreamChannel(Channel):
+    """TCP stream read through a FramedStreamReader (see comms_stream).
+
+    on_messages is called with each list of whole messages received. The
+    connection is reopened after reader.reconnect_delay if it fails, closes,
+    or receives nothing for reader.timeout seconds.
+
+    Once connected, the channel stays registered for writing in the
+    'handshake' state until the reader has sent all of its handshake.
+    """
+    kind = 'stream'
+
+    def __init__(self, name, reader, on_messages):
+        Channel.__init__(self, name)
+        self.reader = reader
+        self.on_messages = on_messages
+
+    def start(self, now):
+        try:
+            self.sock = self.reader.open()
+        except socket.error as e:
+            self.fail(e, now)
+            return
+        self.reactor.selector.register(self.sock, selectors.EVENT_WRITE, self)
+        self.state = 'connecting'
+        self.last_activity = now
+        self.deadline = now + self.reader.timeout
+
+    def fail(self, e, now):
+        """Drops the connection and schedules a new attempt."""
+        self.error(e)
+        if self.sock is not None and self.state in ('connecting', 'handshake',
+                                                    'connected'):
+            self.reactor.selector.unregister(self.sock)
+        self.state = 'waiting'
+        self.deadline = now + self.reader.reconnect_delay
+
+    def handle(self, mask, now):
+        try:
+            if self.state == 'connecting':
+                self.reader.finish_connect()
+                self.state = 'handshake'
+            if self.state == 'handshake':
+                if not self.reader.send_pending():
+                    return  # rest is sent when the socket is writable again
+                self.reactor.selector.modify(self.sock, selectors.EVENT_READ, self)
+                self.state = 'connected'
+            else:
+                messages = self.reader.read_available()
+                self.last_receive = now
+                self.bytes_received = self.reader.bytes_received
+                if messages:
+                    self.messages_received += len(messages)
+                    self.dispatch(self.on_messages, messages)
+        except BlockingIOError:
+            return
+        except socket.error as e:
+            self.fail(e, now)
+            return
+        self.last_activity = now
+        self.deadline = now + self.reader.timeout
+
+    def on_deadline(self, now):
+        if self.state == 'waiting':
+            self.start(now)
+        else:
+            self.fail(socket.timeout('no data for {0} s'.format(self.reader.timeout)),
+                      now)
+
+    def stats(self, now):
+        stats = Channel.stats(self, now)
+        stats.update(self.reader.stats())
+        return stats
+
+
+class DatagramChannel(Channel):
+    """UDP socket bound to address, read through a DatagramReceiver (see
+    comms_udp) that drains every queued datagram per wake-up.
+
+    on_datagram is called with the bytes of each datagram received. If
+    on_idle is given, it is called once no datagram has arrived for
+    idle_timeout seconds after the last one (e.g. at the end of an ADCP
+    burst). The socket is rebound if it fails.
+    """
+    kind = 'datagram'
+
+    def __init__(self, name, address, on_datagram, buff_size=MAX_DATAGRAM_SIZE,
+                 idle_timeout=None, on_idle=None, rebind_delay=1.):
+        Channel.__init__(self, name)
+        self.receiver = DatagramReceiver(address, buff_size)
+        self.on_datagram = on_datagram
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+        self.rebind_delay = rebind_delay
+        self.rebinds = 0
+
+    def start(self, now):
+        try:
+            self.sock = self.receiver.open()
+        except socket.error as e:
+            self.fail(e, now)
+            return
+        self.reactor.selector.register(self.sock, selectors.EVENT_READ, self)
+        self.state = 'bound'
+        self.deadline = None
+
+    def fail(self, e, now):
+        """Closes the socket and schedules rebinding."""
+        self.error(e)
+        if self.state == 'bound':
+            self.reactor.selector.unregister(self.sock)
+        self.receiver.close()
+        self.sock = None
+        self.state = 'waiting'
+        self.deadline = now + self.rebind_delay
+
+    def handle(self, mask, now):
+        try:
+            datagrams = self.receiver.drain()
+        except socket.error as e:
+            self.fail(e, now)
+            return
+        if not datagrams:
+            return
+        self.last_receive = now
+        self.bytes_received = self.receiver.bytes_received
+        self.messages_received = self.receiver.datagrams
+        for data in datagrams:
+            self.dispatch(self.on_datagram, data)
+        if self.on_idle is not None:
+            self.deadline = now + self.idle_timeout
+
+    def on_deadline(self, now):
+        if self.state == 'waiting':
+            self.rebinds += 1
+            self.start(now)
+        else:
+            self.deadline = None
+            self.dispatch(self.on_idle)
+
+    def stats(self, now):
+        stats = Channel.stats(self, now)
+        stats.update(self.receiver.stats())
+        stats['rebinds'] = self.rebinds
+        return stats
+
+
+class Reactor:
+    """Runs every channel from one thread.
+
+    Parameters
+    ----------
+    heartbeat : float, optional
+        Longest time the loop sleeps without waking, so that status() can
+        tell a stalled reactor from an idle one.
+    """
+    def __init__(self, heartbeat=5.):
+        self.selector = selectors.DefaultSelector()
+        self.channels = {}
+        self.heartbeat = heartbeat
+        self.thread = None
+        self.running = False
+        self.loops = 0
+        self.last_loop = None
+        self.started = None
+        # written to by stop() to wake the loop
+        self._wake_receive, self._wake_send = socket.socketpair()
+        self._wake_receive.setblocking(False)
+        self.selector.register(self._wake_receive, selectors.EVENT_READ, None)
+
+    def add(self, channel):
+        """Adds channel (see StreamChannel, DatagramChannel). Channels must be
+        added before start().
+        """
+        if channel.name in self.channels:
+            raise ValueError("Channel {0} already exists.".format(channel.name))
+        channel.reactor = self
+        self.channels[channel.name] = channel
+        return channel
+
+    def start(self):
+        """Starts the reactor thread."""
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wake_send.send(b'\0')
+
+    def run(self):
+        """Serves channels until stop() is called."""
+        now = time.time()
+        self.started = now
+        for channel in self.channels.values():
+            channel.start(now)
+        while self.running:
+            timeout = self.heartbeat
+            deadlines = [channel.deadline for channel in self.channels.values()
+                         if channel.deadline is not None]
+            if deadlines:
+                timeout = min(max(min(deadlines) - time.time(), 0), timeout)
+            try:
+                events = self.selector.select(timeout)
+                now = time.time()
+                self.loops += 1
+                self.last_loop = now
+                for key, mask in events:
+                    if key.data is None:
+                        self._wake_receive.recv(64)
+                    else:
+                        key.data.handle(mask, now)
+                for channel in list(self.channels.values()):
+                    if channel.deadline is not None and channel.deadline <= now:
+                        channel.on_deadline(now)
+            except Exception:
+                # keep serving the other channels
+                traceback.print_exc()
+
+    def status(self):
+        """Returns dictionary describing reactor health and statistics for
+        each channel.
+        """
+        now = time.time()
+        return {'running': self.thread is not None and self.thread.is_alive(),
+                'loops': self.loops,
+                'seconds_since_loop': None if self.last_loop is None
+                                      else now - self.last_loop,
+                'healthy': (self.thread is not None and self.thread.is_alive() and
+                            self.last_loop is not None and
+                            now - self.last_loop < 2 * self.heartbeat),
+                'channels': {name: channel.stats(now)
+                             for name, channel in self.channels.items()}}
@@ -0,0 +1,243 @@
+"""
+Reads framed messages from a TCP stream.
+
+TCP does not preserve message boundaries: one recv may hold part of a
+message, or several messages run together. FramedStreamReader buffers the
+stream and splits it into whole messages using one of two framings:
+
+- 'null': each message is followed by a null byte (NIMS and the simulator)
+- 'length': each message is preceded by its length, packed with
+  length_format (4-byte big-endian unsigned by default)
+"""
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+import time
+
+
+class FramedStreamReader:
+    """Buffered reader that returns whole messages from a TCP stream.
+
+    Data is received straight into a preallocated chunk and appended to one
+    growable bytearray. Consumed messages are dropped from the front of the
+    buffer only once they make up most of it, and the null delimiter search
+    resumes where the previous one stopped, so large messages split over many
+    recvs cost linear time.
+
+    Parameters
+    ----------
+    host, port : str, int
+        Address of the server.
+    framing : {'null', 'length'}, optional
+        How messages are delimited in the stream.
+    handshake : bytes, optional
+        Sent to the server after every (re)connect.
+    timeout : float, optional
+        Seconds without data before reconnecting.
+    recv_size : int, optional
+        Maximum number of bytes read per recv.
+    length_format : str, optional
+        struct format of the length prefix for 'length' framing.
+    reconnect_delay : float, optional
+        Seconds to wait before retrying a failed connection.
+    """
+    def __init__(self, host, port, framing='null', handshake=None, timeout=60.,
+                 recv_size=65536, length_format='>I', reconnect_delay=1.):
+        if framing not in ('null', 'length'):
+            raise ValueError("Unknown framing {0}. Valid inputs are 'null' or" \
+                             " 'length'.".format(framing))
+        self.host = host
+        self.port = port
+        self.framing = framing
+        self.handshake = handshake
+        self.timeout = timeout
+        self.length_prefix = struct.Struct(length_format)
+        self.reconnect_delay = reconnect_delay
+        self.sock = None
+
+        self._chunk = bytearray(recv_size)
+        self._chunk_view = memoryview(self._chunk)
+        self._buffer = bytearray()
+        self._start = 0  # start of the first unread message in _buffer
+        self._scan = 0  # position the delimiter search resumes from
+        self._pending = b''  # part of the handshake not yet sent
+
+        self.bytes_received = 0
+        self.messages_received = 0
+        self.reconnects = 0
+        self.bytes_discarded = 0
+        self._started = time.time()
+        self._last_stats = (self._started, 0, 0)
+
+    def connect(self):
+        """Connects (or reconnects) to the server, retrying until it
+        succeeds. Any partial message left in the buffer is discarded.
+        """
+        if self.sock is not None:
+            self.close()
+            self.reconnects += 1
+        self.reset()
+        while True:
+            try:
+                self.sock = socket.create_connection((self.host, self.port))
+                if self.handshake is not None:
+                    self.sock.sendall(self.handshake)
+                return self.sock
+            except socket.error as e:
+                sys.stderr.write("unable to connect to {0}:{1} ({2}); " \
+                        "retrying\n".format(self.host, self.port, e))
+                time.sleep(self.reconnect_delay)
+
+    def open(self):
+        """Starts a non-blocking connection (or reconnection), for use with a
+        selector (see comms_reactor). The socket becomes writable once the
+        attempt completes; then call finish_connect() and send_pending().
+        Any partial message left in the buffer is discarded.
+        """
+        if self.sock is not None:
+            self.close()
+            self.reconnects += 1
+        self.reset()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        error = self.sock.connect_ex((self.host, self.port))
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(error, os.strerror(error))
+        return self.sock
+
+    def finish_connect(self):
+        """Completes a connection started by open() and queues the handshake
+        to be sent by send_pending(). Raises socket.error if the connection
+        failed.
+        """
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise socket.error(error, os.strerror(error))
+        if self.handshake is not None:
+            self._pending = memoryview(self.handshake)
+
+    def send_pending(self):
+        """Sends as much of the queued handshake as the non-blocking socket
+        accepts. Returns True once all of it has been sent.
+        """
+        while self._pending:
+            try:
+                sent = self.sock.send(self._pending)
+            except BlockingIOError:
+                return False
+            self._pending = self._pending[sent:]
+        return True
+
+    def read_available(self):
+        """Reads once from the socket, once it is readable, and returns list
+        of whole messages received (possibly empty). Raises socket.error if
+        the connection was closed.
+        """
+        size = self.sock.recv_into(self._chunk)
+        if size == 0:
+            raise socket.error(errno.ECONNRESET, "connection closed")
+        return self.feed(self._chunk_view[:size])
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def reset(self):
+        """Discards buffered data."""
+        self.bytes_discarded += len(self._buffer) - self._start
+        del self._buffer[:]
+        self._start = 0
+        self._scan = 0
+        self._pending = b''
+
+    def feed(self, data):
+        """Appends data received from the stream to the buffer and returns
+        list of whole messages (bytes) now available.
+        """
+        self._buffer += data
+        self.bytes_received += len(data)
+        messages = self._split()
+        self.messages_received += len(messages)
+        # drop consumed bytes once they are most of the buffer
+        if self._start and 2 * self._start >= len(self._buffer):
+            del self._buffer[:self._start]
+            self._scan -= self._start
+            self._start = 0
+        return messages
+
+    def _split(self):
+        buffer = self._buffer
+        messages = []
+        if self.framing == 'null':
+            while True:
+                end = buffer.find(b'\0', max(self._scan, self._start))
+                if end < 0:
+                    self._scan = len(buffer)
+                    break
+                if end > self._start:  # skip empty messages
+                    messages.append(bytes(buffer[self._start:end]))
+                self._start = end + 1
+        else:
+            prefix_size = self.length_prefix.size
+            while len(buffer) - self._start >= prefix_size:
+                length, = self.length_prefix.unpack_from(buffer, self._start)
+                end = self._start + prefix_size + length
+                if end > len(buffer):
+                    break
+                messages.append(bytes(buffer[self._start + prefix_size:end]))
+                self._start = end
+        return messages
+
+    def receive(self):
+        """Waits up to timeout for data and returns list of whole messages
+        received (possibly empty). Reconnects if the connection times out,
+        closes or fails.
+        """
+        if self.sock is None:
+            self.connect()
+        try:
+            ready, _, _ = select.select([self.sock], [], [], self.timeout)
+            if not ready:
+                sys.stderr.write("receive timed out; trying to reconnect\n")
+                self.connect()
+                return []
+            return self.read_available()
+        except (select.error, socket.error) as e:
+            sys.stderr.write("socket error ({0}); trying to reconnect\n".format(e))
+            self.connect()
+            return []
+
+    def batches(self):
+        """Yields lists of whole messages as they arrive, forever. Messages
+        that arrived together are yielded together.
+        """
+        while True:
+            messages = self.receive()
+            if messages:
+                yield messages
+
+    def stats(self):
+        """Returns dictionary of totals, and of bytes and messages per second
+        since stats() was last called.
+        """
+        now = time.time()
+        last_time, last_bytes, last_messages = self._last_stats
+        elapsed = max(now - last_time, 1e-9)
+        stats = {'bytes': self.bytes_received,
+                 'messages': self.messages_received,
+                 'reconnects': self.reconnects,
+                 'bytes_discarded': self.bytes_discarded,
+                 'buffered': len(self._buffer) - self._start,
+                 'bytes_per_second': (self.bytes_received - last_bytes) / elapsed,
+                 'messages_per_second':
+                     (self.messages_received - last_messages) / elapsed,
+                 'uptime': now - self._started}
+        self._last_stats = (now, self.bytes_received, self.messages_received)
+        return stats
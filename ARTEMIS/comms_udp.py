@@ -0,0 +1,142 @@
+"""
+Bulk receive of instrument UDP datagrams.
+
+A DatagramReceiver owns one non-blocking UDP socket with a large kernel
+receive buffer. Each wake-up drains every queued datagram into one
+preallocated buffer, and datagrams that were truncated or dropped by the
+kernel are counted rather than lost silently.
+"""
+import errno
+import socket
+import struct
+import sys
+
+import config
+
+# Linux reports the kernel's count of dropped datagrams alongside each
+# datagram once this option is set
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL',
+                      40 if sys.platform.startswith('linux') else None)
+# largest possible UDP payload
+MAX_DATAGRAM_SIZE = 65535
+
+
+def _is_truncation(e):
+    """Whether socket error e means the datagram was larger than the buffer
+    (Windows raises instead of truncating).
+    """
+    return e.errno == errno.EMSGSIZE or getattr(e, 'winerror', None) == 10040
+
+
+class DatagramReceiver:
+    """Non-blocking UDP socket drained into a preallocated buffer.
+
+    Parameters
+    ----------
+    address : tuple
+        (host, port) to bind, "" for all interfaces.
+    buff_size : int, optional
+        Size of the receive buffer. Longer datagrams are counted as truncated
+        and skipped.
+    rcvbuf : int, optional
+        Requested kernel receive buffer (SO_RCVBUF) in bytes. The size
+        granted by the kernel is reported by stats().
+    """
+    def __init__(self, address, buff_size=MAX_DATAGRAM_SIZE,
+                 rcvbuf=config.udp_receive_buffer_size):
+        self.address = address
+        self.rcvbuf = rcvbuf
+        self._buffer = bytearray(buff_size)
+        self._view = memoryview(self._buffer)
+        self._ancillary_size = socket.CMSG_SPACE(4) if hasattr(socket, 'CMSG_SPACE') else 0
+        self.sock = None
+        self.rcvbuf_granted = None
+        self.datagrams = 0
+        self.bytes_received = 0
+        self.truncated = 0
+        self.dropped = 0
+        self.drains = 0
+        self.largest_drain = 0
+
+    def open(self):
+        """Creates and binds the socket, closing any previous one."""
+        self.close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        except socket.error as e:
+            sys.stderr.write("unable to set SO_RCVBUF to {0} ({1})\n".format(
+                    self.rcvbuf, e))
+        self.rcvbuf_granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if SO_RXQ_OVFL is not None:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            except socket.error:
+                pass
+        sock.setblocking(False)
+        sock.bind(self.address)
+        self.sock = sock
+        return sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _receive(self):
+        """Receives one datagram into the buffer. Returns its size, or None if
+        it was truncated. Raises BlockingIOError if none are queued.
+        """
+        if hasattr(self.sock, 'recvmsg_into'):
+            size, ancillary, flags, _ = self.sock.recvmsg_into(
+                    [self._buffer], self._ancillary_size, socket.MSG_TRUNC)
+            for level, kind, data in ancillary:
+                if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+                    # cumulative count of drops since the socket was opened
+                    self.dropped = struct.unpack('I', data[:4])[0]
+            truncated = flags & socket.MSG_TRUNC or size > len(self._buffer)
+        else:
+            try:
+                size, _ = self.sock.recvfrom_into(self._buffer)
+            except socket.error as e:
+                if not _is_truncation(e):
+                    raise
+                size, truncated = len(self._buffer), True
+            else:
+                truncated = False
+        if truncated:
+            self.truncated += 1
+            return None
+        return size
+
+    def drain(self, max_datagrams=None):
+        """Returns list of every datagram (bytes) queued on the socket, up to
+        max_datagrams, without blocking.
+        """
+        datagrams = []
+        while max_datagrams is None or len(datagrams) < max_datagrams:
+            try:
+                size = self._receive()
+            except BlockingIOError:
+                break
+            except socket.error as e:
+                if _is_truncation(e):
+                    self.truncated += 1
+                    continue
+                raise
+            if size is not None:
+                datagrams.append(bytes(self._view[:size]))
+                self.bytes_received += size
+        self.datagrams += len(datagrams)
+        self.drains += 1
+        self.largest_drain = max(self.largest_drain, len(datagrams))
+        return datagrams
+
+    def stats(self):
+        return {'datagrams': self.datagrams,
+                'bytes': self.bytes_received,
+                'truncated': self.truncated,
+                'dropped': self.dropped,
+                'drains': self.drains,
+                'largest_drain': self.largest_drain,
+                'rcvbuf': self.rcvbuf_granted}
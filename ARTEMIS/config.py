@@ -39,6 +39,19 @@ data_streams = ['adcp', 'camera', 'pamguard', 'nims']
 data_streams_classifier_triggers = {'nims_max_pings': 10,
 									'nims_max_time': 1,
 									'pamguard_max_time': 3} # all in seconds
+# PAMGuard detections are paired with every NIMS track seen within this many
+# seconds of the detection. Should not exceed pamguard_max_time.
+pamguard_association_window = 2
+
+# Format of NIMS track messages, 'json' or 'binary' (see nims_decoders)
+nims_message_format = 'json'
+# NIMS ping rate (Hz). Messages without a timestamp that arrive together are
+# given arrival times one ping apart.
+nims_ping_rate = 10
+
+# Kernel receive buffer (SO_RCVBUF) requested for instrument UDP sockets, so
+# bursts of PAMGuard detections and ADCP pings are not dropped
+udp_receive_buffer_size = 4*1024*1024 # bytes
 
 # This supplies the order and contents for classification features
 classifier_features = ['size', 'speed', 'deltav', 'target_strength',
@@ -96,4 +109,39 @@ M3_avgeraging_time = 5 # number of seconds over which to calculate target veloci
 
 # classification refit parameters
 refit_classifier_count = 10
+# seconds after which the classifier is refit from the classifier tables in
+# the background (newly classified targets are added between refits, see
+# classifier_rebuild_threshold)
+classifier_refit_interval = 60*60
+# once a target is queued for classification, wait up to this long (s) for
+# more targets and classify them together, up to classification_max_batch
+classification_latency_budget = 0.05
+classification_max_batch = 256
+# neighbor search used by the classifier: 'auto', 'ball_tree', 'kd_tree',
+# 'brute', or 'grid' (see classification.GridIndex). 'grid' only helps with a
+# classifier radius well below 1/2; with the default radius of 5.0 it searches
+# every row, as 'brute' does.
+classifier_algorithm = 'auto'
+# rows of newly classified targets searched by brute force before the
+# classifier's neighbor tree is rebuilt (in the background) to include them
+classifier_rebuild_threshold = 500
 drop_target_time = 60 # s
+
+# Extra seconds data stream rows are kept beyond drop_target_time, so rows of
+# a target are still there when it expires even if the stage thread is late
+# or the target was last seen by PAMGuard (see pamguard_association_window)
+data_stream_retention_margin = 10 # s
+# Expected rows per second for each data stream. Together with the retention
+# time (drop_target_time + pamguard_association_window +
+# data_stream_retention_margin unless set in data_stream_retention) this sizes
+# the ring buffer that holds each stream's raw data.
+data_stream_rates = {'adcp': 1/60.,
+					 'camera': 0,
+					 'pamguard': 10,
+					 'nims': 10*50} # 10 Hz pings, 50 tracks
+# ADCP readings remain valid for classification until adcp_last_seen_threshold
+data_stream_retention = {'adcp': 60*adcp_last_seen_threshold} # s
+
+# fraction of a data stream table's rows removed since it was last compacted
+# above which it is compacted when old targets are removed
+table_compaction_threshold = 0.5
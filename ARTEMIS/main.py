@@ -1,3 +1,4 @@
+import config
 import targets
 import classification as cl
 import stage
@@ -15,6 +16,7 @@ if __name__ == "__main__":
     background_classifier = cl.BackgroundClassifier()
     rad_neigh_classifier = cl.RadiusNeighborsClassifier(cl.classification_weights,
                                                         target_space,
+                                                        algorithm=config.classifier_algorithm,
                                                         outliers=background_classifier)
 
     # initialize socket to send triggers to LabView
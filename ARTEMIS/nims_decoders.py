@@ -0,0 +1,203 @@
+"""
+Decoders that turn NIMS messages into columns of the nims table.
+
+A decoder's decode(messages, timestamps) returns a dictionary mapping each of
+targets.headers['nims'] to an array with one value per track, across all
+messages, which is the format taken by Stage.addColumnsToStage and
+TargetSpace.append_entries. Only those columns are extracted; other track
+fields are never copied.
+
+Fields missing from a message (the real NIMS stream has no first_ping,
+min_angle_m or max_angle_m) are filled with NaN, or -1 for integer columns.
+
+The optional binary format (BinaryDecoder) is a fixed-layout header followed
+by one fixed-layout record per track, all little-endian:
+
+    header: ping_num (uint32), num_tracks (uint32), timestamp (float64)
+    track:  id, pings_visible, first_ping (int64), then the remaining
+            track_columns in order (float64)
+
+Binary messages may contain null bytes, so they are sent length-prefixed
+(see comms_stream). NIMS-track-simulator/trksrv.py --format binary sends it.
+
+Run this module to compare decoders on NIMS-track-simulator/nims.json.
+"""
+import json
+import os
+import timeit
+
+import numpy as np
+
+from storage import TimeWindowTable, column_dtypes
+from targets import headers
+
+# columns read from each track, rather than filled in by the decoder
+track_columns = [name for name in headers['nims']
+                 if name not in ('timestamp', 'aggregate_indices')]
+
+
+binary_header_dtype = np.dtype([('ping_num', '<u4'), ('num_tracks', '<u4'),
+                                ('timestamp', '<f8')])
+binary_track_dtype = np.dtype([(name, '<i8' if np.issubdtype(
+        np.dtype(column_dtypes.get(name, np.float64)), np.integer) else '<f8')
+        for name in track_columns])
+
+# framing of each message format in the stream (see comms_stream)
+framings = {'json': 'null', 'binary': 'length'}
+
+
+def missing_value(dtype):
+    """Returns value used for a field missing from a track."""
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        return -1
+    return np.nan
+
+
+def columns_from_tracks(pings, timestamps):
+    """Returns nims columns for lists of track dictionaries, one list (and
+    one timestamp) per ping.
+    """
+    counts = [len(tracks) for tracks in pings]
+    tracks = [track for ping in pings for track in ping]
+    columns = {'timestamp': np.repeat(np.asarray(timestamps, dtype=np.float64),
+                                      counts),
+               'aggregate_indices': np.full(len(tracks), None, dtype=object)}
+    for name in track_columns:
+        dtype = column_dtypes.get(name, np.float64)
+        missing = missing_value(dtype)
+        columns[name] = np.array([track.get(name, missing) for track in tracks],
+                                 dtype=dtype)
+    return columns
+
+
+class NIMSDecoder:
+    """Base class for NIMS message decoders.
+
+    Subclasses implement decode() for one message format.
+    """
+    def decode(self, messages, timestamps):
+        """Returns nims columns for messages, with one timestamp (epoch
+        seconds) per message.
+        """
+        raise NotImplementedError
+
+
+class JSONDecoder(NIMSDecoder):
+    """Decodes JSON messages (bytes or str) holding a 'tracks' list, as sent
+    by NIMS and the simulator. A message's 'timestamp' field (epoch seconds),
+    if it has one, is used instead of the timestamp passed to decode().
+    """
+    def decode(self, messages, timestamps):
+        messages = [json.loads(message) for message in messages]
+        return columns_from_tracks(
+                [message['tracks'] for message in messages],
+                [message.get('timestamp', timestamp)
+                 for message, timestamp in zip(messages, timestamps)])
+
+
+class TrackListDecoder(NIMSDecoder):
+    """Decodes messages that are already parsed into lists of track
+    dictionaries.
+    """
+    def decode(self, messages, timestamps):
+        return columns_from_tracks(messages, timestamps)
+
+
+class BinaryDecoder(NIMSDecoder):
+    """Decodes binary messages (see module docstring). Track records are read
+    in place with numpy.frombuffer; each column is a view into the message
+    until written to the table.
+
+    Parameters
+    ----------
+    use_message_time : bool, optional
+        Use the timestamp sent in each message header instead of the
+        timestamps passed to decode().
+    """
+    def __init__(self, use_message_time=True):
+        self.use_message_time = use_message_time
+
+    def decode(self, messages, timestamps):
+        records, counts, message_times = [], [], []
+        for message in messages:
+            header = np.frombuffer(message, dtype=binary_header_dtype, count=1)[0]
+            records.append(np.frombuffer(message, dtype=binary_track_dtype,
+                                         count=int(header['num_tracks']),
+                                         offset=binary_header_dtype.itemsize))
+            counts.append(int(header['num_tracks']))
+            message_times.append(header['timestamp'])
+        if len(records) == 1:
+            tracks = records[0]
+        else:
+            tracks = np.concatenate(records) if records else \
+                    np.zeros(0, dtype=binary_track_dtype)
+        if self.use_message_time:
+            timestamps = message_times
+        columns = {name: tracks[name] for name in track_columns}
+        columns['timestamp'] = np.repeat(np.asarray(timestamps, dtype=np.float64),
+                                         counts)
+        columns['aggregate_indices'] = np.full(len(tracks), None, dtype=object)
+        return columns
+
+
+def encode_binary(tracks, ping_num, timestamp):
+    """Packs track dictionaries into a binary message (without the length
+    prefix). Missing fields are filled as by the other decoders.
+    """
+    records = np.zeros(len(tracks), dtype=binary_track_dtype)
+    for name in track_columns:
+        missing = missing_value(binary_track_dtype[name])
+        records[name] = [track.get(name, missing) for track in tracks]
+    header = np.array([(ping_num, len(tracks), timestamp)],
+                      dtype=binary_header_dtype)
+    return header.tobytes() + records.tobytes()
+
+
+decoders = {'json': JSONDecoder, 'binary': BinaryDecoder}
+
+
+def _rows_from_json(message, timestamp):
+    """Previous decoding, one list per track, for comparison."""
+    rows = []
+    for track in json.loads(message)['tracks']:
+        rows.append([timestamp] + [track.get(name, missing_value(
+                column_dtypes.get(name, np.float64))) for name in track_columns]
+                + [None])
+    return rows
+
+
+if __name__ == '__main__':
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'NIMS-track-simulator', 'nims.json')
+    with open(path, 'rb') as f:
+        message = json.dumps(json.load(f)).encode('utf-8')
+    tracks = json.loads(message)['tracks']
+    batch = 10  # one second of pings at 10 Hz
+    messages = [message] * batch
+    binary_messages = [encode_binary(tracks, i, t)
+                       for i, t in enumerate([1.46e9 + 0.1 * i for i in range(batch)])]
+    timestamps = [1.46e9 + 0.1 * i for i in range(batch)]
+    print('{0} tracks per ping, {1} bytes per JSON message, {2} bytes per binary' \
+          ' message, {3} pings per batch'.format(len(tracks), len(message),
+                                                 len(binary_messages[0]), batch))
+
+    def write_rows():
+        table = TimeWindowTable(headers['nims'], retention=60.)
+        for m, t in zip(messages, timestamps):
+            for row in _rows_from_json(m, t):
+                table.append(row)
+
+    def write_columns(decoder, messages):
+        table = TimeWindowTable(headers['nims'], retention=60.)
+        table.extend(decoder.decode(messages, timestamps))
+
+    cases = [('json -> rows, append per track', write_rows),
+             ('JSONDecoder, extend', lambda: write_columns(JSONDecoder(), messages)),
+             ('TrackListDecoder, extend', lambda: write_columns(TrackListDecoder(),
+                                                                [tracks] * batch)),
+             ('BinaryDecoder, extend', lambda: write_columns(BinaryDecoder(),
+                                                             binary_messages))]
+    for name, function in cases:
+        number = 200
+        seconds = min(timeit.repeat(function, number=number, repeat=3)) / number
+        print('{0:34s} {1:8.1f} us per ping'.format(name, 1e6 * seconds / batch))
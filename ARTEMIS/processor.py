@@ -4,22 +4,189 @@ import os
 import csv
 import numpy as np
 import time
+import traceback
+
+from sklearn.base import clone
 
 import targets
 import config
+import timeutil
 from classification import _scale_axis
 
+class ModelHolder:
+    """Holds the fitted classifier used for predictions, and refits it in a
+    separate worker thread.
+
+    A refit fits an unfitted clone of the classifier on a snapshot of the
+    classifier tables, then publishes it by replacing a single reference, so
+    predictions keep using the previous model until the new one is ready and
+    never see a partly fitted one. update() adds new rows to a copy of the
+    current model and publishes that the same way. Each published model is
+    given a generation number.
+
+    Parameters
+    ----------
+    classifier : classifier
+        Classifier to fit, e.g. classification.RadiusNeighborsClassifier.
+          Fitted models must provide copy() and update() (see
+          RadiusNeighborsClassifier).
+    target_space : TargetSpace
+        Target space holding the classifier tables.
+    """
+    def __init__(self, classifier, target_space):
+        self.template = classifier
+        self.target_space = target_space
+        # (model, generation, time of snapshot it was fitted on)
+        self._published = (None, 0, None)
+        self._condition = threading.Condition()
+        # held while a model is being updated and published, so that every
+        # published model includes the rows of the one before it
+        self._publish_lock = threading.Lock()
+        self._requested = False
+        self.refitting = False
+        self._thread = None
+        self.refits = 0
+        self.failures = 0
+        self.last_refit_seconds = None
+        self.max_refit_seconds = 0.
+        self.total_refit_seconds = 0.
+
+    def current(self):
+        """Returns the current fitted model (None before the first refit)."""
+        return self._published[0]
+
+    @property
+    def generation(self):
+        return self._published[1]
+
+    def age(self):
+        """Returns seconds since the snapshot the current model was fitted
+        on (None before the first refit).
+        """
+        fitted = self._published[2]
+        return None if fitted is None else time.time() - fitted
+
+    def busy(self):
+        """Whether a refit is requested or running."""
+        return self._requested or self.refitting
+
+    def _publish(self, model, fitted):
+        """Publishes model, fitted on a snapshot taken at time fitted, as the
+        next generation. Returns its generation.
+        """
+        with self._condition:
+            generation = self._published[1] + 1
+            self._published = (model, generation, fitted)
+            self._condition.notify_all()
+        return generation
+
+    def refit(self):
+        """Fits a new model on a snapshot of the classifier tables and
+        publishes it. Returns its generation.
+        """
+        start = time.time()
+        features, classifications = self.target_space.classifier_snapshot()
+        model = clone(self.template)
+        model.fit(features, classifications)
+        with self._publish_lock:
+            # rows added since the snapshot, which update() may already have
+            # added to the current model
+            model.update()
+            duration = time.time() - start
+            with self._condition:
+                self.refits += 1
+                self.last_refit_seconds = duration
+                self.max_refit_seconds = max(self.max_refit_seconds, duration)
+                self.total_refit_seconds += duration
+                return self._publish(model, start)
+
+    def update(self):
+        """Adds rows appended to the classifier tables since the current model
+        was fitted or updated to a copy of it, and publishes the copy.
+        Returns the number of rows added.
+        """
+        with self._publish_lock:
+            current, _, fitted = self._published
+            if current is None:
+                return 0
+            model = current.copy()
+            added = model.update()
+            if added:
+                self._publish(model, fitted)
+        return added
+
+    def request_refit(self):
+        """Asks the worker thread to refit, starting it if needed. Requests
+        made while a refit is running result in one more refit.
+        """
+        with self._condition:
+            self._requested = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._requested:
+                    self._condition.wait()
+                self._requested = False
+                self.refitting = True
+            try:
+                self.refit()
+            except Exception:
+                self.failures += 1
+                traceback.print_exc()
+            finally:
+                self.refitting = False
+
+    def wait_for_generation(self, generation, timeout=None):
+        """Waits until a model of at least generation is published. Returns
+        whether it was.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                    lambda: self._published[1] >= generation, timeout)
+
+    def stats(self):
+        """Returns dictionary of refit counts and durations, and staleness of
+        the current model: seconds since the snapshot it was fitted on, and
+        rows added to the classifier tables that it does not include.
+        """
+        model, generation, fitted = self._published
+        with self.target_space.locked(reads=['classifier_features']):
+            rows = len(self.target_space.tables['classifier_features'])
+        return {'generation': generation,
+                'refits': self.refits,
+                'failures': self.failures,
+                'refit_pending': self._requested,
+                'refitting': self.refitting,
+                'last_refit_seconds': self.last_refit_seconds,
+                'max_refit_seconds': self.max_refit_seconds,
+                'mean_refit_seconds': self.total_refit_seconds / self.refits
+                                      if self.refits else None,
+                'model_age_seconds': None if fitted is None
+                                     else time.time() - fitted,
+                'rows_behind': rows - getattr(model, 'n_samples_fit_', 0)}
+
 class ClassificationProcessor:
     """"""
 
     def __init__(self, classifier, target_space, send_triggers,
                  auto_start_thread=True):
-        self.classifier = classifier
+        self.model = ModelHolder(classifier, target_space)
         self.target_space = target_space
         self.send_triggers = send_triggers
 
         self.queue = queue.Queue()
         self.classification_count = 0
+        self.classified = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.skipped = 0
+        self.failed_batches = 0
 
         if auto_start_thread: self.startThread()
 
@@ -43,9 +210,26 @@ class ClassificationProcessor:
         self.fit_classifier()
         self.fitClassificationsAndTriggerRules()
 
+    @property
+    def classifier(self):
+        """Current fitted classifier (see ModelHolder)."""
+        return self.model.current()
+
     def fit_classifier(self):
-        self.classifier.fit(self.target_space.tables['classifier_features'],
-                            self.target_space.tables['classifier_classifications'])
+        """Fits the classifier on the classifier tables, waiting for it."""
+        self.model.refit()
+
+    def request_refit(self):
+        """Refits the classifier in the background. The current classifier
+        is used until the new one is ready.
+        """
+        self.model.request_refit()
+
+    def update_classifier(self):
+        """Adds targets stored in the classifier tables since the last fit or
+        update to the classifier, without refitting it.
+        """
+        self.model.update()
 
     def load_targets(self, file, format, delimiter=';'):
         """Reads targets from file, creating Target instances and appending
@@ -57,21 +241,15 @@ class ClassificationProcessor:
         file = os.path.join(dir, 'ARTEMIS', file)
         if format == 'csv':
             if os.path.isfile(file):
+                instances, features, classifications = [], [], []
                 with open(file, 'r') as f:
                     for record in csv.DictReader(f, delimiter = delimiter):
-
-                        instance = targets.Target(self.target_space,
+                        date = timeutil.from_string(record['date'])
+                        instances.append(targets.Target(self.target_space,
                                           source=record['source'],
-                                          firstseen=record['date'],
-                                          lastseen=record['date'])
-                        index = len(self.target_space.tables['classifier_features'])
-                        assert(len(self.target_space.tables['classifier_features'])
-                                == len(self.target_space.tables['classifier_classifications']))
-                        self.target_space.targets.append(index)
-
-                        instance.indices['classifier'] = index
-                        self.target_space.classifier_index_to_target[index] = instance
-                        self.target_space.tables['classifier_features'].append([
+                                          firstseen=date,
+                                          lastseen=date))
+                        features.append([
                             _scale_axis(float(record['size']), 'size'),
                             _scale_axis(float(record['speed']), 'speed'),
                             _scale_axis(float(record['deltav']), 'deltav'),
@@ -80,29 +258,97 @@ class ClassificationProcessor:
                             _scale_axis(float(record['time_of_day']),
                                     'time_of_day'),
                             _scale_axis(float(record['current']), 'current')])
-                        self.target_space.tables['classifier_classifications'].append(
-                                record['classification'])
+                        classifications.append(record['classification'])
+                self.target_space.targets.extend(
+                        self.target_space.append_classifier_rows(
+                                instances, features, classifications))
             else:
                 raise IOError("Unable to find csv file {0} to load targets.".
                         format(file))
 
 
+    def getTargetBatch(self, timeout):
+        """Waits up to timeout for a queued target, then collects every target
+        already queued or queued within config.classification_latency_budget,
+        up to config.classification_max_batch. Returns list of targets,
+        possibly empty.
+        """
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        deadline = time.time() + config.classification_latency_budget
+        while len(batch) < config.classification_max_batch:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def classifyTargets(self, batch):
+        """Classifies targets with one call to the classifier and checks the
+        saving rules for each. Returns list of targets classified.
+
+        Targets without the data their features need (a nims entry, removed
+        if the target expired while queued, or an ADCP entry) are skipped and
+        counted, so they do not fail the rest of the batch.
+        """
+        # a target queued more than once only needs classifying once
+        batch = list(dict.fromkeys(batch))
+        classifiable = [target for target in batch
+                        if target.get_entry('nims') is not None
+                        and target.get_adcp_entry() is not None]
+        if len(classifiable) < len(batch):
+            self.skipped += len(batch) - len(classifiable)
+            print('Skipped {0} targets without nims or ADCP entries'.format(
+                    len(batch) - len(classifiable)))
+        batch = classifiable
+        if not batch:
+            return batch
+        X = np.array(self.target_space.get_classifier_features(batch))
+        classifications = self.classifier.predict(X).tolist()
+        for target, features, classification in zip(batch, X, classifications):
+            # stored with the classification when the target expires
+            target.features = features.tolist()
+            target.classification = classification
+            print('Classified target {0}, classification: {1}'.format(target, classification))
+            self.send_triggers.check_saving_rules(target, classification)
+            #print('trigger status: ', self.send_triggers.trigger_status)
+        self.classified += len(batch)
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(batch))
+        self.classification_count += len(batch)
+        if self.classification_count >= config.refit_classifier_count:
+            self.update_classifier()
+            self.classification_count = 0
+        return batch
+
     def fitClassificationsAndTriggerRules(self):
-        """Continuously classifies any targets inside of queue."""
+        """Continuously classifies any targets inside of queue, in batches."""
         while True:
-            if not self.queue.empty():
-                target = self.queue.get()
-                if target.get_entry('nims') is not None: # TODO: Check that all targets are being classified, may be missingsome if removed first?
-                    X = np.array(target.get_classifier_features()).reshape(1, -1)
-                    classification = np.squeeze(self.classifier.predict(X)).tolist()
-                    target.classification = classification
-                    print('Classified target {0}, classification: {1}'.format(target, classification))
-                    self.send_triggers.check_saving_rules(target, classification)
-                    #print('trigger status: ', self.send_triggers.trigger_status)
-                    self.classification_count += 1
-                    if self.classification_count < config.refit_classifier_count:
-                        self.fit_classifier()
-                        self.classification_count = 0
+            batch = self.getTargetBatch(timeout=0.01)
+            if batch:
+                try:
+                    self.classifyTargets(batch)
+                except Exception:
+                    # keep classifying later targets
+                    self.failed_batches += 1
+                    traceback.print_exc()
+            age = self.model.age()
+            if (age is not None and age > config.classifier_refit_interval
+                    and not self.model.busy()):
+                self.request_refit()
             self.send_triggers.send_triggers_if_ready()
 
-            time.sleep(0.01)
+    def stats(self):
+        return {'queued': self.queue.qsize(),
+                'classified': self.classified,
+                'batches': self.batches,
+                'largest_batch': self.largest_batch,
+                'skipped': self.skipped,
+                'failed_batches': self.failed_batches,
+                'model': self.model.stats()}
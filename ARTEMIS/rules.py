@@ -1,5 +1,7 @@
 import socket
 from datetime import datetime
+import timeutil
+from timeutil import delta_t_in_seconds
 from config import instrument_ranges
 from config import ADCP_threshold
 from config import instruments
@@ -48,9 +50,8 @@ class SendTriggers:
         """
 
         classes_to_save = ['1','2','3']
-        PAMGuard = target.get_entry('pamguard')
-        ADCP = target.get_entry('adcp')
-        NIMS = target.get_entry('nims')
+        PAMGuard = target.has_entry('pamguard')
+        NIMS = target.has_entry('nims')
 
         # if there is a marine mammal detection from  PAMGuard
         if PAMGuard:
@@ -63,7 +64,7 @@ class SendTriggers:
 
         else:
             # if the current speed is greater than the threshold
-            if ADCP['speed'] > ADCP_threshold:
+            if target.current_speed > ADCP_threshold:
                 if classification in classes_to_save:
                     new_trigs = self.evaluate_target_range(target)
                 else:
@@ -84,8 +85,7 @@ class SendTriggers:
         detection, and cameras and BlueView are added if the target passes within
         their range
         """
-        NIMS = target.get_entry('nims')
-        target_min_range = NIMS['min_range_m']
+        target_min_range = target.min_range_m
 
         new_trigs = ['hydrophones', 'm3']
 
@@ -104,7 +104,7 @@ class SendTriggers:
         """
         trigs_to_send = []
 
-        timestamp = datetime.utcnow()
+        timestamp = timeutil.now()
         unsent_trigs = self.trigger_status['unsent_trigs']
         last_trigger = self.trigger_status['last_trigger']
         buffer_overlap = saving_parameters['buffer_overlap']
@@ -115,11 +115,11 @@ class SendTriggers:
         for inst in unsent_trigs:
             if unsent_trigs[inst]:
                 # calculate elapsed time since the target was detected
-                time_since_detection = self.delta_t_in_seconds(
+                time_since_detection = delta_t_in_seconds(
                     timestamp, unsent_trigs[inst][0])
 
                 # calculate elapsed time since the last trigger for this instrument
-                time_since_last_trigger = self.delta_t_in_seconds(
+                time_since_last_trigger = delta_t_in_seconds(
                     timestamp, last_trigger[inst])
 
                 # Determine if more time than "wait_before_send" (from config)
@@ -139,7 +139,7 @@ class SendTriggers:
                         # remove triggers that are within min_time_between_targets
                         # (i.e. already saved by this buffer)
                         for index, unsent_trig in enumerate(unsent_trigs[inst]):
-                            time_since_detection = self.delta_t_in_seconds(
+                            time_since_detection = delta_t_in_seconds(
                                 last_trigger[inst], unsent_trigs[inst][index])
                             if time_since_detection < min_time_between_targets:
                                 unsent_trigs[inst].pop(index)
@@ -155,19 +155,6 @@ class SendTriggers:
                                }
 
 
-    def delta_t_in_seconds(self, datetime1, datetime2):
-        """
-        calculate delta t in seconds between two datetime objects
-        (returns absolute value, so order of dates is insignifigant)
-        """
-        delta_t = datetime1 - datetime2
-        days_s = delta_t.days*(86400)
-        microseconds_s = delta_t.microseconds/1000000
-        delta_t_s = days_s + delta_t.seconds + microseconds_s
-
-        return abs(delta_t_s)
-
-
     def send_triggers(self, trigs_to_send):
         """
         send triggers to save data to AMP interface.
@@ -210,7 +197,7 @@ class SendTriggers:
 
     def init_trigger_status(self):
 
-        zero_time = datetime(2000,1,1,0,0,0)
+        zero_time = timeutil.to_epoch(datetime(2000,1,1,0,0,0))
 
         last_trigger = {}
         unsent_trigs = {}
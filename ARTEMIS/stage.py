@@ -1,18 +1,44 @@
+import heapq
+import itertools
 import random
 import threading
+import time
 import numpy as np
 
-import datetime
 from rules import SendTriggers
 from targets import Target
 import config
-import time
+import nims_decoders
+import timeutil
 
 
 class Stage:
-    """"""
+    """Stages incoming instrument data and turns it into Targets.
+
+    The processing thread sleeps until the earliest scheduled deadline (a NIMS
+    track reaching nims_max_time, a PAMGuard detection reaching
+    pamguard_max_time, a recent target expiring, or ADCP going stale) or until
+    addDataToStage signals new data.
+
+    PAMGuard detections are buffered in data_queues['pamguard'] until
+    pamguard_max_time has passed. Each detection is paired with every NIMS
+    track seen within pamguard_association_window of it, whether the track is
+    flushed before or after the detection's deadline (see
+    associatePamguardDetection). Detections with no nearby track are grouped
+    into acoustic-only targets.
+
+    Recent targets expire drop_target_time after they were last seen. Their
+    expiry deadlines live in the same heap; refreshing a target pushes a new
+    deadline and the old one is skipped when popped.
+    """
 
     def __init__(self, processor, target_space, send_triggers, source=config.site_name):
+        # guards stage data; notified whenever new data or deadlines are added
+        self.condition = threading.Condition()
+        # heap of (deadline, sequence, kind, key). Entries are not removed when
+        # superseded, they are checked against current state when popped.
+        self.deadlines = []
+        self._deadline_sequence = itertools.count()
         self.processor = processor
         self.target_space = target_space
         self.send_triggers = send_triggers
@@ -21,10 +47,14 @@ class Stage:
             self.data_queues[stream] = []
         # NIMS grouped by target_id, so change to dict {target_id: [indices]}
         self.data_queues['nims'] = {}
-        self.recent_targets = []
+        self.recent_targets = set()
+        # Lookup of recent targets by NIMS track id and by PAMGuard index
+        self.targets_by_track_id = {}
+        self.targets_by_pamguard = {}  # lists of targets, by detection index
+        # latest target made of PAMGuard detections only
+        self.acoustic_target = None
         # Adds ADCP (necessary for testing when not connected to ADCP)
-        unixtime = (datetime.datetime.utcnow() - datetime.datetime(1970,1,1))
-        self.addDataToStage('adcp', [unixtime.days*24*60*60 + unixtime.seconds, 1.2, 4.5])
+        self.addDataToStage('adcp', [timeutil.now(), 1.2, 4.5])
         self.startStageProcessing()
 
     def processDataBeforeStage(self, stream, data):
@@ -32,25 +62,18 @@ class Stage:
         particular stream, adds data to appropriate target list, then returns
         index for added data in TargetSpace.
 
-        Assumes 'nims' passes a list inside a dict with different tracks.
+        Assumes 'nims' passes a list inside a dict with different tracks. All
+        timestamps are epoch seconds (see timeutil).
         """
         if stream == 'adcp':
-            data = [datetime.datetime.fromtimestamp(data[0]), data[1], data[2]]
+            # comm format matches desired (unix timestamp), no need to change
             indices = self.target_space.append_entry(stream, data)
         elif stream == 'pamguard':
             # comm format matches desired, no need to change
             indices = self.target_space.append_entry(stream, data)
         elif stream == 'nims':
-            indices = {}
-            timestamp = data[0]
-            for track in data[1]:
-                new_data = [timestamp, track['id'], track['pings_visible'],
-                        track['first_ping'], track['target_strength'], track['width'],
-                        track['height'], track['size_sq_m'], track['speed_mps'],
-                        track['min_angle_m'], track['min_range_m'], track['max_angle_m'],
-                        track['max_range_m'], track['last_pos_bearing'],
-                        track['last_pos_range'], None]
-                indices[track['id']] = self.target_space.append_entry(stream, new_data)
+            indices = self.processBatchBeforeStage(stream,
+                    nims_decoders.columns_from_tracks([data[1]], [data[0]]))
         elif stream in config.data_streams:
             raise ValueError("No stage processing functionality exists for" \
                              " data stream {0}.".format(stream))
@@ -60,6 +83,80 @@ class Stage:
 
         return indices
 
+    def processBatchBeforeStage(self, stream, columns):
+        """Writes decoded NIMS columns (see nims_decoders) for any number of
+        tracks and pings to the nims table in one step. Returns dictionary of
+        new indices (in arrival order) by track id.
+        """
+        if stream != 'nims':
+            raise ValueError("Batch stage processing is only defined for" \
+                             " nims, not {0}.".format(stream))
+        rows = self.target_space.append_entries(stream, columns)
+
+        indices = {}
+        for track_id, index in zip(np.asarray(columns['id']).tolist(),
+                                   rows.tolist()):
+            indices.setdefault(track_id, []).append(index)
+        return indices
+
+    def addBatchToStage(self, stream, records):
+        """Adds a batch of records from stream to the stage under one lock.
+
+        For 'nims' each record is a message [timestamp, tracks] (one ping).
+        The tracks are decoded into columns before taking the lock, then
+        written together (see addColumnsToStage). Records of other streams are
+        staged one at a time. Returns dictionary with the number of records
+        and rows, and the seconds spent decoding, waiting for the lock,
+        writing to the tables and updating queues.
+        """
+        if stream not in config.data_streams:
+            raise ValueError("Error adding data to stage. Data stream {0} not" \
+                             " defined in config file.".format(stream))
+        start = time.perf_counter()
+        if stream == 'nims':
+            columns = nims_decoders.columns_from_tracks(
+                    [tracks for _, tracks in records],
+                    [timestamp for timestamp, _ in records])
+            decoded = time.perf_counter()
+            timing = self.addColumnsToStage(stream, columns)
+        else:
+            decoded = start
+            with self.condition:
+                locked = time.perf_counter()
+                for data in records:
+                    self.stageData(stream, data,
+                                   self.processDataBeforeStage(stream, data))
+                written = time.perf_counter()
+                self.condition.notify()
+            timing = {'rows': len(records),
+                      'lock_wait': locked - decoded,
+                      'write': written - locked,
+                      'queue': 0.}
+        timing['records'] = len(records)
+        timing['decode'] = decoded - start
+        timing['total'] = time.perf_counter() - start
+        return timing
+
+    def addColumnsToStage(self, stream, columns):
+        """Adds NIMS data already decoded into columns (see nims_decoders) to
+        the stage under one lock. Returns dictionary with the number of rows
+        and the seconds spent waiting for the lock, writing to the table and
+        updating queues.
+        """
+        start = time.perf_counter()
+        with self.condition:
+            locked = time.perf_counter()
+            stage_indices = self.processBatchBeforeStage(stream, columns)
+            written = time.perf_counter()
+            self.queueNimsIndices(stage_indices)
+            self.condition.notify()
+        end = time.perf_counter()
+        return {'rows': len(columns['id']),
+                'lock_wait': locked - start,
+                'write': written - locked,
+                'queue': end - written,
+                'total': end - start}
+
     def addDataToStage(self, stream, data):
         """Calls processing function for data based on stream then adds data to
         stream-specific queue.
@@ -67,143 +164,305 @@ class Stage:
         if stream not in config.data_streams:
             raise ValueError("Error adding data to stage. Data stream {0} not" \
                              " defined in config file.".format(stream))
-        stage_indices = self.processDataBeforeStage(stream, data)
-        if stream == 'nims':  # indexed
-            for track_id in stage_indices:
-                if track_id not in self.data_queues[stream]:
-                    self.data_queues[stream][track_id] = []
-                self.data_queues[stream][track_id].append(stage_indices[track_id])
-        elif stream == 'pamguard' or stream == 'adcp':  # one at any time
+        if stream == 'nims':
+            self.addBatchToStage(stream, [data])
+            return
+        with self.condition:
+            self.stageData(stream, data,
+                           self.processDataBeforeStage(stream, data))
+            self.condition.notify()
+
+    def queueNimsIndices(self, stage_indices):
+        """Appends new nims indices to per-track queues, scheduling tracks that
+        become eligible for processing. Must be called holding self.condition.
+        """
+        triggers = config.data_streams_classifier_triggers
+        queues = self.data_queues['nims']
+        for track_id, indices in stage_indices.items():
+            queue = queues.setdefault(track_id, [])
+            was_empty = not queue
+            queue.extend(indices)
+            if len(queue) >= triggers['nims_max_pings']:
+                self.scheduleDeadline(timeutil.now(), 'nims', track_id)
+            elif was_empty:
+                timestamp = self.target_space.get_entry_value_by_index(
+                        'nims', queue[0], 'timestamp')
+                self.scheduleDeadline(timestamp + triggers['nims_max_time'],
+                                      'nims', track_id)
+
+    def stageData(self, stream, data, stage_indices):
+        """Adds index of processed data from a non-nims stream to its queue.
+        Must be called holding self.condition.
+        """
+        triggers = config.data_streams_classifier_triggers
+        if stream == 'adcp':  # one at any time
             self.data_queues[stream] = stage_indices
+            self.scheduleDeadline(data[0] + 60*config.adcp_last_seen_threshold,
+                                  'adcp', stage_indices)
+        elif stream == 'pamguard':  # buffered until deadline
+            self.data_queues[stream].append(stage_indices)
+            self.scheduleDeadline(data[0] + triggers['pamguard_max_time'],
+                                  'pamguard', stage_indices)
         else:
             self.data_queues[stream].append(stage_indices)  # can have multiple
 
+    def scheduleDeadline(self, deadline, kind, key=None):
+        """Schedules the stage thread to check kind ('nims', 'pamguard',
+        'adcp' or 'expire') for key at deadline (epoch seconds). Must be
+        called holding self.condition.
+        """
+        heapq.heappush(self.deadlines,
+                       (deadline, next(self._deadline_sequence), kind, key))
+
     def createOrUpdateTarget(self, nims=[], pamguard=[], adcp=[]):
         """Appends or creates a Target instance based on current staged data."""
         if pamguard != [] and nims == []:
-            for target in self.recent_targets:
+            if pamguard in self.targets_by_pamguard:
                 # Data is captured in a nims+pamguard Target that will be saved, ignore
-                if target.indices.get('pamguard') == pamguard:
-                    break
+                pass
             else:
-                # Data not captured in any other Targets, create a new one
+                # Data not captured in any other Targets, add it to the current
+                # acoustic-only Target if close enough, or create a new one
+                timestamp = self.target_space.get_entry_value_by_index('pamguard', pamguard, 'timestamp')
+                target = self.acoustic_target
+                if (target in self.recent_targets and timestamp - target.lastseen
+                        <= config.pamguard_association_window):
+                    self.addPamguardToTarget(target, [pamguard])
+                    return target
                 target_out = Target(target_space=self.target_space,
                               source=config.site_name + "_auto",
-                              firstseen=self.target_space.get_entry_value_by_index('pamguard', pamguard, 'timestamp'),
-                              lastseen=self.target_space.get_entry_value_by_index('pamguard', pamguard, 'timestamp'),
-                              indices={'pamguard': pamguard, 'adcp': adcp})
-                target_out.update_classifier_table
-                self.recent_targets.append(target_out)
+                              firstseen=timestamp,
+                              lastseen=timestamp,
+                              indices={'pamguard': pamguard,
+                                       'adcp': self.adcpIndexAt(timestamp, adcp)})
+                self.addRecentTarget(target_out)
+                self.acoustic_target = target_out
                 return target_out
         elif nims != [] and nims[1] != []:
             #print("nims[0]:", nims[0], "nims[1]:", nims[1])
-            for target in self.recent_targets:
-                if target.get_entry_value('nims', 'id') == nims[0]:
-                    # There's an existing target with that id, update that Target object
-                    target.update_entry('nims', nims[1])
-                    return target
+            first_timestamp = self.target_space.get_entry_value_by_index('nims', nims[1][0], 'timestamp')
+            latest_timestamp = self.target_space.get_entry_value_by_index('nims', nims[1][-1], 'timestamp')
+            # PAMGuard detections heard while these pings were recorded
+            window = config.pamguard_association_window
+            detections = self.target_space.get_indices_in_window('pamguard',
+                    first_timestamp - window, latest_timestamp + window)
+
+            target = self.targets_by_track_id.get(nims[0])
+            if target is not None:
+                # There's an existing target with that id, update that Target object
+                target.update_entry('nims', nims[1])
+                self.refreshRecentTarget(target, latest_timestamp)
+                self.addPamguardToTarget(target, detections)
+                return target
             else:
-                    if pamguard:
-                        first_timestamp = min(self.target_space.get_entry_value_by_index('pamguard', pamguard[-1], 'timestamp'),
-                                           self.target_space.get_entry_value_by_index('nims', nims[1][0],'timestamp'))
-                        latest_timestamp = max(self.target_space.get_entry_value_by_index('pamguard', pamguard[-1], 'timestamp'),
-                                           self.target_space.get_entry_value_by_index('nims', nims[1][-1],'timestamp'))
-                    else:
-                        first_timestamp = self.target_space.get_entry_value_by_index('nims', nims[1][0],'timestamp')
-                        latest_timestamp = self.target_space.get_entry_value_by_index('nims', nims[1][-1],'timestamp')
-                        pamguard = None
-
-                    if len(nims[1]) == 1:
-                        # We don't have existing targets and only one index in queue
-                        self.target_space.tables['nims'][nims[1][0]][-1] = []  # changes agg_indices to []
-                        target_out = Target(target_space=self.target_space,
-                                      source=config.site_name + "_auto",
-                                      firstseen=first_timestamp,
-                                      lastseen=latest_timestamp,
-                                      indices={'nims': nims[1][0], 'pamguard': pamguard, 'adcp': adcp})
-                        self.recent_targets.append(target_out)
-                        return target_out
-                    elif len(nims[1]) > 1:
-                        # We don't have existing targets, but multiple indices in queue
-                        combined_entry = self.target_space.combine_entries('nims', nims[1])
-                        index = self.target_space.append_entry('nims', combined_entry)
-                        target_out = Target(target_space=self.target_space,
-                                      source=config.site_name + "_auto",
-                                      firstseen=first_timestamp,
-                                      lastseen=latest_timestamp,
-                                      indices={'nims': index, 'pamguard': pamguard, 'adcp': adcp})
-                        self.recent_targets.append(target_out)
-                        return target_out
+                    adcp = self.adcpIndexAt(latest_timestamp, adcp)
+
+                    # We don't have existing targets, start an aggregate of
+                    # the queued pings
+                    index = self.target_space.aggregate_entries('nims', nims[1])
+                    target_out = Target(target_space=self.target_space,
+                                  source=config.site_name + "_auto",
+                                  firstseen=first_timestamp,
+                                  lastseen=latest_timestamp,
+                                  indices={'nims': index, 'pamguard': None, 'adcp': adcp},
+                                  track_id=nims[0])
+                    self.addRecentTarget(target_out)
+                    self.addPamguardToTarget(target_out, detections)
+                    return target_out
+
+    def addPamguardToTarget(self, target, detections):
+        """Pairs PAMGuard detection indices with target, widening when it was
+        seen to cover them. Returns True if target had no detections before.
+
+        Only acoustic-only targets are kept alive by detections. A NIMS
+        target expires drop_target_time after its latest ping, while its nims
+        rows are still in the table.
+        """
+        new_detections = [detection for detection in detections
+                          if detection not in target.pamguard_indices]
+        if not new_detections:
+            return False
+        first_detection = not target.pamguard_indices
+        target.pamguard_indices.extend(new_detections)
+        target.pamguard_indices.sort()
+        target.indices['pamguard'] = target.pamguard_indices[-1]
+        for detection in new_detections:
+            self.targets_by_pamguard.setdefault(detection, []).append(target)
+        timestamps = self.target_space.get_values_by_indices('pamguard',
+                'timestamp', new_detections)
+        target.firstseen = min(target.firstseen, timestamps.min())
+        if target.track_id is None:
+            if target in self.recent_targets:
+                self.refreshRecentTarget(target, timestamps.max())
+            else:
+                target.lastseen = max(target.lastseen, timestamps.max())
+        return first_detection
+
+    def associatePamguardDetection(self, detection):
+        """Pairs a PAMGuard detection with every recent NIMS target seen within
+        pamguard_association_window of it, using the nims time index.
+
+        Returns list of targets that gained their first detection, and
+        whether any NIMS track near the detection is still staged (it will
+        be paired when that track is flushed).
+        """
+        timestamp = self.target_space.get_entry_value_by_index('pamguard',
+                detection, 'timestamp')
+        window = config.pamguard_association_window
+        rows = self.target_space.get_indices_in_window('nims',
+                timestamp - window, timestamp + window)
+        track_ids = set(self.target_space.get_values_by_indices('nims', 'id',
+                rows).tolist())
+        paired = []
+        for track_id in track_ids:
+            target = self.targets_by_track_id.get(track_id)
+            if target is not None and self.addPamguardToTarget(target, [detection]):
+                paired.append(target)
+        staged = any(track_id in self.data_queues['nims'] for track_id in track_ids)
+        return paired, staged
+
+    def addRecentTarget(self, target):
+        """Adds target to recent targets and indexes it by NIMS track id and
+        PAMGuard index.
+        """
+        self.recent_targets.add(target)
+        self.scheduleDeadline(target.lastseen + config.drop_target_time,
+                              'expire', target)
+        if target.track_id is not None:
+            self.targets_by_track_id[target.track_id] = target
+        for detection in target.pamguard_indices:
+            self.targets_by_pamguard.setdefault(detection, []).append(target)
+
+    def refreshRecentTarget(self, target, lastseen):
+        """Updates when target was last seen, postponing its expiry."""
+        if lastseen > target.lastseen:
+            target.lastseen = lastseen
+            self.scheduleDeadline(target.lastseen + config.drop_target_time,
+                                  'expire', target)
+
+    def removeRecentTarget(self, target):
+        """Removes target from recent targets and from the lookup indexes."""
+        self.recent_targets.remove(target)
+        if self.targets_by_track_id.get(target.track_id) is target:
+            self.targets_by_track_id.pop(target.track_id)
+        for detection in target.pamguard_indices:
+            paired = self.targets_by_pamguard.get(detection, [])
+            if target in paired:
+                paired.remove(target)
+                if not paired:
+                    self.targets_by_pamguard.pop(detection)
+
+    def adcpIndexAt(self, timestamp, adcp):
+        """Returns index of the ADCP reading valid at timestamp, or the staged
+        ADCP index if no reading is available.
+        """
+        index = self.target_space.get_index_nearest('adcp', timestamp)
+        return adcp if index is None else index
 
     def startStageProcessing(self):
         """Creates thread, starts loop that processes stage data."""
         threading.Thread(target=self.processEligibleStagedData).start()
 
-    # Should be looping. That way, we can check time-based conditions.
     def processEligibleStagedData(self):
-        """Deletes, classifies, or sends data to rules if eligible."""
-        # Only try to create new target in potential pamguard only case
+        """Deletes, classifies, or sends data to rules as their deadlines
+        pass. Sleeps until the next deadline or until new data arrives.
+        """
         while True:
-            # determine if ADCP is active
-            adcp_index = self.data_queues['adcp']
-            adcp_last_seen = self.target_space.get_entry_value_by_index('adcp', adcp_index, 'timestamp')
-            adcp_flag = abs(datetime.datetime.now() - adcp_last_seen) > datetime.timedelta(0,60*config.adcp_last_seen_threshold,0)
+            self.processDueDeadlines()
 
-            if adcp_flag:
+    def processDueDeadlines(self, wait=True):
+        """Acts on every deadline that has passed. If none has, waits (if
+        wait is True) until the next deadline or until new data arrives.
+
+        Expired targets are removed from the stage while holding
+        self.condition, but their classifier features are stored and their
+        entries cleared after releasing it, so that comms threads adding data
+        are not blocked behind a large expiry batch.
+        """
+        with self.condition:
+            now = timeutil.now()
+            expired_targets = []
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, _, kind, key = heapq.heappop(self.deadlines)
+                if kind == 'expire':
+                    # skip if already removed, or refreshed since deadline
+                    # was set (a later deadline exists)
+                    if (key in self.recent_targets and
+                            key.lastseen + config.drop_target_time <= deadline):
+                        expired_targets.append(key)
+                else:
+                    self.processDeadline(kind, key, now)
+            if expired_targets:
+                self.removeRecentTargets(expired_targets)
+            elif wait:
+                timeout = self.deadlines[0][0] - now if self.deadlines else None
+                self.condition.wait(timeout)
+        if expired_targets:
+            self.storeExpiredTargets(expired_targets)
+
+    def processDeadline(self, kind, key, now):
+        """Acts on a deadline that has passed, if it still applies."""
+        triggers = config.data_streams_classifier_triggers
+        if kind == 'adcp':
+            # deadline is superseded if newer ADCP data has arrived
+            if self.data_queues['adcp'] == key:
                 raise Exception('ADCP has is no longer updating, cannot classify features.')
 
-            if self.data_queues['pamguard'] != []:
-                pamguard_exceeds_max_time = (datetime.datetime.utcnow() -
-                        self.target_space.get_entry_value_by_index('pamguard',
-                        self.data_queues['pamguard'],'timestamp') >= datetime.timedelta(
-                        seconds=config.data_streams_classifier_triggers['pamguard_max_time']))
-                if pamguard_exceeds_max_time:
-                    target = createOrUpdateTarget(pamguard=self.data_queues['pamguard'],
-                                                  adcp=self.data_queues['adcp'])
-                    self.data_queues['pamguard'] = []
-                    self.recent_targets.append(target)
+        elif kind == 'pamguard':
+            self.data_queues['pamguard'].remove(key)
+            paired, staged = self.associatePamguardDetection(key)
+            for target in paired:
+                # rules depend on whether a target has a PAMGuard detection
+                self.send_triggers.check_saving_rules(target, target.classification)
+            if key not in self.targets_by_pamguard and not staged:
+                # Only try to create new target in potential pamguard only case
+                target = self.createOrUpdateTarget(pamguard=key,
+                                                   adcp=self.data_queues['adcp'])
+                if len(target.pamguard_indices) == 1:  # new acoustic target
                     self.send_triggers.check_saving_rules(target, None)
-                    self.send_triggers.send_triggers_if_ready()
-
-            track_ids_to_remove = []
-            track_ids_to_process = list(self.data_queues['nims'].keys())
-            for track_id in track_ids_to_process:
-                # If max_pings or max_time, create/update Target
-                ping_count = len(self.data_queues['nims'][track_id])
-                exceeds_max_pings = (ping_count >=
-                        config.data_streams_classifier_triggers['nims_max_pings'])
-                exceeds_max_time = (datetime.datetime.utcnow() -
-                        self.target_space.get_entry_value_by_index('nims',
-                        self.data_queues['nims'][track_id][-1], 'timestamp')
-                        >= datetime.timedelta(seconds=config.data_streams_classifier_triggers['nims_max_time']))
-                if exceeds_max_pings or exceeds_max_time:
-                    target = self.createOrUpdateTarget(nims=(track_id, self.data_queues['nims'][track_id]),
-                                                  pamguard=self.data_queues['pamguard'],
-                                                  adcp=self.data_queues['adcp'])
-                    track_ids_to_remove.append(track_id)
-                    self.processor.addTargetToQueue(target)
-
-            for track_id in track_ids_to_remove: self.data_queues['nims'].pop(track_id)
-
-            for recent_target in self.recent_targets:
-                if (datetime.datetime.utcnow() - recent_target.lastseen).seconds >= config.drop_target_time:
-                    print('Start removal process for Target:', recent_target.indices)
-                    # Remove recent target from list
-                    self.recent_targets.remove(recent_target)
-                    # Processes any stage data remaining
-                    #rt_nims_id = recent_target.get_entry_value('nims','id')
-                    #if self.data_queues['nims'].get(rt_nims_id):
-                    #    new_target = self.createOrUpdateTarget(adcp=self.data_queues['adcp'],
-                    #            pamguard=self.data_queues['pamguard'],
-                    #            nims=self.data_queues['nims'].get(rt_nims_id))
-                    #else:
-                    #    new_target = self.createOrUpdateTarget(adcp=self.data_queues['adcp'],
-                    #            pamguard=self.data_queues['pamguard'])
-                    #if self.data_queues['nims'].get(rt_nims_id):
-                    #    self.processor.addTargetToQueue(new_target)
-                    # Update classifier features list
-                    self.target_space.update_classifier_tables(recent_target)
-                    # Clear nims and pamguard
-                    self.target_space.update(recent_target)
-
-        time.sleep(0.01)
+            self.send_triggers.send_triggers_if_ready()
+
+        elif kind == 'nims':
+            queue = self.data_queues['nims'].get(key)
+            if not queue:
+                return  # already flushed
+            # If max_pings or max_time, create/update Target
+            exceeds_max_pings = len(queue) >= triggers['nims_max_pings']
+            last_ping = self.target_space.get_entry_value_by_index('nims',
+                    queue[-1], 'timestamp')
+            time_left = last_ping + triggers['nims_max_time'] - now
+            if exceeds_max_pings or time_left <= 0:
+                target = self.createOrUpdateTarget(nims=(key, queue),
+                                                   adcp=self.data_queues['adcp'])
+                self.data_queues['nims'].pop(key)
+                self.processor.addTargetToQueue(target)
+            else:
+                # more pings arrived since deadline was set
+                self.scheduleDeadline(now + time_left, 'nims', key)
+
+    def expireRecentTargets(self, targets):
+        """Removes expired targets, storing their classifier features and
+        clearing their data stream entries in one batch.
+        """
+        with self.condition:
+            self.removeRecentTargets(targets)
+        self.storeExpiredTargets(targets)
+
+    def removeRecentTargets(self, targets):
+        """Removes expired targets from recent targets and the lookup indexes,
+        so no new data is added to them. Must be called holding
+        self.condition.
+        """
+        for target in targets:
+            print('Start removal process for Target:', target.indices)
+            self.removeRecentTarget(target)
+
+    def storeExpiredTargets(self, targets):
+        """Stores classifier features of targets removed by
+        removeRecentTargets and clears their data stream entries in one
+        batch. Only takes the target space locks, not self.condition.
+        """
+        # Update classifier features list
+        self.target_space.update_classifier_tables_batch(targets)
+        # Clear nims and pamguard
+        self.target_space.update_batch(targets)
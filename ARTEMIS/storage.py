@@ -0,0 +1,679 @@
+from collections.abc import Mapping
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+import threading
+import time
+import numpy as np
+
+
+# Column dtypes shared by every data stream table. Columns not listed here
+# (including 'timestamp', in epoch seconds) are stored as float64.
+column_dtypes = {'id': np.int64,
+                 'pings_visible': np.int64,
+                 'first_ping': np.int64,
+                 'detection': object,
+                 'aggregate_indices': object}
+
+
+def grow_rows(array, size):
+    """Returns array, or a copy with room for at least size rows. Capacity
+    doubles so that appending rows one at a time costs amortized O(1).
+    """
+    if size <= len(array):
+        return array
+    grown = np.empty((max(2 * len(array), size),) + array.shape[1:],
+                     dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def _to_python(value):
+    """Converts numpy scalars to builtin Python types."""
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class RowView(Mapping):
+    """Read/write view of a single row in a ColumnTable.
+
+    Behaves like the dictionary previously built by
+    TargetSpace.get_entry_by_index, but reads values straight from the
+    backing column arrays instead of copying the row.
+    """
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getitem__(self, key):
+        return _to_python(self._table.columns[key][self._table._slot(self._index)])
+
+    def __setitem__(self, key, value):
+        if key not in self._table.columns:
+            raise KeyError(key)
+        self._table.columns[key][self._table._slot(self._index)] = value
+        self._table.rewrites += 1
+
+    def __iter__(self):
+        return iter(self._table.headers)
+
+    def __len__(self):
+        return len(self._table.headers)
+
+    def __repr__(self):
+        return 'RowView({0}, {1})'.format(self._index, dict(self))
+
+    @property
+    def index(self):
+        return self._index
+
+
+class ReadWriteLock:
+    """Readers-writer lock guarding one table.
+
+    Any number of threads may read at once, while a writer has exclusive
+    access. Waiting writers block new readers so that a steady stream of
+    reads cannot starve ingest. The lock is re-entrant for a thread that
+    already holds it: a reader may read again and a writer may read or write
+    again, but a reader cannot upgrade to a writer.
+
+    Counts acquisitions and how often, and for how long, threads had to wait
+    (see stats()).
+    """
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._waiting_writers = 0
+        self._local = threading.local()
+        self.reads = 0
+        self.writes = 0
+        self.read_waits = 0
+        self.write_waits = 0
+        self.read_wait_time = 0.
+        self.write_wait_time = 0.
+
+    def _held(self):
+        """Returns this thread's stack of acquisitions."""
+        if not hasattr(self._local, 'held'):
+            self._local.held = []
+        return self._local.held
+
+    def acquire_read(self):
+        held = self._held()
+        with self._condition:
+            self.reads += 1
+            if held:
+                held.append(None)
+                return
+            if self._writer is not None or self._waiting_writers:
+                self.read_waits += 1
+                start = time.perf_counter()
+                while self._writer is not None or self._waiting_writers:
+                    self._condition.wait()
+                self.read_wait_time += time.perf_counter() - start
+            self._readers += 1
+            held.append('read')
+
+    def acquire_write(self):
+        held = self._held()
+        me = threading.get_ident()
+        with self._condition:
+            self.writes += 1
+            if held:
+                if self._writer != me:
+                    raise RuntimeError("Cannot upgrade a read lock to a write lock.")
+                held.append(None)
+                return
+            if self._writer is not None or self._readers:
+                self.write_waits += 1
+                start = time.perf_counter()
+                self._waiting_writers += 1
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+                self._waiting_writers -= 1
+                self.write_wait_time += time.perf_counter() - start
+            self._writer = me
+            held.append('write')
+
+    def release(self):
+        """Releases the most recent acquisition by this thread."""
+        kind = self._held().pop()
+        if kind is None:
+            return
+        with self._condition:
+            if kind == 'read':
+                self._readers -= 1
+            else:
+                self._writer = None
+            self._condition.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        """Returns dictionary of acquisition and contention counters."""
+        with self._condition:
+            return {'reads': self.reads,
+                    'writes': self.writes,
+                    'read_waits': self.read_waits,
+                    'write_waits': self.write_waits,
+                    'read_wait_time': self.read_wait_time,
+                    'write_wait_time': self.write_wait_time}
+
+
+class ColumnTable:
+    """Columnar storage for one data stream.
+
+    Each header is backed by its own typed NumPy array. Rows are addressed by
+    integer index and are always appended at the end. Removed rows leave a
+    hole, so indices of live rows never change; TimeWindowTable reclaims holes
+    as its window advances.
+
+    Parameters
+    ----------
+    headers : list of str
+        Column names, in the order rows are passed to append().
+    capacity : int, optional
+        Number of rows to preallocate. Storage doubles when full.
+    """
+    def __init__(self, headers, capacity=1024):
+        self.headers = list(headers)
+        self.columns = {}
+        for name in self.headers:
+            dtype = column_dtypes.get(name, np.float64)
+            self.columns[name] = self._empty_column(dtype, capacity)
+        self._valid = np.zeros(capacity, dtype=bool)
+        self._size = 0
+        self._live = 0
+        # number of times an existing row has been overwritten, so cached
+        # copies of rows can be invalidated
+        self.rewrites = 0
+        self._compactions = 0
+        self._rows_reclaimed = 0
+
+    @staticmethod
+    def _empty_column(dtype, length):
+        if np.dtype(dtype) == object:
+            return np.full(length, None, dtype=object)
+        return np.zeros(length, dtype=dtype)
+
+    @property
+    def capacity(self):
+        return len(self._valid)
+
+    def _slot(self, index):
+        """Maps a row index to its position in the column arrays."""
+        return index
+
+    def __len__(self):
+        """Number of row slots in use, including holes left by remove()."""
+        return self._size
+
+    def __getitem__(self, index):
+        if not self.is_valid(index):
+            raise IndexError("Row {0} is not a valid row.".format(index))
+        return RowView(self, index)
+
+    def __setitem__(self, index, data):
+        if index < 0 or index >= self._size:
+            raise IndexError("Row {0} is outside of table of length {1}.".format(
+                index, self._size))
+        self._write(index, data)
+        self.rewrites += 1
+
+    def _write(self, index, data):
+        if len(data) != len(self.headers):
+            raise ValueError("Expected {0} values, got {1}.".format(
+                len(self.headers), len(data)))
+        for name, value in zip(self.headers, data):
+            self.columns[name][index] = value
+        if not self._valid[index]:
+            self._valid[index] = True
+            self._live += 1
+
+    def _resize(self, capacity):
+        keep = min(capacity, self.capacity)
+        for name, column in self.columns.items():
+            new_column = self._empty_column(column.dtype, capacity)
+            new_column[:keep] = column[:keep]
+            self.columns[name] = new_column
+        valid = np.zeros(capacity, dtype=bool)
+        valid[:keep] = self._valid[:keep]
+        self._valid = valid
+
+    def append(self, data):
+        """Stores a row (list in header order) and returns its index."""
+        if self._size == self.capacity:
+            self._resize(max(2 * self.capacity, 1))
+        index = self._size
+        self._size += 1
+        self._write(index, data)
+        return index
+
+    def _column_count(self, columns):
+        """Checks columns holds every header with equal lengths, returns the
+        number of rows.
+        """
+        missing = [name for name in self.headers if name not in columns]
+        if missing:
+            raise ValueError("Missing columns {0}.".format(missing))
+        counts = set(len(columns[name]) for name in self.headers)
+        if len(counts) > 1:
+            raise ValueError("Columns have different lengths {0}.".format(
+                sorted(counts)))
+        return counts.pop()
+
+    def _write_columns(self, slots, columns):
+        for name in self.headers:
+            self.columns[name][slots] = columns[name]
+        self._valid[slots] = True
+        self._live += len(slots)
+
+    def extend(self, columns):
+        """Stores many rows at once and returns array of their indices.
+
+        columns maps each header to a sequence with one value per row. Rows
+        are written after the end of the table.
+        """
+        count = self._column_count(columns)
+        capacity = max(self.capacity, 1)
+        while self._size + count > capacity:
+            capacity *= 2
+        if capacity != self.capacity:
+            self._resize(capacity)
+        indices = np.arange(self._size, self._size + count)
+        self._write_columns(indices, columns)
+        self._size += count
+        return indices
+
+    def remove(self, index):
+        """Marks a row as removed, leaving a hole."""
+        if not self.is_valid(index):
+            return
+        self._valid[index] = False
+        self._live -= 1
+        for name, column in self.columns.items():
+            if column.dtype == object:
+                column[index] = None
+
+    def fragmentation(self):
+        """Fraction of row slots that are holes."""
+        if self._size == 0:
+            return 0.
+        return (self._size - self._live) / self._size
+
+    def live_count(self):
+        return self._live
+
+    def stats(self):
+        """Returns dictionary of allocation statistics for the table."""
+        return {'length': self._size,
+                'capacity': self.capacity,
+                'live': self._live,
+                'free': self._size - self._live,
+                'fragmentation': self.fragmentation(),
+                'compactions': self._compactions,
+                'rows_reclaimed': self._rows_reclaimed}
+
+    def is_valid(self, index):
+        return 0 <= index < self._size and bool(self._valid[index])
+
+    def valid_mask(self, indices):
+        """Returns boolean array, True where indices refer to live rows."""
+        indices = np.asarray(indices, dtype=np.int64)
+        in_range = (indices >= 0) & (indices < self._size)
+        return in_range & self._valid[np.where(in_range, indices, 0)]
+
+    def get_value(self, index, key):
+        """Returns a single value without building a row view, or None if
+        the row has been removed or the column does not exist.
+        """
+        if key not in self.columns or not self.is_valid(index):
+            return None
+        return _to_python(self.columns[key][self._slot(index)])
+
+    def valid_indices(self):
+        """Returns array of indices of all rows that have not been removed."""
+        return np.flatnonzero(self._valid[:self._size])
+
+    def column(self, name):
+        """Returns the backing array of a column, trimmed to the table length."""
+        return self.columns[name][:self._size]
+
+    def take(self, name, indices):
+        """Returns array of column values for the given row indices."""
+        return self.columns[name][self._slot(np.asarray(indices, dtype=np.int64))]
+
+
+class TimeIndex:
+    """Row indices of a table kept sorted by timestamp.
+
+    Keys are epoch timestamps. Rows arrive nearly in time order, so inserts
+    are almost always appends. Entries for rows that are no longer valid are
+    skipped by queries and trimmed from the front as the table expires rows.
+
+    Parameters
+    ----------
+    is_valid : callable
+        Returns whether a row index still refers to a live row.
+    """
+    def __init__(self, is_valid):
+        self.is_valid = is_valid
+        self._keys = []
+        self._rows = []
+        self._start = 0  # entries before start have been trimmed
+
+    def __len__(self):
+        return len(self._keys) - self._start
+
+    def insert(self, key, row):
+        if not self._keys or key >= self._keys[-1]:
+            self._keys.append(key)
+            self._rows.append(row)
+        else:
+            position = max(bisect_right(self._keys, key), self._start)
+            self._keys.insert(position, key)
+            self._rows.insert(position, row)
+
+    def extend(self, keys, rows):
+        """Inserts many entries. Appends in one step if keys are in order
+        and no earlier than the newest key.
+        """
+        keys = list(keys)
+        rows = list(rows)
+        if not keys:
+            return
+        in_order = all(a <= b for a, b in zip(keys, keys[1:]))
+        if in_order and (not self._keys or keys[0] >= self._keys[-1]):
+            self._keys.extend(keys)
+            self._rows.extend(rows)
+        else:
+            for key, row in zip(keys, rows):
+                self.insert(key, row)
+
+    def discard(self, key, row):
+        """Removes entry for row, which was inserted with key."""
+        position = bisect_left(self._keys, key, self._start)
+        while position < len(self._keys) and self._keys[position] == key:
+            if self._rows[position] == row:
+                del self._keys[position]
+                del self._rows[position]
+                return
+            position += 1
+
+    def trim(self, cutoff):
+        """Drops leading entries older than cutoff whose rows are gone."""
+        while (self._start < len(self._keys) and self._keys[self._start] < cutoff
+               and not self.is_valid(self._rows[self._start])):
+            self._start += 1
+        if self._start > 1024 and 2 * self._start > len(self._keys):
+            del self._keys[:self._start]
+            del self._rows[:self._start]
+            self._start = 0
+
+    def asof(self, key):
+        """Returns the latest valid row with key at or before key, or None."""
+        position = bisect_right(self._keys, key, self._start) - 1
+        while position >= self._start:
+            if self.is_valid(self._rows[position]):
+                return self._rows[position]
+            position -= 1
+        return None
+
+    def after(self, key):
+        """Returns the earliest valid row with key after key, or None."""
+        position = bisect_right(self._keys, key, self._start)
+        while position < len(self._keys):
+            if self.is_valid(self._rows[position]):
+                return self._rows[position]
+            position += 1
+        return None
+
+    def window(self, start, end):
+        """Returns valid rows with keys in [start, end], in time order."""
+        first = bisect_left(self._keys, start, self._start)
+        last = bisect_right(self._keys, end, self._start)
+        return [row for row in self._rows[first:last] if self.is_valid(row)]
+
+
+class TimeWindowTable(ColumnTable):
+    """Fixed-capacity ring buffer of rows ordered by arrival time.
+
+    Rows are given monotonically increasing indices that are never reused, and
+    are stored at slot ``index % capacity``. Whenever a row is appended, rows
+    older than ``retention`` seconds (relative to the new row's timestamp) are
+    expired from the oldest end of the ring, so memory stays flat for a steady
+    data rate. The ring only grows if it fills with rows that are still inside
+    the retention window. Rows are also indexed by timestamp (see TimeIndex)
+    for as-of and window queries.
+
+    Parameters
+    ----------
+    headers : list of str
+        Column names, in the order rows are passed to append(). Must include
+        'timestamp'.
+    retention : float
+        Number of seconds a row is kept after newer data arrives. Timestamps
+        are in epoch seconds (see timeutil).
+    capacity : int, optional
+        Number of rows in the ring.
+    """
+    def __init__(self, headers, retention, capacity=1024):
+        if 'timestamp' not in headers:
+            raise ValueError("TimeWindowTable requires a 'timestamp' column.")
+        ColumnTable.__init__(self, headers, capacity)
+        self.retention = retention
+        self._timestamp_position = self.headers.index('timestamp')
+        self._head = 0  # index of next row to be appended
+        self._tail = 0  # oldest row that may still be live
+        self._expired = 0
+        self._grown = 0
+        self._removed_since_compaction = 0
+        self.time_index = TimeIndex(self.is_valid)
+
+    def _slot(self, index):
+        return index % self.capacity
+
+    @staticmethod
+    def time_key(timestamp):
+        """Converts a timestamp to the key used by the time index."""
+        return float(timestamp)
+
+    def __len__(self):
+        """Total number of rows ever appended (one past the newest index)."""
+        return self._head
+
+    def __setitem__(self, index, data):
+        if index < self._tail or index >= self._head:
+            raise IndexError("Row {0} is outside of table window [{1}, {2}).".format(
+                index, self._tail, self._head))
+        slot = self._slot(index)
+        if self._valid[slot]:
+            self.time_index.discard(
+                    self.time_key(self.columns['timestamp'][slot]), index)
+        self._write(slot, data)
+        self.rewrites += 1
+        self.time_index.insert(self.time_key(data[self._timestamp_position]), index)
+
+    def _resize(self, capacity):
+        indices = np.arange(self._tail, self._head)
+        old_slots = indices % self.capacity
+        new_slots = indices % capacity
+        for name, column in self.columns.items():
+            new_column = self._empty_column(column.dtype, capacity)
+            new_column[new_slots] = column[old_slots]
+            self.columns[name] = new_column
+        valid = np.zeros(capacity, dtype=bool)
+        valid[new_slots] = self._valid[old_slots]
+        self._valid = valid
+
+    def _clear_slot(self, slot):
+        self._valid[slot] = False
+        self._live -= 1
+        for name, column in self.columns.items():
+            if column.dtype == object:
+                column[slot] = None
+
+    def expire(self, cutoff):
+        """Drops rows, starting from the oldest, until reaching a live row
+        with timestamp at or after cutoff. Returns number of rows expired.
+        """
+        timestamps = self.columns['timestamp']
+        expired = 0
+        while self._tail < self._head:
+            slot = self._slot(self._tail)
+            if self._valid[slot]:
+                if timestamps[slot] >= cutoff:
+                    break
+                self._clear_slot(slot)
+                expired += 1
+            self._tail += 1
+        self._expired += expired
+        self.time_index.trim(self.time_key(cutoff))
+        return expired
+
+    def append(self, data):
+        """Stores a row (list in header order) and returns its index, first
+        expiring rows that fall outside the retention window.
+        """
+        timestamp = float(data[self._timestamp_position])
+        self.expire(timestamp - self.retention)
+        if self._head - self._tail == self.capacity:
+            self._resize(2 * self.capacity)
+            self._grown += 1
+        index = self._head
+        self._head += 1
+        self._write(self._slot(index), data)
+        self.time_index.insert(self.time_key(timestamp), index)
+        return index
+
+    def extend(self, columns):
+        """Stores many rows at once and returns array of their indices,
+        first expiring rows that fall outside the retention window of the
+        newest row.
+        """
+        count = self._column_count(columns)
+        if count == 0:
+            return np.arange(0)
+        timestamps = np.asarray(columns['timestamp'], dtype=np.float64)
+        self.expire(timestamps.max() - self.retention)
+        while self._head - self._tail + count > self.capacity:
+            self._resize(2 * self.capacity)
+            self._grown += 1
+        indices = np.arange(self._head, self._head + count)
+        self._head += count
+        self._write_columns(indices % self.capacity, columns)
+        self.time_index.extend(map(self.time_key, timestamps.tolist()),
+                               indices.tolist())
+        return indices
+
+    def asof(self, timestamp):
+        """Returns index of the latest row at or before timestamp, or None."""
+        return self.time_index.asof(self.time_key(timestamp))
+
+    def nearest(self, timestamp):
+        """Returns index of the latest row at or before timestamp, falling back
+        to the earliest row after it. Returns None if the table is empty.
+        """
+        key = self.time_key(timestamp)
+        index = self.time_index.asof(key)
+        if index is None:
+            index = self.time_index.after(key)
+        return index
+
+    def window(self, start, end):
+        """Returns indices of rows with timestamps in [start, end], oldest
+        first.
+        """
+        return self.time_index.window(self.time_key(start), self.time_key(end))
+
+    def remove(self, index):
+        """Marks a row as removed before it would expire. The hole is
+        reclaimed when the oldest end of the ring passes it (see expire() and
+        compact()).
+        """
+        if not self.is_valid(index):
+            return
+        self._clear_slot(self._slot(index))
+        self._removed_since_compaction += 1
+
+    def is_valid(self, index):
+        return (self._tail <= index < self._head and
+                bool(self._valid[self._slot(index)]))
+
+    def valid_mask(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        in_window = (indices >= self._tail) & (indices < self._head)
+        return in_window & self._valid[self._slot(indices)]
+
+    def valid_indices(self):
+        indices = np.arange(self._tail, self._head)
+        return indices[self._valid[indices % self.capacity]]
+
+    def column(self, name):
+        """Returns column values for all rows in the window, oldest first."""
+        return self.take(name, np.arange(self._tail, self._head))
+
+    def fragmentation(self):
+        """Fraction of rows in the window that have been removed."""
+        window = self._head - self._tail
+        if window == 0:
+            return 0.
+        return (window - self._live) / window
+
+    def needs_compaction(self, threshold):
+        """Whether rows removed since the last compaction make up more than
+        threshold of the window. Counting removals since the last compaction,
+        rather than holes, means a window whose oldest row stays live is not
+        compacted again on every call.
+        """
+        window = self._head - self._tail
+        return (self._removed_since_compaction > 0 and
+                self._removed_since_compaction > threshold * window)
+
+    def compact(self):
+        """Advances the oldest end of the ring past removed rows. Returns the
+        number of slots reclaimed.
+        """
+        self._removed_since_compaction = 0
+        start = self._tail
+        while self._tail < self._head and not self._valid[self._slot(self._tail)]:
+            self._tail += 1
+        reclaimed = self._tail - start
+        if reclaimed:
+            self._compactions += 1
+            self._rows_reclaimed += reclaimed
+        return reclaimed
+
+    @property
+    def oldest_index(self):
+        """Index of the oldest row that may still be live. Every row before it
+        has expired or been removed.
+        """
+        return self._tail
+
+    def stats(self):
+        """Returns dictionary of allocation statistics for the table."""
+        stats = ColumnTable.stats(self)
+        stats.update({'length': self._head - self._tail,
+                      'free': self.capacity - self._live,
+                      'oldest_index': self._tail,
+                      'expired': self._expired,
+                      'grown': self._grown})
+        return stats
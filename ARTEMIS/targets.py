@@ -1,6 +1,11 @@
-from datetime import datetime
+from bisect import bisect_left
+from contextlib import contextmanager
 import math
+import numpy as np
 import config
+import timeutil
+from timeutil import delta_t_in_seconds
+from storage import ColumnTable, ReadWriteLock, TimeWindowTable, grow_rows
 
 
 headers = {}
@@ -13,37 +18,310 @@ headers['nims'] = ['timestamp', 'id', 'pings_visible', 'first_ping',
         'last_pos_bearing', 'last_pos_range', 'aggregate_indices']
 headers['classifier'] = config.classifier_features
 
+# Rules used to combine NIMS pings of the same track into a single entry
+_min_columns = ['first_ping', 'min_angle_m', 'min_range_m']
+_max_columns = ['timestamp', 'pings_visible', 'max_angle_m', 'max_range_m']
+_mean_columns = ['target_strength', 'width', 'height', 'size_sq_m', 'speed_mps']
+_last_columns = ['last_pos_bearing', 'last_pos_range']
+
+def source_weight(source):
+    """Returns weight of votes of a classifier target with given source.
+
+    Targets from the current site (config.site_name) count more than those
+    from previous deployments, and manually reviewed targets more than
+    automatic classifications. Sources not formatted as site_manual or
+    site_auto get weight 1.
+    """
+    if source.startswith(config.site_name):
+        if source.endswith('manual'):
+            return 1.
+        elif source.endswith('auto'):
+            return 0.9
+    else:
+        if source.endswith('manual'):
+            return 0.9
+        elif source.endswith('auto'):
+            return 0.8
+    return 1.
+
+class RunningAggregate:
+    """Running summary of the NIMS pings that make up one track.
+
+    Keeps the minimum, maximum, running mean (sum and count) and last value of
+    each column, along with the indices of the pings folded in, so adding
+    pings costs O(number of new pings) rather than O(pings in track). Indices
+    of pings that have expired from the table are dropped (see drop_before),
+    so they cover at most the table's retention window.
+    """
+    __slots__ = ('count', 'track_id', 'values', 'totals', 'indices')
+
+    def __init__(self):
+        self.count = 0
+        self.track_id = None
+        self.values = {}
+        self.totals = {}
+        self.indices = []
+
+    def fold(self, table, indices):
+        """Folds rows of table at indices into the aggregate. Expects indices
+        to be in order of read, that is, last entry is the latest.
+        """
+        if len(indices) == 0:
+            return
+        rows = np.asarray(indices, dtype=np.int64)
+        ids = table.take('id', rows)
+        track_id = ids[0] if self.track_id is None else self.track_id
+        if np.any(ids != track_id):
+            raise ValueError("Internal errror. All ids " \
+                    "in combine_entries are expected to match.")
+        self.track_id = track_id
+        for name in _min_columns:
+            value = table.take(name, rows).min()
+            self.values[name] = value if self.count == 0 else min(self.values[name], value)
+        for name in _max_columns:
+            value = table.take(name, rows).max()
+            self.values[name] = value if self.count == 0 else max(self.values[name], value)
+        for name in _mean_columns:
+            self.totals[name] = self.totals.get(name, 0.) + table.take(name, rows).sum()
+        for name in _last_columns:
+            self.values[name] = table.take(name, rows[-1:])[0]
+        self.count += len(rows)
+        self.indices.extend(indices)
+
+    def drop_before(self, index):
+        """Drops indices of pings before index, in increasing order like the
+        rows of a TimeWindowTable.
+        """
+        end = bisect_left(self.indices, index)
+        if end:
+            del self.indices[:end]
+
+    def entry(self, table_headers):
+        """Returns combined entry as a list in order of table_headers."""
+        entry = []
+        for name in table_headers:
+            if name == 'id':
+                entry.append(self.track_id)
+            elif name in self.totals:
+                entry.append(self.totals[name] / self.count)
+            elif name == 'aggregate_indices':
+                # a copy, as stored entries must not change with later pings
+                entry.append(list(self.indices))
+            else:
+                entry.append(self.values[name])
+        return entry
+
 def _get_minutes_since_midnight(timestamp):
-    """"""
-    return min(timestamp.hour*60 + timestamp.minute,
-        60*24 - (timestamp.hour*60 + timestamp.minute))
+    """Minutes from the nearest midnight (UTC) for epoch timestamp(s)."""
+    minutes = timeutil.seconds_since_midnight(timestamp) // 60
+    return np.minimum(minutes, 60*24 - minutes)
+
+def transform_NIMS_to_vectors(ranges, bearings):
+    """
+    Transform NIMS detections (ranges, and bearings in degrees) to earth
+    coordinates (East-North). Array version of Target.transform_NIMS_to_vector.
+
+    Returns arrays of X and Y coordinates.
+    """
+    # shift bearing such that zero degrees is center of swath, then convert to
+    # angle from due N by subtracting AMP angle
+    heading = (np.radians(np.asarray(bearings, dtype=np.float64) -
+                          (config.M3_swath[1] - config.M3_swath[0])/2)
+               - config.AMP_heading)
+    ranges = np.asarray(ranges, dtype=np.float64)
+    return ranges * np.cos(heading), ranges * np.sin(heading)
+
+def _select_deltav_points(timestamps, averaging_time):
+    """Returns positions of the (sorted) timestamps between which velocity is
+    calculated: the first ping, each ping at least averaging_time after the
+    previously selected one, and the last ping.
+    """
+    selected = [0]
+    while True:
+        position = np.searchsorted(timestamps,
+                                   timestamps[selected[-1]] + averaging_time)
+        if position >= len(timestamps):
+            break
+        selected.append(position)
+    if selected[-1] != len(timestamps) - 1:
+        selected.append(len(timestamps) - 1)
+    return np.asarray(selected, dtype=np.int64)
+
+def calculate_deltav_batch(timestamps, ranges, bearings, track_starts,
+                           adcp_speeds, adcp_headings,
+                           averaging_time=config.M3_avgeraging_time):
+    """
+    Calculates maximum delta_v (see Target.calculate_deltav) for one or many
+    tracks at once.
+
+    Parameters
+    ----------
+    timestamps, ranges, bearings : array-like
+        Ping timestamps (epoch seconds), last_pos_range and last_pos_bearing
+        of all tracks, stored back to back.
+    track_starts : array-like of int
+        Position in the ping arrays where each track starts.
+    adcp_speeds, adcp_headings : array-like
+        ADCP current speed and heading (radians from North) for each track.
+    averaging_time : float, optional
+        Minimum time between pings used to calculate target velocity.
+
+    Returns
+    -------
+    deltav : array of shape [n_tracks]
+        Maximum delta_v of each track, 0 for tracks with fewer than two pings.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    track_starts = np.asarray(track_starts, dtype=np.int64)
+    track_ends = np.append(track_starts[1:], len(timestamps))
+    deltav = np.zeros(len(track_starts))
+
+    # pairs of consecutive selected pings, and the track each belongs to
+    first, second, pair_tracks = [], [], []
+    for track, (start, end) in enumerate(zip(track_starts, track_ends)):
+        if end - start < 2:
+            continue
+        order = start + np.argsort(timestamps[start:end], kind='stable')
+        selected = order[_select_deltav_points(timestamps[order], averaging_time)]
+        first.append(selected[:-1])
+        second.append(selected[1:])
+        pair_tracks.append(np.full(len(selected) - 1, track))
+    if not first:
+        return deltav
+    first = np.concatenate(first)
+    second = np.concatenate(second)
+    pair_tracks = np.concatenate(pair_tracks)
+
+    east, north = transform_NIMS_to_vectors(ranges, bearings)
+    dt = timestamps[second] - timestamps[first]
+    usable = dt > 0  # no time elapsed, velocity undefined
+    first, second, pair_tracks, dt = (first[usable], second[usable],
+                                      pair_tracks[usable], dt[usable])
+
+    adcp_speeds = np.asarray(adcp_speeds, dtype=np.float64)
+    adcp_headings = np.asarray(adcp_headings, dtype=np.float64)
+    velocity_diff_east = ((east[second] - east[first]) / dt -
+                          (adcp_speeds * np.cos(adcp_headings))[pair_tracks])
+    velocity_diff_north = ((north[second] - north[first]) / dt -
+                           (adcp_speeds * np.sin(adcp_headings))[pair_tracks])
+    np.maximum.at(deltav, pair_tracks,
+                  np.hypot(velocity_diff_east, velocity_diff_north))
+    return deltav
 
 class Target:
-    """"""
-    def __init__(self, target_space, source="Unknown", firstseen=datetime.utcnow(),
-                 lastseen=datetime.utcnow(), classification=None, indices={}):
+    """A detected target, referencing its entries in a TargetSpace by index.
+
+    Decoded entries are cached per table and reused until the Target's index
+    for that table changes, the entry is removed, or the table rewrites a row.
+
+    A Target may be paired with several PAMGuard detections. All of their
+    indices are kept in pamguard_indices (oldest first), and
+    indices['pamguard'] refers to the latest.
+
+    track_id is the NIMS track id, kept on the Target because the track's
+    rows may expire from the nims table before the Target does. For the same
+    reason, features holds the classifier features the Target was last
+    classified with.
+    """
+    __slots__ = ('target_space', 'source', 'firstseen', 'lastseen',
+                 'classification', 'features', 'indices', 'pamguard_indices',
+                 'track_id', '_entry_cache')
+
+    def __init__(self, target_space, source="Unknown", firstseen=None,
+                 lastseen=None, classification=None, indices=None,
+                 track_id=None):
         self.target_space = target_space
+        self.track_id = track_id
         self.source = source
-        self.firstseen = firstseen
-        self.lastseen = lastseen
+        self.firstseen = timeutil.now() if firstseen is None else firstseen
+        self.lastseen = timeutil.now() if lastseen is None else lastseen
         self.classification = classification
-        self.indices = indices
+        self.features = None
+        self.indices = {} if indices is None else indices
+        pamguard = self.indices.get('pamguard')
+        self.pamguard_indices = [] if pamguard is None else [pamguard]
+        self._entry_cache = {}
 
     def get_entry(self, table):
-        """Returns dictionary of table headers and values for given table."""
+        """Returns dictionary of table headers and values for given table.
+        The dictionary is shared with the cache and should not be modified.
+        """
         if table not in headers or table not in self.target_space.tables:
             raise ValueError("{0} is an invalid table name. Valid inputs are " \
                     "'classifier_{features,classifications} or data stream " \
                     "name.".format(table))
-        elif self.indices.get(table) != None:
-            return dict(zip(headers[table],
-                            self.target_space.tables[table][self.indices[table]]))
+        index = self.indices.get(table)
+        if index is None:
+            return None
+        storage = self.target_space.tables[table]
+        with self.target_space.locked(reads=[table]):
+            cached = self._entry_cache.get(table)
+            if (cached is not None and cached[0] == index and
+                    cached[1] == storage.rewrites and storage.is_valid(index)):
+                return cached[2]
+            entry = self.target_space.get_entry_by_index(table, index)
+            if entry is None:
+                self._entry_cache.pop(table, None)
+                return None
+            entry = dict(entry)
+            self._entry_cache[table] = (index, storage.rewrites, entry)
+        return entry
+
+    def has_entry(self, table):
+        """Returns whether the Target has a live entry in table."""
+        index = self.indices.get(table)
+        return index is not None and self.target_space.tables[table].is_valid(index)
 
     def get_entry_value(self, table, key):
-        """Returns specific value from Target.get_entry() to avoid None issues."""
-        entry = self.get_entry(table)
-        if entry != None and key in entry:
-            return entry.get(key)
+        """Returns specific value from Target.get_entry() to avoid None issues.
+
+        Reads the value straight from the table unless the entry is cached.
+        """
+        index = self.indices.get(table)
+        if index is None:
+            return None
+        cached = self._entry_cache.get(table)
+        if cached is not None and cached[0] == index:
+            entry = self.get_entry(table)  # revalidates the cached entry
+            return None if entry is None else entry.get(key)
+        return self.target_space.get_entry_value_by_index(table, index, key)
+
+    @property
+    def timestamp(self):
+        """Timestamp of the latest NIMS detection, or of the PAMGuard
+        detection for acoustic-only targets.
+        """
+        timestamp = self.get_entry_value('nims', 'timestamp')
+        if timestamp is None:
+            timestamp = self.get_entry_value('pamguard', 'timestamp')
+        return timestamp
+
+    @property
+    def min_range_m(self):
+        """Minimum range (m) at which NIMS detected the target."""
+        return self.get_entry_value('nims', 'min_range_m')
+
+    @property
+    def current_speed(self):
+        """Current speed (m/s) from the ADCP reading valid for the target."""
+        adcp = self.get_adcp_entry()
+        if adcp is not None:
+            return adcp['speed']
+
+    def get_adcp_entry(self):
+        """Returns the ADCP entry valid at the Target's latest NIMS detection,
+        falling back to the ADCP entry staged with the Target. The entry is a
+        copy, taken under the adcp read lock.
+        """
+        timestamp = self.get_entry_value('nims', 'timestamp')
+        if timestamp is not None:
+            with self.target_space.locked(reads=['adcp']):
+                index = self.target_space.get_index_nearest('adcp', timestamp)
+                if index is not None:
+                    entry = self.target_space.get_entry_by_index('adcp', index)
+                    if entry is not None:
+                        return dict(entry)
+        return self.get_entry('adcp')
 
     def update_entry(self, table, indices):
         """Rules to update an existing target entry with
@@ -51,26 +329,29 @@ class Target:
         returns nothing otherwise.
 
         NIMS records list of indices from which it is derived
-        in 'aggregate_indices' field.
+        in 'aggregate_indices' field. New pings are folded into the
+        track's running aggregate (see TargetSpace.aggregate_entries), or
+        start a new one if the Target's nims entry has been removed.
         """
         if table == 'nims':
-            old_entry_index = self.indices[table]
-            old_aggs = self.target_space.tables[table][old_entry_index][-1]
-            assert(old_aggs != None)
-            indices.extend(old_aggs)
-            new_entry = self.target_space.combine_entries(table, indices)
-            self.target_space.tables[table][old_entry_index] = new_entry
+            self.indices[table] = self.target_space.aggregate_entries(
+                    table, indices, self.indices.get(table))
 
-    def get_classifier_features(self):
-        """Uses Target's data stream entries to update classifier tables."""
+    def get_classifier_features(self, deltav=None):
+        """Uses Target's data stream entries to update classifier tables.
 
+        deltav may be passed in if already calculated (see
+        TargetSpace.calculate_deltav).
+        """
+        if deltav is None:
+            deltav = self.calculate_deltav()
 
         return [self.get_entry_value('nims', 'size_sq_m'),  # size
                 self.get_entry_value('nims', 'speed_mps'),  # speed
-                self.calculate_deltav(),  # deltav
+                deltav,  # deltav
                 self.get_entry_value('nims','target_strength'),  # target_strength
                 _get_minutes_since_midnight(self.get_entry_value('nims','timestamp')),  # time_of_day
-                self.get_entry_value('adcp', 'speed')]  # current
+                self.get_adcp_entry()['speed']]  # current
 
     def calculate_deltav(self):
         """
@@ -85,18 +366,22 @@ class Target:
         ping at 10 Hz for 5 seconds, the velocity would be calculated 5 times.
 
         The most recent ADCP data at the time of target detection is used to
-        calculate delta_v.
+        calculate delta_v. See TargetSpace.calculate_deltav to compute delta_v
+        for many targets at once.
+        """
+        return float(self.target_space.calculate_deltav([self])[0])
+
+    def calculate_deltav_scalar(self):
+        """
+        Reference implementation of calculate_deltav, one ping at a time.
+        Kept to check the batched implementation against.
         """
         # extract target data
         nims_indices = self.get_entry('nims')['aggregate_indices']
         if len(nims_indices) > 1:
 
             #("calculating deltav for: ", nims_indices)
-            adcp = self.get_entry('adcp')
-
-            # sort nims data by timestamp
-            #nims_indices = sorted(nims_indices,
-            #       key = lambda x: self.target_space.get_entry_by_index('nims', x)['timestamp'])
+            adcp = self.get_adcp_entry()
 
             # extract all targets from nims data
             targets = self.extract_targets(nims_indices)
@@ -109,19 +394,19 @@ class Target:
             for i, target in enumerate(targets):
                 # add to points_to_avg if the difference in time between
                 # target sightings is greater than the M3_averaging_time
-                diff = self.delta_t_in_seconds(target['timestamp'], start_time)
+                diff = delta_t_in_seconds(target['timestamp'], start_time)
 
                 if diff >= config.M3_avgeraging_time:
                     points_to_avg.append(targets[i])
                     index = i
                     start_time = targets[index]['timestamp']
 
-                if i >= (len(targets)-1):
+                if i >= (len(targets)-1) and index != i:
                     points_to_avg.append(targets[i])
                     index = i
 
             delta_v = self.calc_delta_v(points_to_avg, adcp)
-            return max(delta_v)
+            return max(delta_v) if delta_v else 0
         else:
             # should calculate first ping using NIMS velocity
             return 0
@@ -142,7 +427,7 @@ class Target:
 
         point1_cartesian = self.transform_NIMS_to_vector(point1)
         point2_cartesian = self.transform_NIMS_to_vector(point2)
-        dt = self.delta_t_in_seconds(point1['timestamp'], point2['timestamp'])
+        dt = delta_t_in_seconds(point1['timestamp'], point2['timestamp'])
         # subtract 2-1 to get velocity
         vel = [(point2_cartesian[0] - point1_cartesian[0])/dt,
                (point2_cartesian[1] - point1_cartesian[1])/dt]
@@ -169,27 +454,17 @@ class Target:
         return(point_cartesian)
 
 
-    def delta_t_in_seconds(self, datetime1, datetime2):
-        """
-        calculate delta t in seconds between two datetime objects
-        (returns absolute value, so order of dates is insignifigant)
-        """
-        delta_t = datetime1 - datetime2
-        days_s = delta_t.days*(86400)
-        microseconds_s = delta_t.microseconds/1000000
-        delta_t_s = days_s + delta_t.seconds + microseconds_s
-
-        return abs(delta_t_s)
-
-
     def extract_targets(self, nims_indices):
         """
         Extract all targets from nims data
         """
 
         targets = []
-        for index in nims_indices:
-            targets.append(self.target_space.get_entry_by_index('nims', index))
+        with self.target_space.locked(reads=['nims']):
+            for index in nims_indices:
+                entry = self.target_space.get_entry_by_index('nims', index)
+                if entry is not None:  # skip pings expired from the table
+                    targets.append(dict(entry))
 
         return targets
 
@@ -212,6 +487,9 @@ class Target:
             except:
                 break
 
+            if point1['timestamp'] == point2['timestamp']:
+                continue  # no time elapsed, velocity undefined
+
             # velocity of target between point 1 and point 2
             velocity_target = self.velocity_between_two_points(point1, point2)
             # difference between target and adcp velocity
@@ -220,97 +498,302 @@ class Target:
             # "delta_v" is magnitude of velocity difference
             delta_v.append((velocity_diff[0]**2 + velocity_diff[1]**2)**0.5)
 
-            return(delta_v)
+        return(delta_v)
 
 
 class TargetSpace:
-    """"""
+    """Tables of data stream entries and classifier features.
+
+    The comms threads, the stage thread and the classification processor all
+    share one TargetSpace, so each table has a ReadWriteLock. Methods below
+    take the locks they need; code reaching into self.tables directly should
+    hold them via locked().
+    """
     def __init__(self, data_streams=config.data_streams):
         self.targets = []
         self.tables = {}
         for stream in data_streams:
-            self.tables[stream] = []
+            if stream in headers:
+                retention = config.data_stream_retention.get(stream,
+                        config.drop_target_time + config.pamguard_association_window
+                        + config.data_stream_retention_margin)
+                # 25% headroom for bursts and combined nims entries
+                capacity = max(int(1.25 * config.data_stream_rates[stream] * retention), 16)
+                self.tables[stream] = TimeWindowTable(headers[stream], retention,
+                                                      capacity)
+            else:
+                # no headers defined for stream yet, nothing to store
+                self.tables[stream] = []
         self.tables['classifier_features'] = []
         self.tables['classifier_classifications'] = []
         self.classifier_index_to_target = {}
+        # classified targets that could not be stored, having no features
+        self.classifier_targets_dropped = 0
+        # source_weight() of each classifier row, growing with the tables
+        self._classifier_source_weights = np.empty(0)
+        # running aggregates of nims tracks, by index of combined entry
+        self.aggregates = {}
+        self.locks = {name: ReadWriteLock() for name in self.tables}
+
+    def __deepcopy__(self, memo):
+        # shared by every thread, so a deep copy of an object holding it (e.g.
+        # sklearn.base.clone of a classifier) refers to the same one
+        return self
+
+    @contextmanager
+    def locked(self, reads=(), writes=()):
+        """Holds read locks on tables in reads and write locks on tables in
+        writes. Locks are always taken in order of table name so that threads
+        cannot deadlock.
+        """
+        names = sorted(set(reads) | set(writes))
+        acquired = []
+        try:
+            for name in names:
+                if name in writes:
+                    self.locks[name].acquire_write()
+                else:
+                    self.locks[name].acquire_read()
+                acquired.append(name)
+            yield
+        finally:
+            for name in reversed(acquired):
+                self.locks[name].release()
+
+    def lock_stats(self):
+        """Returns contention counters for each table lock."""
+        return {name: lock.stats() for name, lock in self.locks.items()}
+
+    def classifier_snapshot(self, start=0):
+        """Returns copies of the classifier feature and classification
+        tables from row start on, taken together, for readers that should not
+        hold the locks.
+        """
+        with self.locked(reads=['classifier_features',
+                                'classifier_classifications']):
+            return (self.tables['classifier_features'][start:],
+                    self.tables['classifier_classifications'][start:])
+
+    def get_classifier_source_weights(self):
+        """Returns array of the source weight of each classifier row."""
+        with self.locked(reads=['classifier_features']):
+            return self._classifier_source_weights[
+                    :len(self.tables['classifier_features'])]
+
+    def append_classifier_rows(self, targets, features, classifications):
+        """Appends features and classification of each of targets to the
+        classifier tables. Returns list of their classifier indices.
+        """
+        with self.locked(writes=['classifier_features',
+                                 'classifier_classifications']):
+            start = len(self.tables['classifier_features'])
+            self.tables['classifier_features'].extend(features)
+            self.tables['classifier_classifications'].extend(classifications)
+            weights = grow_rows(self._classifier_source_weights,
+                                start + len(targets))
+            weights[start:start + len(targets)] = [source_weight(target.source)
+                                                   for target in targets]
+            self._classifier_source_weights = weights
+            indices = list(range(start, start + len(targets)))
+            for target, index in zip(targets, indices):
+                target.indices['classifier'] = index
+                self.classifier_index_to_target[index] = target
+        return indices
 
     def append_entry(self, table, data):
-        for i, entry in enumerate(self.tables[table]):
-            if entry == []:
-                self.tables[table][i] = data
-                return i
-        else:
-            self.tables[table].append(data)
-            return len(self.tables[table]) - 1
+        """Stores data (list in order of table headers), returns its index."""
+        with self.locked(writes=[table]):
+            return self.tables[table].append(data)
+
+    def append_entries(self, table, columns):
+        """Stores many rows at once. columns maps each of the table headers to
+        a sequence of values, one per row. Returns array of row indices.
+        """
+        with self.locked(writes=[table]):
+            return self.tables[table].extend(columns)
 
     def get_entry_by_index(self, table, index):
-        """Returns dictionary of table headers and values for given index."""
+        """Returns view of table headers and values for given index, or None
+        if the entry has been removed.
+        """
         if table not in headers or table not in self.tables:
             raise ValueError("{0} is an invalid table name. Valid inputs are " \
                     "'classifier_{features,classifications}' or data stream " \
                     "name.".format(table))
-        elif index < 0 or index >= len(self.tables[table]):
-            raise ValueError("Invalid table index {0}. {1} table is of length" \
-                    " {2}.".format(index, table, len(self.tables[table])))
-        else:
-            return dict(zip(headers[table], self.tables[table][index]))
+        with self.locked(reads=[table]):
+            if index < 0 or index >= len(self.tables[table]):
+                raise ValueError("Invalid table index {0}. {1} table is of length" \
+                        " {2}.".format(index, table, len(self.tables[table])))
+            elif self.tables[table].is_valid(index):
+                return self.tables[table][index]
 
     def get_entry_value_by_index(self, table, index, key):
         """Returns value for specific key in table entry."""
+        if isinstance(self.tables.get(table), ColumnTable):
+            with self.locked(reads=[table]):
+                return self.tables[table].get_value(index, key)
         entry = self.get_entry_by_index(table, index)
         if entry != None and key in entry:
             return entry.get(key)
 
+    def calculate_deltav(self, targets):
+        """Returns array of maximum delta_v for each of targets, calculated in
+        one batch (see calculate_deltav_batch). Pings that have expired from
+        the nims table are left out.
+        """
+        table = self.tables['nims']
+        chunks, track_starts, adcp_speeds, adcp_headings = [], [], [], []
+        position = 0
+        with self.locked(reads=['nims', 'adcp']):
+            for target in targets:
+                indices = np.asarray(target.get_entry_value('nims', 'aggregate_indices')
+                                     or [], dtype=np.int64)
+                indices = indices[table.valid_mask(indices)]
+                chunks.append(indices)
+                track_starts.append(position)
+                position += len(indices)
+                adcp = target.get_adcp_entry()
+                # without any ADCP data, treat current as still water
+                adcp_speeds.append(adcp['speed'] if adcp is not None else 0.)
+                adcp_headings.append(adcp['heading'] if adcp is not None else 0.)
+            rows = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+            timestamps = table.take('timestamp', rows)
+            ranges = table.take('last_pos_range', rows)
+            bearings = table.take('last_pos_bearing', rows)
+        return calculate_deltav_batch(timestamps, ranges, bearings,
+                                      track_starts, adcp_speeds, adcp_headings)
+
+    def get_index_asof(self, table, timestamp):
+        """Returns index of the latest entry at or before timestamp, or None."""
+        with self.locked(reads=[table]):
+            return self.tables[table].asof(timestamp)
+
+    def get_index_nearest(self, table, timestamp):
+        """Returns index of the latest entry at or before timestamp. If there
+        is none, returns the earliest entry after timestamp (or None if the
+        table is empty).
+        """
+        with self.locked(reads=[table]):
+            return self.tables[table].nearest(timestamp)
+
+    def get_values_by_indices(self, table, key, indices):
+        """Returns array of key values for entries at indices."""
+        with self.locked(reads=[table]):
+            return self.tables[table].take(key, indices)
+
+    def get_indices_in_window(self, table, start, end):
+        """Returns indices of entries with timestamps between start and end
+        (inclusive), oldest first.
+        """
+        with self.locked(reads=[table]):
+            return self.tables[table].window(start, end)
+
     def combine_entries(self, table, indices):
         """Expects indices to be in order of read. That is, last
         entry is the latest in the list.
         """
-        combined_entry = []
-        for column_index, column_name in enumerate(headers[table]):
-            values = []
-            for index in indices:
-                values.append(self.tables[table][index][column_index])
-
-            if column_name in ['first_ping', 'min_angle_m', 'min_range_m']:
-                combined_entry.append(min(values))
-            elif column_name in ['timestamp', 'pings_visible', 'max_angle_m', 'max_range_m']:
-                combined_entry.append(max(values))
-            elif column_name in ['id']:
-                if len(set(values)) > 1:
-                    raise ValueError("Internal errror. All ids " \
-                            "in combine_entries are expected to match.")
-                combined_entry.append(values[0])
-            elif column_name in ['target_strength', 'width', 'height',
-                                 'size_sq_m', 'speed_mps']:
-                combined_entry.append(sum(values) / float(len(values)))
-            elif column_name in ['last_pos_bearing', 'last_pos_range']:
-                combined_entry.append(values[len(values) - 1])
-            elif column_name == 'aggregate_indices':
-                combined_entry.append(indices)
-        return combined_entry
+        aggregate = RunningAggregate()
+        with self.locked(reads=[table]):
+            aggregate.fold(self.tables[table], indices)
+        return aggregate.entry(headers[table])
+
+    def aggregate_entries(self, table, indices, index=None):
+        """Folds entries at indices into the running aggregate whose combined
+        entry is at index, or into a new aggregate if index is None.
+
+        The updated combined entry is stored as a new row (and the old one
+        removed) so it is not expired along with the oldest pings of the
+        track. Returns index of the combined entry.
+        """
+        with self.locked(writes=[table]):
+            aggregate = self.aggregates.pop(index, None)
+            if aggregate is None:
+                aggregate = RunningAggregate()
+                if index is not None:
+                    # combined entry was not built here, rebuild from its pings
+                    old_indices = self.get_entry_value_by_index(table, index,
+                            'aggregate_indices') or []
+                    aggregate.fold(self.tables[table],
+                            [i for i in old_indices if self.tables[table].is_valid(i)])
+            aggregate.fold(self.tables[table], indices)
+            aggregate.drop_before(self.tables[table].oldest_index)
+            new_index = self.append_entry(table, aggregate.entry(headers[table]))
+            if index is not None:
+                self.tables[table].remove(index)
+            self.aggregates[new_index] = aggregate
+        return new_index
+
+    def get_classifier_features(self, targets):
+        """Returns list of classifier features for each of targets, with
+        delta_v calculated for all targets in one batch.
+        """
+        deltav = self.calculate_deltav(targets)
+        return [target.get_classifier_features(deltav=target_deltav)
+                for target, target_deltav in zip(targets, deltav)]
 
     def update_classifier_tables(self, target):
         """Permanently store recently classified features and classifications."""
-        # WARNING: get_classifier_features() recalculates the features based on
-        #   the current table entries. It could (but shouldn't) be that a target
-        #   is classified, more target data arrives, but the target was never
-        #   reclassified before old targets are removed. This means that we'd
-        #   store updated features but with an old classification.
-        #   A potential solution may be to store the number of pings used to
-        #   create classification features from agg_indices.
-        self.tables['classifier_features'].append(target.get_classifier_features())
-        self.tables['classifier_classifications'].append(target.classification)
-        index = len(self.tables['classifier_features']) - 1
-        target.indices['classifier'] = index
-        self.classifier_index_to_target[index] = target
+        self.update_classifier_tables_batch([target])
+
+    def update_classifier_tables_batch(self, targets):
+        """Permanently store features and classifications of targets.
+
+        Targets are stored with the features they were classified with (see
+        Target.features), so the stored row matches its classification even
+        if more pings arrived or the nims rows expired since. Features of
+        targets classified without recording them are calculated from their
+        nims entry. Targets that were never classified have no label and are
+        skipped, and classified targets with neither are counted in
+        classifier_targets_dropped.
+        """
+        targets = [target for target in targets
+                   if target.classification is not None]
+        recalculate = [target for target in targets
+                       if target.features is None and target.has_entry('nims')]
+        for target, features in zip(recalculate,
+                                    self.get_classifier_features(recalculate)):
+            target.features = features
+        dropped = [target for target in targets if target.features is None]
+        if dropped:
+            self.classifier_targets_dropped += len(dropped)
+            print('Dropped {0} classified targets without classifier ' \
+                  'features'.format(len(dropped)))
+            targets = [target for target in targets
+                       if target.features is not None]
+        self.append_classifier_rows(targets,
+                                    [target.features for target in targets],
+                                    [target.classification for target in targets])
 
     def update(self, target):
         """
         remove old targets from target space
         """
-        self.remove_old_nims(target)
-        self.remove_old_pamguard(target)
-        self.remove_old_adcp()
+        self.update_batch([target])
+
+    def update_batch(self, targets):
+        """
+        remove old targets from target space
+
+        Data stream rows also expire on their own once they are older than
+        the table's retention window, so ADCP needs no explicit cleanup.
+        """
+        for target in targets:
+            self.remove_old_nims(target)
+            self.remove_old_pamguard(target)
+        for name, table in self.tables.items():
+            if isinstance(table, TimeWindowTable):
+                with self.locked(writes=[name]):
+                    if table.needs_compaction(config.table_compaction_threshold):
+                        table.compact()
+
+    def table_stats(self):
+        """Returns allocation statistics for each data stream table."""
+        stats = {}
+        for name, table in self.tables.items():
+            if isinstance(table, ColumnTable):
+                with self.locked(reads=[name]):
+                    stats[name] = table.stats()
+        return stats
 
     def remove_old_nims(self, target):
         """
@@ -319,37 +802,25 @@ class TargetSpace:
         """
         # remove all targets with nims that have not been seen
         # for drop_target_time seconds
-        indices = target.get_entry_value('nims', 'aggregate_indices')
-        indices.append(target.indices['nims'])
+        if target.indices.get('nims') is None:
+            return  # acoustic-only target
+        with self.locked(writes=['nims']):
+            indices = target.get_entry_value('nims', 'aggregate_indices') or []
 
-        for index in sorted(indices, reverse = True):
-            self.tables['nims'][index] = []
+            for index in indices:
+                self.tables['nims'].remove(index)
+            self.tables['nims'].remove(target.indices['nims'])
 
-        target.indices.pop('nims')
+            self.aggregates.pop(target.indices.pop('nims'), None)
 
     def remove_old_pamguard(self, target):
         """
-        Remove pamguard data older than drop_target_time. Update minimum
-        time of all targets (to avoid dropping relevant ADCP data)
-        """
-        if target.get_entry('pamguard') != None:
-            if self.delta_t_in_seconds(datetime.now(), target.get_entry_value('pamguard', 'timestamp')) >= config.drop_target_time:
-                self.tables['pamguard'][target.indices['pamguard']] = []
-
-    def remove_old_adcp(self):
-        """
-        remove all adcp data except for the most recent entry
-        """
-        self.tables['adcp'] = [self.tables['adcp'][-1]]
-
-    # this function is already in code...import?
-    def delta_t_in_seconds(self, datetime1, datetime2):
-        """
-        calculate delta t in seconds between two datetime objects
-        (returns absolute value, so order of dates is insignifigant)
+        Remove pamguard detections of target older than drop_target_time.
         """
-        delta_t = datetime1 - datetime2
-        days_s = delta_t.days*(86400)
-        microseconds_s = delta_t.microseconds/1000000
-        delta_t_s = days_s + delta_t.seconds + microseconds_s
-        return abs(delta_t_s)
+        with self.locked(writes=['pamguard']):
+            table = self.tables['pamguard']
+            for index in target.pamguard_indices:
+                timestamp = table.get_value(index, 'timestamp')
+                if (timestamp is not None and delta_t_in_seconds(timeutil.now(),
+                        timestamp) >= config.drop_target_time):
+                    table.remove(index)
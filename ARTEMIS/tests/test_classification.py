@@ -0,0 +1,162 @@
+import os.path as op
+import sys
+import time
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+# ARTEMIS modules import each other by module name
+sys.path.insert(0, op.join(op.dirname(__file__), '..'))
+pytest.importorskip('sklearn')
+from sklearn.neighbors import NearestNeighbors  # noqa
+import classification  # noqa
+import targets  # noqa
+
+
+def _assert_same_neighbors(result, expected):
+    """Checks radius_neighbors results match, ignoring neighbor order."""
+    for dist, ind, expected_dist, expected_ind in zip(*(result + expected)):
+        order, expected_order = np.argsort(ind), np.argsort(expected_ind)
+        npt.assert_equal(ind[order], expected_ind[expected_order])
+        npt.assert_allclose(dist[order], expected_dist[expected_order])
+
+
+def _wait_for_rebuild(index, timeout=10.):
+    end = time.time() + timeout
+    while index.rebuilding and time.time() < end:
+        time.sleep(0.01)
+    assert not index.rebuilding
+
+
+@pytest.mark.parametrize('background', [True, False])
+def test_incremental_index_matches_refit(background):
+    """
+    Rows added to the insert buffer, and to the tree once it is rebuilt, are
+    found as if all rows had been fitted at once.
+    """
+    rng = np.random.RandomState(21)
+    X = rng.rand(1200, 6)
+    queries = rng.rand(30, 6)
+    index = classification.IncrementalNeighborIndex(
+            radius=0.4, rebuild_threshold=150, background=background)
+    index.fit(X[:400])
+
+    # below the threshold, new rows are only in the buffer
+    index.add(X[400:500])
+    assert index.stats()['buffered'] == 100
+    refit = NearestNeighbors(radius=0.4).fit(X[:500])
+    _assert_same_neighbors(index.radius_neighbors(queries),
+                           refit.radius_neighbors(queries))
+
+    for start in range(500, len(X), 50):
+        index.add(X[start:start + 50])
+    _wait_for_rebuild(index)
+    assert index.rebuilds >= 1
+    assert index.n_indexed > 500
+    refit = NearestNeighbors(radius=0.4).fit(X)
+    _assert_same_neighbors(index.radius_neighbors(queries),
+                           refit.radius_neighbors(queries))
+    _assert_same_neighbors(index.radius_neighbors(queries, 0.2),
+                           refit.radius_neighbors(queries, 0.2))
+
+
+@pytest.mark.parametrize('metric,p', [('minkowski', 1), ('minkowski', 2),
+                                      ('chebyshev', 2), ('minkowski', 3)])
+def test_grid_index_matches_brute_force(metric, p):
+    rng = np.random.RandomState(22)
+    X = rng.rand(2000, 4)
+    queries = np.vstack([rng.rand(50, 4), X[:10], [[0.15, 0.3, 0.45, 0.6]]])
+    index = classification.GridIndex(radius=0.15, metric=metric, p=p)
+    index.fit(X[:1500])
+    index.add(X[1500:])
+    brute = NearestNeighbors(radius=0.15, algorithm='brute', metric=metric,
+                             p=p).fit(X)
+    _assert_same_neighbors(index.radius_neighbors(queries),
+                           brute.radius_neighbors(queries))
+    _assert_same_neighbors(index.radius_neighbors(queries, 0.05),
+                           brute.radius_neighbors(queries, 0.05))
+    with pytest.raises(ValueError):
+        index.radius_neighbors(queries, 0.2)
+
+
+def test_grid_index_with_large_radius_has_one_cell():
+    """Scaled features all fall in one cell of side 5.0, the default."""
+    rng = np.random.RandomState(5)
+    index = classification.GridIndex().fit(rng.rand(100, 6))
+    assert index.stats()['cells'] == 1
+
+
+def test_grid_classifier_fits_and_predicts():
+    rng = np.random.RandomState(2)
+    X = rng.rand(300, 6)
+    labels = np.where(X[:, 0] < 0.5, 1, 2)
+    target_space = targets.TargetSpace()
+    target_space.append_classifier_rows(
+            [targets.Target(target_space, source='MSL') for _ in X],
+            X.tolist(), labels.tolist())
+    classifier = classification.RadiusNeighborsClassifier(
+            classification.classification_weights, target_space, radius=0.4,
+            algorithm='grid')
+    assert classifier.algorithm == 'grid'
+    classifier.fit(*target_space.classifier_snapshot())
+    assert isinstance(classifier._index, classification.GridIndex)
+    queries = np.array([[0.05, 0.5, 0.5, 0.5, 0.5, 0.5],
+                        [0.95, 0.5, 0.5, 0.5, 0.5, 0.5]])
+    npt.assert_equal(classifier.predict(queries), [1, 2])
+    # new targets are added to the grid without refitting
+    target_space.append_classifier_rows(
+            [targets.Target(target_space, source='MSL')],
+            [[0.1, 0.5, 0.5, 0.5, 0.5, 0.5]], [3])
+    assert classifier.update() == 1
+    assert len(classifier._index) == 301
+
+
+def _loop_weights(neigh_dist, neigh_ind, target_space):
+    """Weights of one query's neighbors, one neighbor at a time, looking up
+    each neighbor's source as classification_weights used to.
+    """
+    weights = []
+    for distance, ind in zip(neigh_dist, neigh_ind):
+        source = target_space.classifier_index_to_target[ind].source
+        if source.startswith(classification.config.site_name):
+            source_weight = 1 if source.endswith('manual') else 0.9
+        elif source.endswith('manual'):
+            source_weight = 0.9
+        elif source.endswith('auto'):
+            source_weight = 0.8
+        else:
+            source_weight = 1
+        weights.append(source_weight / (distance if distance != 0 else 1))
+    return np.array(weights)
+
+
+def test_classification_weights_match_loop():
+    rng = np.random.RandomState(23)
+    site = classification.config.site_name
+    sources = [site + '_auto', site + '_manual', 'OtherSite_auto',
+               'OtherSite_manual', 'unknown']
+    X = rng.rand(500, 3)
+    target_space = targets.TargetSpace()
+    target_space.append_classifier_rows(
+            [targets.Target(target_space, source=sources[i % len(sources)])
+             for i in range(len(X))], X.tolist(), [1] * len(X))
+    # includes queries on a training row (distance 0) and with no neighbors
+    queries = np.vstack([rng.rand(40, 3), X[:3], [[5., 5., 5.]]])
+    neigh_dist, neigh_ind = NearestNeighbors(radius=0.2).fit(X)\
+            .radius_neighbors(queries)
+    assert len(neigh_ind[-1]) == 0
+
+    weights = classification.classification_weights(neigh_dist, neigh_ind,
+                                                     target_space)
+    assert weights.dtype == object and len(weights) == len(queries)
+    for dist, ind, query_weights in zip(neigh_dist, neigh_ind, weights):
+        expected = _loop_weights(dist, ind, target_space)
+        npt.assert_allclose(query_weights, expected)
+        # single query
+        npt.assert_allclose(classification.classification_weights(
+                dist, ind, target_space), expected)
+    assert len(weights[-1]) == 0
+    empty = classification.classification_weights(
+            np.empty(0, dtype=object), np.empty(0, dtype=object), target_space)
+    assert len(empty) == 0
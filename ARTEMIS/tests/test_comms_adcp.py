@@ -0,0 +1,90 @@
+import os.path as op
+import sys
+
+import numpy as np
+import numpy.testing as npt
+
+# ARTEMIS modules import each other by module name
+sys.path.insert(0, op.join(op.dirname(__file__), '..'))
+import comms_adcp  # noqa
+
+
+class _Stage:
+    def __init__(self):
+        self.data = []
+
+    def addDataToStage(self, stream, data):
+        self.data.append((stream, data))
+
+
+def _packet(seconds, currents, pressure=12):
+    """Encodes currents (nBeams x nCells, mm/s) as an ADCP UDP packet."""
+    n_beams, n_cells = currents.shape
+    values = ' '.join(str(int(value)) for value in currents.ravel())
+    return 'AAAA {0} 250 {1} {2} {3} {4} 1234 ZZZZ'.format(
+            seconds, n_cells, n_beams, pressure, values).encode()
+
+
+def _list_burst(packets):
+    """Burst mean, speed and heading computed from a list of decoded pings,
+    as ADCP_read and process_ADCP did before the running sums.
+    """
+    currents = []
+    for data in packets:
+        tokens = data.decode('utf-8').split(' ')
+        n_cells, n_beams = int(tokens[3]), int(tokens[4])
+        current = np.array(list(map(float, tokens[6:-2]))) / 1000
+        currents.append(np.resize(current, (n_beams, n_cells)).round(3))
+    bin_avg = np.mean(np.array(currents), axis=0)
+    avg = np.mean(bin_avg[:, 1:4], axis=1).round(3)
+    return bin_avg, (avg[1]**2 + avg[0]**2)**0.5, avg
+
+
+def test_burst_matches_list_based_summary():
+    rng = np.random.RandomState(18)
+    for east, north in [(300, 200), (-300, 200), (-300, -200), (300, -200)]:
+        packets = []
+        for ping in range(20):
+            currents = rng.randint(-50, 50, size=(4, 8))
+            currents[0] += east
+            currents[1] += north
+            packets.append(_packet(1460000000 + ping, currents))
+        burst = comms_adcp.ADCPBurst(max_pings=5)
+        for data in packets:
+            assert burst.add(data)
+        stage_instance = _Stage()
+        comms_adcp.end_ADCP_burst(stage_instance, burst)
+
+        bin_avg, speed, avg = _list_burst(packets)
+        (stream, (timestamp, burst_speed, heading)), = stage_instance.data
+        assert stream == 'adcp'
+        assert timestamp == 1460000019.25
+        npt.assert_allclose(burst.pings[4], _list_burst(packets[4:5])[0])
+        npt.assert_allclose(burst_speed, speed)
+        npt.assert_allclose(heading, np.arctan2(avg[1], avg[0]).round(3))
+        if east > 0:
+            # arctan2 only differs from the old arctan(north/east) when the
+            # current has a westward component
+            npt.assert_allclose(heading, np.arctan(avg[1] / avg[0]).round(3))
+        assert burst.count == 0
+
+
+def test_bad_packets_are_rejected():
+    currents = np.arange(8).reshape(2, 4)
+    good = _packet(1460000000, currents)
+    burst = comms_adcp.ADCPBurst()
+    assert burst.add(good)
+    bad = [good[:-4],  # no end marker
+           good[:30] + b' ZZZZ',  # truncated
+           good.replace(b' 5 ', b' 5x '),  # garbled value
+           good.replace(b' 5 ', b' '),  # value missing
+           good.replace(b'AAAA 1460000000', b'AAAA 14600x0000'),  # header
+           b'AAAA 1 2 ZZZZ']
+    for data in bad:
+        assert not burst.add(data), data
+        assert comms_adcp.decode_ADCP(data) == ([], [])
+    assert burst.count == 1
+    npt.assert_allclose(burst.mean(), currents / 1000.)
+    current, header = comms_adcp.decode_ADCP(good)
+    npt.assert_allclose(current, currents / 1000.)
+    assert header == [1460000000.25, 4, 2, 12]
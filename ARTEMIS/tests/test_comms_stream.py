@@ -0,0 +1,97 @@
+import os.path as op
+import selectors
+import struct
+import sys
+
+# ARTEMIS modules import each other by module name
+sys.path.insert(0, op.join(op.dirname(__file__), '..'))
+from comms_reactor import StreamChannel  # noqa
+from comms_stream import FramedStreamReader  # noqa
+
+
+def _reader(**kwargs):
+    return FramedStreamReader('localhost', 0, **kwargs)
+
+
+def test_null_framing_splits_across_feeds():
+    reader = _reader()
+    stream = b'first\0second message\0\0third\0'
+    messages = []
+    # one byte at a time, then the rest in one feed
+    for i in range(10):
+        messages += reader.feed(stream[i:i + 1])
+    messages += reader.feed(stream[10:])
+    assert messages == [b'first', b'second message', b'third']
+    assert reader.feed(b'') == []
+    assert reader.stats()['buffered'] == 0
+
+
+def test_null_framing_skips_empty_messages():
+    reader = _reader()
+    assert reader.feed(b'\0\0\0') == []
+    assert reader.feed(b'a\0\0b') == [b'a']
+    assert reader.feed(b'\0') == [b'b']
+    assert reader.messages_received == 2
+
+
+def test_length_framing():
+    reader = _reader(framing='length', length_format='>H')
+    payloads = [b'abc', b'', b'x' * 300]
+    stream = b''.join(struct.pack('>H', len(p)) + p for p in payloads)
+    # split inside the second length prefix and inside the last payload
+    assert reader.feed(stream[:6]) == [b'abc']
+    assert reader.feed(stream[6:50]) == [b'']
+    assert reader.feed(stream[50:]) == [b'x' * 300]
+    assert reader.stats()['buffered'] == 0
+
+
+class _Socket:
+    """Non-blocking socket that accepts at most limit bytes per send, and
+    none once full.
+    """
+    def __init__(self, limit, full_after):
+        self.limit = limit
+        self.full_after = full_after
+        self.sent = b''
+
+    def getsockopt(self, *args):
+        return 0
+
+    def send(self, data):
+        if len(self.sent) >= self.full_after:
+            raise BlockingIOError()
+        data = bytes(data[:self.limit])
+        self.sent += data
+        return len(data)
+
+
+class _Selector:
+    def __init__(self):
+        self.events = None
+
+    def modify(self, sock, events, data):
+        self.events = events
+
+
+class _Reactor:
+    def __init__(self):
+        self.selector = _Selector()
+
+
+def test_partial_handshake_is_sent_once():
+    handshake = b'0123456789' * 3
+    reader = _reader(handshake=handshake)
+    reader.sock = _Socket(limit=4, full_after=12)
+    channel = StreamChannel('nims', reader, on_messages=None)
+    channel.reactor = _Reactor()
+    channel.sock = reader.sock
+    channel.state = 'connecting'
+    channel.handle(selectors.EVENT_WRITE, 0.)
+    assert channel.state == 'handshake'
+    assert reader.sock.sent == handshake[:12]
+
+    reader.sock.full_after = len(handshake)
+    channel.handle(selectors.EVENT_WRITE, 1.)
+    assert channel.state == 'connected'
+    assert channel.reactor.selector.events == selectors.EVENT_READ
+    assert reader.sock.sent == handshake
@@ -0,0 +1,82 @@
+import os.path as op
+import select
+import socket
+import sys
+
+import pytest
+
+# ARTEMIS modules import each other by module name
+sys.path.insert(0, op.join(op.dirname(__file__), '..'))
+import comms_udp  # noqa
+
+
+@pytest.fixture
+def loopback():
+    """Yields a function opening a DatagramReceiver on loopback, and a
+    socket sending to it.
+    """
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receivers = []
+
+    def open_receiver(**kwargs):
+        receiver = comms_udp.DatagramReceiver(('127.0.0.1', 0), **kwargs)
+        receiver.open()
+        receivers.append(receiver)
+        return receiver, receiver.sock.getsockname()
+
+    yield open_receiver, sender
+    sender.close()
+    for receiver in receivers:
+        receiver.close()
+
+
+def _wait(receiver):
+    ready, _, _ = select.select([receiver.sock], [], [], 5)
+    assert ready
+
+
+def test_drain_counts_truncated_datagrams(loopback):
+    open_receiver, sender = loopback
+    receiver, address = open_receiver(buff_size=16)
+    for data in [b'short', b'x' * 100, b'exactly sixteen!', b'last']:
+        sender.sendto(data, address)
+    _wait(receiver)
+    assert receiver.drain() == [b'short', b'exactly sixteen!', b'last']
+    stats = receiver.stats()
+    assert stats['truncated'] == 1
+    assert stats['datagrams'] == 3 and stats['bytes'] == 25
+    assert receiver.drain() == []
+
+
+def test_drain_returns_at_most_max_datagrams(loopback):
+    open_receiver, sender = loopback
+    receiver, address = open_receiver()
+    for i in range(10):
+        sender.sendto(str(i).encode(), address)
+    _wait(receiver)
+    assert receiver.drain(max_datagrams=4) == [b'0', b'1', b'2', b'3']
+    assert receiver.drain(max_datagrams=4) == [b'4', b'5', b'6', b'7']
+    assert receiver.drain() == [b'8', b'9']
+    assert receiver.stats()['largest_drain'] == 4
+    assert receiver.stats()['drains'] == 3
+
+
+@pytest.mark.skipif(comms_udp.SO_RXQ_OVFL is None,
+                    reason='kernel does not report dropped datagrams')
+def test_drain_counts_dropped_datagrams(loopback):
+    """
+    Datagrams dropped because the kernel buffer was full are reported with
+    the next datagram received.
+    """
+    open_receiver, sender = loopback
+    receiver, address = open_receiver(rcvbuf=4096)
+    sent = 200
+    for i in range(sent):
+        sender.sendto(b'x' * 1000, address)
+    _wait(receiver)
+    received = len(receiver.drain())
+    sender.sendto(b'after', address)
+    _wait(receiver)
+    assert receiver.drain() == [b'after']
+    assert received < sent
+    assert receiver.stats()['dropped'] == sent - received
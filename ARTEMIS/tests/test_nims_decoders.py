@@ -0,0 +1,57 @@
+import json
+import os.path as op
+import sys
+
+import numpy as np
+import numpy.testing as npt
+
+# ARTEMIS modules import each other by module name
+sys.path.insert(0, op.join(op.dirname(__file__), '..'))
+import comms_NIMS_sim  # noqa
+import config  # noqa
+import nims_decoders  # noqa
+
+
+class _Stage:
+    def __init__(self):
+        self.columns = []
+
+    def addColumnsToStage(self, stream, columns):
+        self.columns.append(columns)
+
+
+def _message(ping_num, track_ids, timestamp=None):
+    message = {'ping_num': ping_num,
+               'tracks': [{'id': track_id} for track_id in track_ids]}
+    if timestamp is not None:
+        message['timestamp'] = timestamp
+    return json.dumps(message).encode()
+
+
+def test_coalesced_messages_get_distinct_times(monkeypatch):
+    """
+    Messages received in one read are given arrival times one ping apart,
+    so pings of a track are not all at the same time.
+    """
+    monkeypatch.setattr(comms_NIMS_sim.timeutil, 'now', lambda: 100.)
+    stage_instance = _Stage()
+    messages = [_message(ping, [1, 2]) for ping in range(3)]
+    comms_NIMS_sim.get_tracks(stage_instance, messages,
+                              nims_decoders.JSONDecoder())
+    columns, = stage_instance.columns
+    period = 1. / config.nims_ping_rate
+    npt.assert_allclose(columns['timestamp'],
+                        np.repeat([100. - 2 * period, 100. - period, 100.], 2))
+    npt.assert_equal(columns['id'], [1, 2] * 3)
+
+
+def test_message_time_is_used_when_sent():
+    decoder = nims_decoders.JSONDecoder()
+    columns = decoder.decode([_message(0, [1], 50.), _message(1, [1, 2])],
+                             [98., 99.])
+    npt.assert_equal(columns['timestamp'], [50., 99., 99.])
+
+    binary = [nims_decoders.encode_binary([{'id': 1}], ping, 10. + ping)
+              for ping in range(2)]
+    columns = nims_decoders.BinaryDecoder().decode(binary, [98., 99.])
+    npt.assert_equal(columns['timestamp'], [10., 11.])
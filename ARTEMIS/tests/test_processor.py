@@ -0,0 +1,204 @@
+import os
+import os.path as op
+import sys
+import threading
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+# ARTEMIS modules import each other by module name
+sys.path.insert(0, op.join(op.dirname(__file__), '..'))
+pytest.importorskip('sklearn')
+from sklearn.base import BaseEstimator  # noqa
+import classification  # noqa
+import processor  # noqa
+import targets  # noqa
+
+
+def test_load_targets_dates_are_epoch_seconds(tmp_path, monkeypatch):
+    os.mkdir(str(tmp_path / 'ARTEMIS'))
+    with open(str(tmp_path / 'ARTEMIS' / 'model.csv'), 'w') as f:
+        f.write('id;size;speed;deltav;target_strength;current;time_of_day;'
+                'passive_acoustics;source;date;classification\n'
+                '1;1;2;3;4;5;6;7;"MSL_auto";2016-04-07T03:33:20;1.1\n'
+                '2;7;6;5;4;3;2;1;"MSL_auto";;1.2\n')
+    monkeypatch.chdir(str(tmp_path))
+    target_space = targets.TargetSpace()
+    class_processor = processor.ClassificationProcessor(None, target_space,
+            None, auto_start_thread=False)
+    class_processor.load_targets('model.csv', 'csv')
+    loaded = [target_space.classifier_index_to_target[index]
+              for index in target_space.targets]
+    assert loaded[0].firstseen == loaded[0].lastseen == 1460000000.
+    # targets without a date are given the time they were loaded
+    assert isinstance(loaded[1].firstseen, float)
+    assert loaded[1].firstseen > loaded[0].firstseen
+
+
+class _PausedClassifier(classification.RadiusNeighborsClassifier):
+    """Classifier whose fit waits for release to be set."""
+    # class attributes, as clone() only copies constructor parameters
+    started = threading.Event()
+    release = threading.Event()
+
+    def fit(self, X, y):
+        self.started.set()
+        assert self.release.wait(10)
+        return classification.RadiusNeighborsClassifier.fit(self, X, y)
+
+
+def _append_rows(target_space, features, classifications):
+    target_space.append_classifier_rows(
+            [targets.Target(target_space, source='MSL') for _ in features],
+            features, classifications)
+
+
+def test_model_holder_swaps_models_without_losing_rows():
+    """
+    Predictions use the previous model until a refit is published. Rows
+    added after the refit's snapshot are added before it is published.
+    """
+    rng = np.random.RandomState(25)
+    target_space = targets.TargetSpace()
+    X = rng.rand(40, 6)
+    _append_rows(target_space, X.tolist(), [1] * 40)
+    classifier = _PausedClassifier(classification.classification_weights,
+                                   target_space, radius=0.5)
+    holder = processor.ModelHolder(classifier, target_space)
+    classifier.release.set()
+    assert holder.refit() == 1
+    first = holder.current()
+    assert first is not classifier and first.target_space is target_space
+    assert not hasattr(classifier, '_index')
+
+    classifier.started.clear()
+    classifier.release.clear()
+    holder.request_refit()
+    assert classifier.started.wait(10)
+    # rows added after the snapshot, while the new model is being fitted
+    new_rows = [[0.9] * 6, [0.95] * 6]
+    _append_rows(target_space, new_rows, [2, 2])
+    assert holder.current() is first and holder.generation == 1
+    classifier.release.set()
+    assert holder.wait_for_generation(2, timeout=10)
+
+    model = holder.current()
+    assert model is not first
+    assert model.n_samples_fit_ == 42
+    assert holder.stats()['rows_behind'] == 0
+    npt.assert_equal(model.predict(new_rows), [2, 2])
+    # the previous model was not changed
+    assert first.n_samples_fit_ == 40
+
+
+@pytest.mark.parametrize('algorithm', ['auto', 'grid'])
+def test_model_holder_update_publishes_a_copy(algorithm):
+    rng = np.random.RandomState(26)
+    target_space = targets.TargetSpace()
+    _append_rows(target_space, rng.rand(40, 6).tolist(), [1] * 40)
+    holder = processor.ModelHolder(classification.RadiusNeighborsClassifier(
+            classification.classification_weights, target_space, radius=0.5,
+            algorithm=algorithm), target_space)
+    assert holder.update() == 0
+    holder.refit()
+    first = holder.current()
+    assert holder.update() == 0
+    assert holder.current() is first and holder.generation == 1
+
+    new_rows = [[0.9] * 6, [0.95] * 6]
+    _append_rows(target_space, new_rows, [2, 2])
+    assert holder.stats()['rows_behind'] == 2
+    assert holder.update() == 2
+    model = holder.current()
+    assert model is not first and holder.generation == 2
+    assert holder.stats()['rows_behind'] == 0
+    npt.assert_equal(model.predict(new_rows), [2, 2])
+    # readers of the previous model do not see the new rows
+    assert first.n_samples_fit_ == 40
+    assert len(first._index) == 40 and len(first.classes_) == 1
+
+    # a refit keeps rows added by update()
+    holder.refit()
+    assert holder.current().n_samples_fit_ == 42
+
+
+class _CountingClassifier(BaseEstimator):
+    """Classifies every target as 1, counting calls to predict."""
+
+    def fit(self, X, y):
+        self.n_samples_fit_ = len(y)
+        self.predicted = []
+        return self
+
+    def predict(self, X):
+        self.predicted.append(len(X))
+        return np.ones(len(X), dtype=int)
+
+    def update(self):
+        return 0
+
+
+class _SendTriggers:
+    def __init__(self):
+        self.checked = []
+
+    def check_saving_rules(self, target, classification):
+        self.checked.append(target)
+
+
+class _NoADCPTarget(targets.Target):
+    def get_adcp_entry(self):
+        return None
+
+
+def _classification_processor():
+    target_space = targets.TargetSpace()
+    class_processor = processor.ClassificationProcessor(
+            _CountingClassifier(), target_space, _SendTriggers(),
+            auto_start_thread=False)
+    class_processor.fit_classifier()
+    return class_processor
+
+
+def _queue_target(target_space, track_id, cls=targets.Target):
+    start = 1.46e9
+    index = target_space.aggregate_entries('nims', [target_space.append_entry(
+            'nims', [start + track_id, track_id, 1, 1, 1., 1., 1., 1., 1., 0.,
+                     0., 120., 50., 1., 1., None])])
+    return cls(target_space, indices={'nims': index}, track_id=track_id)
+
+
+def test_batch_is_deduplicated_and_capped(monkeypatch):
+    monkeypatch.setattr(processor.config, 'classification_max_batch', 4)
+    monkeypatch.setattr(processor.config, 'classification_latency_budget', 0.)
+    class_processor = _classification_processor()
+    target_space = class_processor.target_space
+    target_space.append_entry('adcp', [1.46e9, 0.5, 1.])
+    queued = [_queue_target(target_space, i) for i in range(3)]
+    for target in [queued[0], queued[1], queued[0], queued[2], queued[1]]:
+        class_processor.addTargetToQueue(target)
+
+    batch = class_processor.getTargetBatch(timeout=1.)
+    assert batch == [queued[0], queued[1], queued[0], queued[2]]
+    assert class_processor.queue.qsize() == 1
+    assert class_processor.classifyTargets(batch) == queued
+    model = class_processor.classifier
+    assert model.predicted == [3]
+    assert [target.classification for target in queued] == [1, 1, 1]
+    assert class_processor.send_triggers.checked == queued
+    assert class_processor.stats()['largest_batch'] == 3
+
+
+def test_unclassifiable_targets_are_skipped():
+    class_processor = _classification_processor()
+    target_space = class_processor.target_space
+    target_space.append_entry('adcp', [1.46e9, 0.5, 1.])
+    good = _queue_target(target_space, 1)
+    no_adcp = _queue_target(target_space, 2, cls=_NoADCPTarget)
+    expired = _queue_target(target_space, 3)
+    target_space.remove_old_nims(expired)
+    assert class_processor.classifyTargets([no_adcp, good, expired]) == [good]
+    assert class_processor.classifier.predicted == [1]
+    assert no_adcp.classification is None
+    assert class_processor.stats()['skipped'] == 2
@@ -0,0 +1,177 @@
+import os.path as op
+import sys
+import threading
+
+import numpy as np
+
+# ARTEMIS modules import each other by module name
+sys.path.insert(0, op.join(op.dirname(__file__), '..'))
+import stage  # noqa
+import targets  # noqa
+
+
+class _Stage(stage.Stage):
+    """Stage whose deadlines are processed by the test, not a thread."""
+
+    def startStageProcessing(self):
+        pass
+
+
+def _stage():
+    return _Stage(processor=None, target_space=targets.TargetSpace(),
+                  send_triggers=None)
+
+
+def _ping(stage_instance, track_id, timestamp):
+    return stage_instance.target_space.append_entry('nims',
+        [timestamp, track_id, 1, 1, 1., 1., 1., 1., 1., 0., 0., 120., 50.,
+         1., 1., None])
+
+
+def test_expire_target_after_nims_rows_aged_out():
+    """
+    A target whose nims rows expired before it did is still removed from the
+    track lookup, so later pings of its track start a new target.
+    """
+    stage_instance = _stage()
+    start = stage.timeutil.now()
+    pings = [_ping(stage_instance, 1, start + t) for t in [0., 0.5]]
+    target = stage_instance.createOrUpdateTarget(nims=(1, pings))
+    assert target.track_id == 1
+    # other tracks keep pinging until track 1's rows age out of the table
+    retention = stage_instance.target_space.tables['nims'].retention
+    for timestamp in np.arange(start, start + retention + 5, 0.5):
+        _ping(stage_instance, 2, timestamp)
+    assert not target.has_entry('nims')
+    stage_instance.expireRecentTargets([target])
+    assert 1 not in stage_instance.targets_by_track_id
+
+    later = start + retention + 6
+    new_target = stage_instance.createOrUpdateTarget(
+            nims=(1, [_ping(stage_instance, 1, later)]))
+    assert new_target is not target
+    assert stage_instance.targets_by_track_id[1] is new_target
+
+
+def test_update_target_without_nims_entry():
+    """Pings for a target whose nims entry is gone start a new aggregate."""
+    stage_instance = _stage()
+    start = stage.timeutil.now()
+    target = stage_instance.createOrUpdateTarget(
+            nims=(1, [_ping(stage_instance, 1, start)]))
+    stage_instance.target_space.remove_old_nims(target)
+    assert not target.has_entry('nims')
+    ping = _ping(stage_instance, 1, start + 1.)
+    assert stage_instance.createOrUpdateTarget(nims=(1, [ping])) is target
+    assert target.get_entry_value('nims', 'aggregate_indices') == [ping]
+    assert target.lastseen == start + 1.
+
+
+def test_expired_target_keeps_classifier_features():
+    """
+    A classified target is stored with the features it was classified with,
+    even when its nims rows aged out before it expired. Classified targets
+    with no features at all are counted, not silently dropped.
+    """
+    stage_instance = _stage()
+    target_space = stage_instance.target_space
+    start = stage.timeutil.now()
+    classified = stage_instance.createOrUpdateTarget(
+            nims=(1, [_ping(stage_instance, 1, start)]))
+    classified.features = target_space.get_classifier_features([classified])[0]
+    classified.classification = 1
+    lost = stage_instance.createOrUpdateTarget(
+            nims=(2, [_ping(stage_instance, 2, start)]))
+    lost.classification = 2
+    retention = target_space.tables['nims'].retention
+    _ping(stage_instance, 3, start + retention + 1)
+    assert not classified.has_entry('nims') and not lost.has_entry('nims')
+
+    stage_instance.expireRecentTargets([classified, lost])
+    assert target_space.tables['classifier_features'] == [classified.features]
+    assert target_space.tables['classifier_classifications'] == [1]
+    assert target_space.classifier_targets_dropped == 1
+
+
+def test_pamguard_refreshes_only_acoustic_targets():
+    """
+    A detection after a NIMS target's latest ping pairs with the target but
+    does not postpone its expiry past its nims rows. Acoustic-only targets
+    are kept alive by their detections.
+    """
+    stage_instance = _stage()
+    target_space = stage_instance.target_space
+    start = stage.timeutil.now()
+    target = stage_instance.createOrUpdateTarget(
+            nims=(1, [_ping(stage_instance, 1, start)]))
+    detection = target_space.append_entry('pamguard', [start + 1.5, 1])
+    stage_instance.addPamguardToTarget(target, [detection])
+    assert target.pamguard_indices == [detection]
+    assert target.lastseen == start
+
+    first = target_space.append_entry('pamguard', [start, 1])
+    acoustic = stage_instance.createOrUpdateTarget(pamguard=first)
+    stage_instance.addPamguardToTarget(acoustic, [detection])
+    assert acoustic.lastseen == start + 1.5
+
+
+def test_expiry_batch_does_not_hold_stage_lock(monkeypatch):
+    """
+    Expired targets are removed under the stage lock, but their features
+    are stored and entries cleared after releasing it, so comms threads can
+    add data meanwhile.
+    """
+    stage_instance = _stage()
+    target_space = stage_instance.target_space
+    start = stage.timeutil.now()
+    target = stage_instance.createOrUpdateTarget(
+            nims=(1, [_ping(stage_instance, 1, start)]))
+    stored = []
+
+    def update_batch(targets):
+        acquired = []
+        def add_data():
+            acquired.append(stage_instance.condition.acquire(timeout=5))
+            stage_instance.condition.release()
+        thread = threading.Thread(target=add_data)
+        thread.start()
+        thread.join()
+        assert acquired == [True]
+        stored.extend(targets)
+
+    monkeypatch.setattr(target_space, 'update_batch', update_batch)
+    monkeypatch.setattr(stage.timeutil, 'now',
+                        lambda: start + stage.config.drop_target_time + 1)
+    stage_instance.processDueDeadlines(wait=False)
+    assert stored == [target]
+    assert target not in stage_instance.recent_targets
+    assert 1 not in stage_instance.targets_by_track_id
+
+
+def test_nims_burst_is_staged_in_one_batch():
+    """
+    A multi-ping burst is written as contiguous nims rows, queued by track,
+    and each track gets one flush deadline.
+    """
+    stage_instance = _stage()
+    start = stage.timeutil.now()
+    tracks = [[{'id': 1}, {'id': 2}], [{'id': 1}], [{'id': 2}, {'id': 1}]]
+    records = [[start + 0.1 * i, ping] for i, ping in enumerate(tracks)]
+    first = len(stage_instance.target_space.tables['nims'])
+    timing = stage_instance.addBatchToStage('nims', records)
+
+    table = stage_instance.target_space.tables['nims']
+    rows = list(range(first, first + 5))
+    assert list(table.valid_indices()) == rows
+    assert table.take('id', rows).tolist() == [1, 2, 1, 2, 1]
+    assert stage_instance.data_queues['nims'] == {1: [rows[0], rows[2], rows[4]],
+                                                  2: [rows[1], rows[3]]}
+    nims_deadlines = [(deadline, key) for deadline, _, kind, key
+                      in stage_instance.deadlines if kind == 'nims']
+    max_time = stage.config.data_streams_classifier_triggers['nims_max_time']
+    assert sorted(nims_deadlines) == [(start + max_time, 1),
+                                      (start + max_time, 2)]
+    for key in ['records', 'rows', 'decode', 'lock_wait', 'write', 'queue',
+                'total']:
+        assert key in timing
+    assert timing['records'] == 3 and timing['rows'] == 5
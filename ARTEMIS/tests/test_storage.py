@@ -0,0 +1,220 @@
+import os.path as op
+import sys
+import threading
+import time
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+# ARTEMIS modules import each other by module name
+sys.path.insert(0, op.join(op.dirname(__file__), '..'))
+from storage import ReadWriteLock, TimeIndex, TimeWindowTable  # noqa
+import targets  # noqa
+
+
+def _table(retention=10., capacity=4):
+    return TimeWindowTable(['timestamp', 'id', 'value'], retention, capacity)
+
+
+def test_ring_wraps_without_growing():
+    """
+    At a steady data rate, old rows expire and their slots are reused, so
+    indices keep increasing while the ring keeps its capacity.
+    """
+    table = _table(retention=2.5, capacity=4)
+    indices = [table.append([float(t), t, 10. * t]) for t in range(20)]
+    npt.assert_equal(indices, np.arange(20))
+    assert table.capacity == 4
+    assert table.stats()['grown'] == 0
+    # rows within 2.5 s of the newest (t=19) survive
+    npt.assert_equal(table.valid_indices(), [17, 18, 19])
+    assert not table.is_valid(16)
+    assert table.get_value(16, 'value') is None
+    npt.assert_equal(table.take('value', [17, 18, 19]), [170., 180., 190.])
+    npt.assert_equal(table.column('id'), [17, 18, 19])
+
+
+def test_ring_grows_when_window_is_full():
+    """Rows still inside the retention window are never overwritten."""
+    table = _table(retention=100., capacity=4)
+    for t in range(6):
+        table.append([float(t), t, 0.])
+    assert table.capacity == 8
+    npt.assert_equal(table.valid_indices(), np.arange(6))
+    npt.assert_equal(table.column('timestamp'), np.arange(6.))
+
+
+def test_extend_matches_append():
+    """
+    Writing rows in one batch gives the same table as appending them, once
+    the next row expires what the batch left outside the window.
+    """
+    appended, extended = _table(capacity=2), _table(capacity=2)
+    timestamps = np.arange(0., 30., 1.5)
+    for t in timestamps:
+        appended.append([t, int(t), 2 * t])
+    extended.extend({'timestamp': timestamps, 'id': timestamps.astype(int),
+                     'value': 2 * timestamps})
+    # a batch only expires rows older than the window of its newest row
+    assert len(extended.valid_indices()) == len(timestamps)
+    for table in [appended, extended]:
+        table.append([30., 30, 60.])
+    npt.assert_equal(appended.valid_indices(), extended.valid_indices())
+    for name in ['timestamp', 'id', 'value']:
+        npt.assert_equal(appended.column(name), extended.column(name))
+    assert appended.asof(20.) == extended.asof(20.)
+
+
+def test_asof_and_window_skip_removed_rows():
+    table = _table(retention=100., capacity=8)
+    for t in range(6):
+        table.append([float(t), t, 0.])
+    table.remove(3)
+    table.remove(4)
+    assert table.asof(4.5) == 2
+    assert table.asof(5.) == 5
+    assert table.asof(-1.) is None
+    assert table.nearest(-1.) == 0
+    npt.assert_equal(table.window(1., 4.), [1, 2])
+    # removed row is not found by index either
+    assert not table.is_valid(3)
+
+
+def test_time_index_out_of_order_inserts():
+    valid = set()
+    index = TimeIndex(lambda row: row in valid)
+    for key, row in [(1., 0), (3., 1), (2., 2), (5., 3), (4., 4)]:
+        index.insert(key, row)
+        valid.add(row)
+    assert index.window(2., 4.) == [2, 1, 4]
+    assert index.asof(3.5) == 1
+    index.discard(3., 1)
+    valid.discard(1)
+    assert index.asof(3.5) == 2
+    assert index.after(2.) == 4
+    # trim only drops leading entries whose rows are gone
+    valid.discard(0)
+    index.trim(2.5)
+    assert len(index) == 3
+    assert index.window(0., 10.) == [2, 4, 3]
+
+
+def test_compaction_has_hysteresis():
+    """
+    A table is compacted once enough rows were removed since the last
+    compaction, not on every call while old holes remain.
+    """
+    table = _table(retention=100., capacity=16)
+    for t in range(10):
+        table.append([float(t), t, 0.])
+    table.remove(0)
+    table.remove(1)
+    table.remove(5)
+    assert table.needs_compaction(0.2)
+    assert not table.needs_compaction(0.5)
+    assert table.compact() == 2
+    assert table.stats()['oldest_index'] == 2
+    # the hole at row 5 remains, but nothing was removed since compacting
+    assert table.fragmentation() > 0
+    assert not table.needs_compaction(0.)
+    npt.assert_equal(table.valid_indices(), [2, 3, 4, 6, 7, 8, 9])
+
+
+def _wait_until(condition, timeout=5.):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end
+        time.sleep(0.001)
+
+
+def _start(function):
+    thread = threading.Thread(target=function)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_read_lock_is_reentrant():
+    lock = ReadWriteLock()
+    with lock.reading():
+        with lock.reading():
+            assert lock._readers == 1
+        # a writer may also read and write again
+    with lock.writing():
+        with lock.reading():
+            with lock.writing():
+                pass
+    assert lock._readers == 0 and lock._writer is None
+    assert lock.stats()['reads'] == 3 and lock.stats()['writes'] == 2
+
+
+def test_read_lock_cannot_be_upgraded():
+    lock = ReadWriteLock()
+    with lock.reading():
+        with pytest.raises(RuntimeError):
+            lock.acquire_write()
+    # the failed upgrade left nothing held
+    with lock.writing():
+        assert lock._readers == 0
+
+
+def test_waiting_writer_blocks_new_readers():
+    """A writer waiting for a reader gets the lock before later readers."""
+    lock = ReadWriteLock()
+    order = []
+    lock.acquire_read()
+
+    def write():
+        with lock.writing():
+            order.append('write')
+
+    def read():
+        with lock.reading():
+            order.append('read')
+
+    writer = _start(write)
+    _wait_until(lambda: lock._waiting_writers == 1)
+    reader = _start(read)
+    _wait_until(lambda: lock.stats()['read_waits'] == 1)
+    assert order == []
+    lock.release()
+    writer.join(5)
+    reader.join(5)
+    assert order == ['write', 'read']
+    stats = lock.stats()
+    assert stats['write_waits'] == 1 and stats['read_waits'] == 1
+    assert stats['write_wait_time'] > 0 and stats['read_wait_time'] > 0
+
+
+def test_locked_takes_tables_in_sorted_order():
+    """
+    Threads locking the same tables listed in opposite orders do not
+    deadlock, as locks are always taken in order of table name.
+    """
+    target_space = targets.TargetSpace()
+    taken = []
+    for name in ['adcp', 'nims', 'pamguard']:
+        lock = target_space.locks[name]
+        def acquire_write(lock=lock, name=name, acquire=lock.acquire_write):
+            taken.append(name)
+            acquire()
+        lock.acquire_write = acquire_write
+    with target_space.locked(reads=['pamguard'], writes=['nims', 'adcp']):
+        assert taken == ['adcp', 'nims']
+        assert target_space.locks['pamguard']._readers == 1
+
+    def lock_tables(tables):
+        def run():
+            for _ in range(200):
+                with target_space.locked(writes=tables):
+                    pass
+        return run
+    threads = [_start(lock_tables(['nims', 'adcp', 'pamguard'])),
+               _start(lock_tables(['pamguard', 'adcp', 'nims']))]
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
+    for name in ['adcp', 'nims', 'pamguard']:
+        lock = target_space.locks[name]
+        assert lock._writer is None and lock._readers == 0
@@ -0,0 +1,145 @@
+import os.path as op
+import sys
+
+import numpy as np
+import numpy.testing as npt
+
+# ARTEMIS modules import each other by module name
+sys.path.insert(0, op.join(op.dirname(__file__), '..'))
+import targets  # noqa
+
+
+def _make_target(target_space, track_id, timestamps, rng):
+    """Adds pings of one track to target_space and returns its Target."""
+    indices = []
+    for timestamp in timestamps:
+        indices.append(target_space.append_entry('nims',
+            [timestamp, track_id, 1, 1, 1., 1., 1., 1., 1., 0., 0., 120., 50.,
+             rng.uniform(0, 120), rng.uniform(0, 50), None]))
+    index = target_space.aggregate_entries('nims', indices)
+    return targets.Target(target_space, indices={'nims': index, 'adcp': 0})
+
+
+def test_calculate_deltav_matches_scalar():
+    """
+    Batched delta_v for many tracks should match the ping-by-ping
+    implementation for each track.
+    """
+    rng = np.random.RandomState(2016)
+    target_space = targets.TargetSpace()
+    start = 1.46e9
+    target_space.append_entry('adcp', [start, 1.2, 0.4])
+
+    track_targets = []
+    for track_id, n_pings in enumerate([1, 2, 5, 30, 120]):
+        # jittered pings, all within the nims table retention window
+        timestamps = start + np.cumsum(rng.uniform(0.05, 0.4, n_pings))
+        track_targets.append(_make_target(target_space, track_id,
+                                          timestamps, rng))
+
+    batched = target_space.calculate_deltav(track_targets)
+    scalar = [target.calculate_deltav_scalar() for target in track_targets]
+    npt.assert_allclose(batched, scalar)
+    npt.assert_equal(batched[0], 0)
+    for target, deltav in zip(track_targets, batched):
+        npt.assert_allclose(target.calculate_deltav(), deltav)
+
+
+def test_nims_rows_outlive_target_expiry():
+    """
+    A target expires drop_target_time after its latest ping, possibly late
+    if the stage thread is busy. Its nims rows must still be in the table
+    then.
+    """
+    rng = np.random.RandomState(3)
+    target_space = targets.TargetSpace()
+    start = 1.46e9
+    target_space.append_entry('adcp', [start, 1.2, 0.4])
+    target = _make_target(target_space, 1, start + np.arange(0., 2., 0.1), rng)
+    lastseen = target.get_entry_value('nims', 'timestamp')
+    # other tracks keep pinging until the target expires, late
+    expiry = (lastseen + targets.config.drop_target_time +
+              targets.config.pamguard_association_window + 5)
+    for timestamp in np.arange(lastseen, expiry, 0.5):
+        target_space.append_entry('nims', [timestamp, 2, 1, 1, 1., 1., 1., 1.,
+                                           1., 0., 0., 120., 50., 1., 1., None])
+    assert target.has_entry('nims')
+    indices = target.get_entry_value('nims', 'aggregate_indices')
+    assert target_space.tables['nims'].valid_mask(indices).all()
+
+
+def test_running_aggregate_matches_combine():
+    """
+    Folding pings into a track's aggregate batch by batch gives the same
+    combined entry as combining all of its pings at once.
+    """
+    rng = np.random.RandomState(6)
+    target_space = targets.TargetSpace()
+    start = 1.46e9
+    indices = []
+    for timestamp in start + np.cumsum(rng.uniform(0.05, 0.2, 12)):
+        indices.append(target_space.append_entry('nims',
+            [timestamp, 7, rng.randint(1, 20), rng.randint(0, 5),
+             rng.uniform(-60, -20), 1., 1., rng.uniform(0, 2),
+             rng.uniform(0, 3), rng.uniform(0, 60), rng.uniform(0, 10),
+             rng.uniform(60, 120), rng.uniform(10, 20), rng.uniform(0, 120),
+             rng.uniform(0, 50), None]))
+    index = None
+    for batch in [indices[:1], indices[1:5], indices[5:]]:
+        index = target_space.aggregate_entries('nims', batch, index)
+    combined = target_space.combine_entries('nims', indices)
+    entry = target_space.get_entry_by_index('nims', index)
+    for name, expected in zip(targets.headers['nims'], combined):
+        if name == 'aggregate_indices':
+            assert list(entry[name]) == indices
+        else:
+            npt.assert_allclose(entry[name], expected)
+    # the previous combined entries were replaced
+    assert len(target_space.aggregates) == 1
+
+
+def test_running_aggregate_indices_are_copied_and_bounded():
+    """
+    Stored combined entries keep the indices they were built with, and a
+    track in view for longer than the nims retention only refers to pings
+    still in the table.
+    """
+    rng = np.random.RandomState(61)
+    target_space = targets.TargetSpace()
+    table = target_space.tables['nims']
+    start = 1.46e9
+    target = _make_target(target_space, 1, [start], rng)
+    first = target.get_entry('nims')['aggregate_indices']
+    assert first == [0]
+    duration = 3 * table.retention
+    for timestamp in start + np.arange(1., duration, 1.):
+        ping = target_space.append_entry('nims', [timestamp, 1, 1, 1, 1., 1.,
+                1., 1., 1., 0., 0., 120., 50., 1., 1., None])
+        target.update_entry('nims', [ping])
+    assert first == [0]
+    indices = target.get_entry_value('nims', 'aggregate_indices')
+    assert len(indices) <= table.retention + 1
+    assert table.valid_mask(indices).all()
+    assert indices[-1] == ping
+    # the running mean still covers every ping of the track
+    aggregate = target_space.aggregates[target.indices['nims']]
+    assert aggregate.count == int(duration)
+
+
+def test_adcp_entry_is_a_copy():
+    """
+    The ADCP entry read for a target does not change as the ring reuses
+    its slot.
+    """
+    rng = np.random.RandomState(13)
+    target_space = targets.TargetSpace()
+    start = 1.46e9
+    target_space.append_entry('adcp', [start, 1.2, 0.4])
+    target = _make_target(target_space, 1, [start + 1.], rng)
+    adcp = target.get_adcp_entry()
+    assert isinstance(adcp, dict)
+    table = target_space.tables['adcp']
+    for i in range(1, table.capacity + 1):
+        target_space.append_entry('adcp', [start + table.retention * 2 + i,
+                                           9., 9.])
+    assert adcp['speed'] == 1.2 and target.current_speed == 9.
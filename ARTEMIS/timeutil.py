@@ -0,0 +1,60 @@
+"""
+Shared time representation for ARTEMIS.
+
+All timestamps in the pipeline are float64 seconds since the Unix epoch (UTC),
+so time differences are plain subtraction and work element-wise on arrays.
+"""
+from datetime import datetime, timedelta
+import time
+
+import numpy as np
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def now():
+    """Returns the current time in epoch seconds (UTC)."""
+    return time.time()
+
+
+def to_epoch(value):
+    """Converts a naive UTC datetime or numpy datetime64 to epoch seconds.
+    Numbers (and arrays of numbers) are assumed to be epoch seconds already.
+    """
+    if isinstance(value, datetime):
+        return (value - _EPOCH).total_seconds()
+    if isinstance(value, (np.datetime64, np.ndarray)) and \
+            np.issubdtype(np.asarray(value).dtype, np.datetime64):
+        return np.asarray(value, dtype='datetime64[ns]').astype(np.int64) / 1e9
+    return value
+
+
+def from_string(text):
+    """Converts a date read from a file, either epoch seconds or an ISO 8601
+    date and time (UTC), to epoch seconds. Returns None for an empty string.
+    """
+    text = text.strip()
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return to_epoch(np.datetime64(text.rstrip('Z')))
+
+
+def to_datetime(timestamp):
+    """Converts epoch seconds to a naive UTC datetime."""
+    return _EPOCH + timedelta(seconds=float(timestamp))
+
+
+def delta_t_in_seconds(timestamp1, timestamp2):
+    """
+    calculate delta t in seconds between two epoch timestamps (or arrays of
+    timestamps). Returns absolute value, so order of times is insignificant.
+    """
+    return np.abs(np.subtract(timestamp1, timestamp2))
+
+
+def seconds_since_midnight(timestamp):
+    """Returns seconds elapsed since midnight UTC for epoch timestamp(s)."""
+    return np.mod(timestamp, 86400.)
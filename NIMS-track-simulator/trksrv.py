@@ -2,6 +2,7 @@
 # - calculate actual velocity
 # - change number of targets in FOV
 
+import argparse
 import struct
 import random
 import time
@@ -83,6 +84,14 @@ class track ():
                "id": self.id}
         return msg
 
+    def get_record(self):
+        """Values of the binary track record, in order of track_struct."""
+        return (self.id, self.pings_visible, self.first_ping,
+                self.target_strength, self.width, self.height, self.size_sq_m,
+                self.speed_mps, self.min_angle_m, self.min_range_m,
+                self.max_angle_m, self.max_range_m, self.last_pos_angle,
+                self.last_pos_range)
+
     def perturb(self):
         t = time.time()
         dt = t - self.last_update
@@ -141,15 +150,38 @@ def format_json(tracks, ping_num):
     for t in tracks:
         tracks_msg.append(t.get_buffer())
 
-    msg = {"ping_num": ping_num, "tracks":tracks_msg, "num_tracks":len(tracks)}
+    msg = {"ping_num": ping_num, "tracks":tracks_msg, "num_tracks":len(tracks),
+           "timestamp": time.time()}
     msg = json.dumps(msg)
     msg = codecs.latin_1_encode(msg)[0]
     frmt = "=%ds" % len(msg)
-    msg = struct.pack(frmt, msg)
+    # null terminated, as in the NIMS stream, so clients can find the end of
+    # messages that are split across (or share) reads
+    msg = struct.pack(frmt, msg) + b'\0'
     return msg
 
 
+# Binary message layout, matching ARTEMIS/nims_decoders.py: header of ping
+# number, number of tracks and timestamp, then one record per track.
+header_struct = struct.Struct('<IId')
+track_struct = struct.Struct('<3q11d')
+length_struct = struct.Struct('>I')
+
+
+def format_binary(tracks, ping_num):
+    msg = header_struct.pack(ping_num, len(tracks), time.time())
+    msg += b''.join(track_struct.pack(*t.get_record()) for t in tracks)
+    # binary data may contain null bytes, so prefix with length instead
+    return length_struct.pack(len(msg)) + msg
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulated NIMS track server')
+    parser.add_argument('--format', choices=['json', 'binary'], default='json',
+                        help='track message format (default json)')
+    args = parser.parse_args()
+    formatters = {'json': format_json, 'binary': format_binary}
+
     # probability of generating a new track if n tracks < max_targets
     track_prob = 25
     # maximum number of targets allowed
@@ -172,7 +204,7 @@ if __name__ == "__main__":
     while True:
         # create track packet to write
 
-        msg = format_json(tracks, ping_num)
+        msg = formatters[args.format](tracks, ping_num)
 
         sonar_prop.track_message = msg
         sonar_prop.ping_id += 1